@@ -8,18 +8,21 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from mangum import Mangum
 
-import calensync.api.service
-from calensync import sqs
 from calensync.api.common import format_response, ApiError
 import calensync.api.endpoints as edp
 from calensync.api.response import PostMagicLinkResponse
 from calensync.database.utils import DatabaseSession
 from calensync.dataclass import GoogleWebhookEvent, SQSEvent, QueueEvent, PostSyncRuleBody, PatchSyncRuleBody
 from calensync.log import get_logger
+from calensync.queue_backend import get_queue_backend
 from calensync.utils import get_env, utcnow
+from calensync.webhook import WebhookDebouncer, ChannelTokenCache, forward_webhook
 
 app = FastAPI(title="Calensync")  # Here is the magic
 logger = get_logger("api")
+webhook_debouncer = WebhookDebouncer()
+# optional, validates the notifications before they're queued
+channel_token_cache = ChannelTokenCache() if os.environ.get("WEBHOOK_VALIDATE_TOKENS") else None
 
 
 @app.post("/webhook")
@@ -29,13 +32,18 @@ def post__webhook(event: Request):
     token = event.headers["X-Goog-Channel-Token"]
     state = event.headers["X-Goog-Resource-State"]
     resource_id = event.headers.get("X-Goog-Resource-Id")
+    message_number = event.headers.get("X-Goog-Message-Number")
+    webhook_event = GoogleWebhookEvent(channel_id=channel_id, token=token, state=state, resource_id=resource_id)
+    if get_env() in ["prod", "dev"]:
+        # the notification is only forwarded, no need for a database session
+        forward_webhook(webhook_event, webhook_debouncer, message_number, channel_token_cache)
+        return
+
+    if not webhook_debouncer.should_forward(channel_id, state, message_number, debounce=False):
+        return
     with DatabaseSession(os.environ["ENV"]) as db:
-        webhook_event = GoogleWebhookEvent(channel_id=channel_id, token=token, state=state, resource_id=resource_id)
         sqs_event = SQSEvent(kind=QueueEvent.GOOGLE_WEBHOOK, data=webhook_event)
-        if get_env() in ["prod", "dev"]:
-            sqs.send_event(boto3.session.Session(), sqs_event.json())
-        else:
-            calensync.api.service.handle_sqs_event(sqs_event, db, boto3.Session())
+        get_queue_backend().send([sqs_event], boto3.Session(), db, delay=0)
 
 
 @app.get("/paddle/verify_transaction")
@@ -1,28 +1,22 @@
 import boto3
 
 from calensync.awslambda import daily_sync
-from calensync.awslambda.daily_sync import send_trial_finishing_email
 from calensync.database.utils import DatabaseSession
-from calensync.log import get_logger
 from calensync.utils import get_env
 
-logger = get_logger("daily_sync")
-
 
 def handler(event, context):
     """
-    Is woken up once a day, gets all currently active calendars, fetches
-    the event for the furthest in the future, and synchronizes them
+    Is woken up once a day, and queues the sync of each user with active calendars: the SQS receiver
+    fetches their events for the furthest in the future, and synchronizes them. It then renews the expiring
+    watches and sends emails to people who are finishing their trial.
+    The progress is saved, and invoking it again the same day resumes the steps which didn't finish.
+    The watches are also renewed by a separate schedule, several times a day, with the kind "renew_watches".
+    Invoking it with {"kind": "renew_watches", "reregister_all": true} registers all the watches again
     """
     with DatabaseSession(get_env()) as db:
-        boto_session = boto3.Session()
-        daily_sync.sync_user_calendars_by_date(db, boto_session)
-        daily_sync.update_watches(db)
+        if event.get("kind") == "renew_watches":
+            renewed = daily_sync.update_watches(db, reregister_all=event.get("reregister_all", False))
+            return {"renewed_watches": renewed}
 
-        # send emails to people who are finishing their trial
-        session = boto3.Session()
-        try:
-            logger.info("Starting send trial emails")
-            send_trial_finishing_email(session, db)
-        except Exception as e:
-            logger.error(f"Something happened to email sending: {e}")
+        return daily_sync.run_daily_sync(db, boto3.Session())
@@ -11,18 +11,19 @@ import peewee
 import starlette.responses
 
 import calensync.api.service
-import calensync.sqs
 from calensync import paddle
 from calensync import dataclass
 from calensync.api.common import ApiError, RedirectResponse, encode_query_message
 from calensync.api.response import PostMagicLinkResponse
 from calensync.api.service import verify_valid_sync_rule, merge_users, handle_refresh_existing_calendar, \
     handle_delete_sync_rule_event, handle_update_sync_rule_event
+from calensync.credentials import invalidate_credentials
 from calensync.database.model import User, OAuthState, Calendar, OAuthKind, CalendarAccount, Session, SyncRule, EmailDB, \
     MagicLinkDB
 from calensync.dataclass import PostSyncRuleBody, PostSyncRuleEvent, PatchSyncRuleBody
 from calensync.gwrapper import get_google_email, get_google_calendars
 from calensync.log import get_logger
+from calensync.queue_backend import get_queue_backend
 from calensync.secure import encrypt_credentials, decrypt_credentials
 from calensync.utils import get_client_secret, get_profile_and_calendar_scopes, get_profile_scopes, is_local, utcnow, \
     get_paddle_token, prefetch_get_or_none, replace_timezone
@@ -215,6 +216,7 @@ def handle_add_calendar(state_db: OAuthState, email: str, credentials_dict: dict
     else:
         account.encrypted_credentials = encrypted_credentials
         account.save()
+        invalidate_credentials(account.id)
 
     state_db.delete_instance()
     if delete_secondary_user and other_user is not None:
@@ -390,10 +392,7 @@ def get_calendar(user: User, calendar_id: str, db: peewee.Database) -> Calendar:
 def _launch_resync_rule_event(rule: SyncRule, db, boto_session):
     event = PostSyncRuleEvent(sync_rule_id=rule.id)
     sqs_event = dataclass.SQSEvent(kind=dataclass.QueueEvent.POST_SYNC_RULE, data=event)
-    if is_local():
-        calensync.api.service.handle_sqs_event(sqs_event, db, boto_session)
-    else:
-        calensync.sqs.send_event(boto3.Session(), sqs_event.json())
+    get_queue_backend().send([sqs_event], boto_session, db, delay=0)
 
 
 def resync_rule(user: User, rule_uuid: str, boto_session: boto3.Session, db: peewee.Database):
@@ -1,24 +1,32 @@
 from __future__ import annotations
 
+import collections
 import datetime
 import traceback
-from typing import Tuple
+from typing import Tuple, List, Set, Callable
 
 import boto3
 import peewee
+import pydantic
 
 from calensync.api.common import number_of_days_to_sync_in_advance, ApiError
 from calensync.database.model import Calendar, User, SyncRule, EmailDB, CalendarAccount, Session
 from calensync.dataclass import EventExtendedProperty, DeleteSyncRuleEvent, GoogleCalendar, SQSEvent, QueueEvent, \
-    GoogleWebhookEvent, PostSyncRuleEvent, UpdateGoogleEvent, EventStatus, PatchSyncRuleBody
-from calensync.gwrapper import GoogleCalendarWrapper, delete_events_for_sync_rule
+    GoogleWebhookEvent, PostSyncRuleEvent, UpdateGoogleEvent, EventStatus, PatchSyncRuleBody, DailySyncEvent
+from calensync.gwrapper import GoogleCalendarWrapper, delete_events_for_sync_rule, COPY_DELETION_FIELDS, \
+    build_rule_copy_index, get_calendar_wrapper
+from calensync.libcalendar import recurrences_first
 from calensync.log import get_logger
+from calensync.queries.common import get_sync_rules_with_calendars
 from calensync.sqs import SQSEventRun, check_if_should_run_time_or_wait, push_update_event_to_queue, \
     prepare_event_to_push
 from calensync.utils import utcnow
 
 logger = get_logger(__file__)
 
+# below this number of events of a rule, looking up each copy is cheaper than listing the destination
+COPY_INDEX_MIN_EVENTS = 3
+
 
 def verify_valid_sync_rule(user: User, source_calendar_uuid: str, destination_calendar_uuid: str
                            ) -> Tuple[Calendar, Calendar]:
@@ -70,15 +78,15 @@ def run_initial_sync(sync_rule_id: int, session: boto3.Session, db):
 
     # number of days to sync in the future
     end_date = start_date + datetime.timedelta(days=number_of_days_to_sync_in_advance())
-    events = source_wrapper.get_events(start_date, end_date)
-
-    # sorts them so that even that have a recurrence are handled first
-    events.sort(key=lambda x: x.recurrence is None)
-
-    events = list(filter(lambda x: len(x.extendedProperties.private) == 0, events))
-    logger.info(f"Found {len(events)} events, pushing to queue")
-    prepared_events = [prepare_event_to_push(e, sync_rule.id, False) for e in events]
-    push_update_event_to_queue(prepared_events, session, db)
+    n_events = 0
+    # events are pushed page by page, so that only one page is held in memory at a time. The recurrences are
+    # pushed before their instances, also across pages
+    for events in recurrences_first(source_wrapper.iter_event_pages(start_date, end_date)):
+        events = list(filter(lambda x: len(x.extendedProperties.private) == 0, events))
+        prepared_events = [prepare_event_to_push(e, sync_rule.id, False) for e in events]
+        push_update_event_to_queue(prepared_events, session, db)
+        n_events += len(events)
+    logger.info(f"Pushed {n_events} events to queue")
 
     source.last_processed = utcnow()
     source.save()
@@ -163,10 +171,11 @@ def delete_calensync_events(destination_wrapper: 'GoogleCalendarWrapper', source
         private_extended_properties=EventExtendedProperty.for_calendar_id(source_calendar_uuid).to_google_dict(),
         start_date=datetime.datetime.now(),
         end_date=datetime.datetime.now() + datetime.timedelta(days=number_of_days_to_sync_in_advance()),
-        showDeleted=False
+        showDeleted=False,
+        fields=COPY_DELETION_FIELDS
     )
     destination_wrapper.events_handler.delete(events)
-    destination_wrapper.delete_events()
+    destination_wrapper.delete_events(batch=True)
 
 
 def handle_delete_sync_rule_event(sync_rule_id: int, boto_session: boto3.Session, db):
@@ -261,11 +270,16 @@ def handle_sqs_event(sqs_event: SQSEvent, db, boto_session: boto3.Session):
         handle_delete_sync_rule_event(e.sync_rule_id, boto_session, db)
 
     elif sqs_event.kind == QueueEvent.UPDATED_EVENT:
-        e: UpdateGoogleEvent = UpdateGoogleEvent.parse_obj(sqs_event.data)
+        e: UpdateGoogleEvent = sqs_event.get_update_event()
 
         # error catching is handled in the lambda handler function
         handle_updated_event(e)
 
+    elif sqs_event.kind == QueueEvent.DAILY_SYNC:
+        from calensync.awslambda.daily_sync import handle_daily_sync_event
+        e: DailySyncEvent = DailySyncEvent.parse_obj(sqs_event.data)
+        handle_daily_sync_event(e, boto_session)
+
     else:
         logger.error("Unknown event type")
 
@@ -283,3 +297,93 @@ def handle_updated_event(e: UpdateGoogleEvent):
         event.status = EventStatus.cancelled
 
     GoogleCalendarWrapper.push_event_to_rule(event, rules[0])
+
+
+def superseded_updated_events(sqs_events: List[SQSEvent]) -> Set[int]:
+    """
+    Returns the indices of the UPDATED_EVENT events superseded by another one of the list, i.e. with the same
+    rule and event id and a later `updated` (or the same, and further in the list). Only the latest state
+    of an event needs to be pushed to the rule, the other ones can be acknowledged without being processed
+    """
+    latest = {}
+    superseded = set()
+    for i, sqs_event in enumerate(sqs_events):
+        if sqs_event.kind != QueueEvent.UPDATED_EVENT:
+            continue
+        try:
+            e: UpdateGoogleEvent = sqs_event.get_update_event()
+        except pydantic.ValidationError:
+            # left to the processing of the event, which reports the error
+            continue
+        key = (e.rule_id, e.event.id)
+        updated = e.event.updated or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        if key in latest:
+            previous, previous_updated = latest[key]
+            if updated < previous_updated:
+                superseded.add(i)
+                continue
+            superseded.add(previous)
+        latest[key] = (i, updated)
+    return superseded
+
+
+def handle_sqs_events(sqs_events: List[SQSEvent], db, boto_session: boto3.Session):
+    """ Same as handle_sqs_event for several events, the updated events are handled together """
+    superseded = superseded_updated_events(sqs_events)
+    if superseded:
+        logger.info(f"Skipping {len(superseded)} superseded updated events")
+    sqs_events = [sqs_event for i, sqs_event in enumerate(sqs_events) if i not in superseded]
+
+    update_events = []
+    for sqs_event in sqs_events:
+        if sqs_event.kind == QueueEvent.UPDATED_EVENT:
+            update_events.append(sqs_event.get_update_event())
+        else:
+            handle_sqs_event(sqs_event, db, boto_session)
+    handle_updated_events(update_events, boto_session)
+
+
+def handle_updated_events(update_events: List[UpdateGoogleEvent], boto_session: boto3.Session = None,
+                          on_error: Callable[[UpdateGoogleEvent, Exception], None] = None):
+    """
+    Same as handle_updated_event for several events. The rules are loaded at once, and the events of a rule
+    share the wrapper of its destination. When a rule has enough events, its destination is listed once
+    into a copy index, instead of being queried for each event.
+    Without on_error the first failure is raised, otherwise it's passed the failed events and the others
+    are still processed
+    """
+    events_by_rule = collections.defaultdict(list)
+    for e in update_events:
+        events_by_rule[e.rule_id].append(e)
+    rules = get_sync_rules_with_calendars(events_by_rule.keys())
+
+    for rule_id, rule_events in events_by_rule.items():
+        rule = rules.get(rule_id)
+        if rule is None:
+            logger.warn(f"No rules found for {len(rule_events)} update events - rule id: {rule_id}")
+            continue
+
+        destination_wrapper = get_calendar_wrapper(rule.destination, session=boto_session)
+        copy_index = None
+        if len(rule_events) >= COPY_INDEX_MIN_EVENTS:
+            try:
+                copy_index = build_rule_copy_index(rule, [e.event for e in rule_events], boto_session,
+                                                   destination_wrapper=destination_wrapper)
+            except Exception as exc:
+                if on_error is None:
+                    raise exc
+                for e in rule_events:
+                    on_error(e, exc)
+                continue
+
+        for e in rule_events:
+            event = e.event
+            if e.delete:
+                event.status = EventStatus.cancelled
+            try:
+                GoogleCalendarWrapper.push_event_to_rule(event, rule, session=boto_session, copy_index=copy_index,
+                                                         destination_wrapper=destination_wrapper)
+            except Exception as exc:
+                if on_error is None:
+                    raise exc
+                on_error(e, exc)
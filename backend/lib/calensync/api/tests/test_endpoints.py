@@ -463,7 +463,10 @@ class TestResyncCalendar:
         rule = SyncRule(source=calendar1_1, destination=calendar1_2).save_new()
         rule2 = SyncRule(source=calendar1_1, destination=calendar1_2_2).save_new()
 
-        with patch("calensync.api.service.handle_sqs_event") as handle_sqs_event:
+        with (
+            patch("calensync.queue_backend.QUEUE_BACKEND", "inline"),
+            patch("calensync.api.service.handle_sqs_event") as handle_sqs_event,
+        ):
             resync_calendar(user, calendar1_1.uuid, boto_session, db)
             assert handle_sqs_event.call_count == 2
             event = PostSyncRuleEvent.parse_obj(handle_sqs_event.call_args_list[0].args[0].data)
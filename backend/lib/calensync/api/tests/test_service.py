@@ -9,11 +9,11 @@ from moto import mock_aws
 
 from calensync.api.common import ApiError
 from calensync.api.service import verify_valid_sync_rule, received_webhook, handle_sqs_event, handle_updated_event, \
-    handle_update_sync_rule_event
+    handle_update_sync_rule_event, superseded_updated_events
 from calensync.database.model import SyncRule
 from calensync.dataclass import SQSEvent, QueueEvent, UpdateGoogleEvent, EventStatus, PostSyncRuleEvent, \
     DeleteSyncRuleEvent, ExtendedProperties, EventExtendedProperty, PatchSyncRuleBody
-from calensync.sqs import SQSEventRun, check_if_should_run_time_or_wait
+from calensync.sqs import SQSEventRun, check_if_should_run_time_or_wait, decode_sqs_event
 from calensync.tests.fixtures import *
 from calensync.utils import utcnow, BackoffException
 
@@ -246,6 +246,29 @@ class TestReceiveUpdateEvent:
             assert {sr.id for sr in argument_sync_rules} == {rule1.id, rule2.id}
 
 
+class TestSupersededUpdatedEvents:
+    @staticmethod
+    def test_latest_update_kept():
+        now = utcnow()
+
+        def updated_event(event_id, rule_id, updated):
+            event = GoogleEvent(id=event_id, status=EventStatus.confirmed, updated=updated)
+            return SQSEvent(kind=QueueEvent.UPDATED_EVENT,
+                            data=UpdateGoogleEvent(event=event, rule_id=rule_id, delete=False).dict())
+
+        sqs_events = [
+            updated_event("1", 1, now),
+            updated_event("1", 1, now + datetime.timedelta(seconds=10)),
+            updated_event("1", 1, now + datetime.timedelta(seconds=5)),
+            updated_event("1", 2, now),
+            updated_event("2", 1, now),
+            updated_event("2", 1, now),
+            SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=1).dict()),
+        ]
+        # on equal updates, the last message wins
+        assert superseded_updated_events(sqs_events) == {0, 2, 4}
+
+
 class TestReceiveCreateRuleEvent:
     @staticmethod
     @mock_aws
@@ -267,10 +290,12 @@ class TestReceiveCreateRuleEvent:
             patch("calensync.api.service.GoogleCalendarWrapper") as GoogleCalendarWrapper,
         ):
 
-            GoogleCalendarWrapper.return_value.get_events.return_value = [
-                GoogleEvent(id="1", status=EventStatus.confirmed, summary="Test1"),
-                GoogleEvent(id="2", status=EventStatus.confirmed, summary="Test2"),
-                GoogleEvent(id="3", status=EventStatus.cancelled, summary="Test3"),
+            GoogleCalendarWrapper.return_value.iter_event_pages.return_value = [
+                [
+                    GoogleEvent(id="1", status=EventStatus.confirmed, summary="Test1"),
+                    GoogleEvent(id="2", status=EventStatus.confirmed, summary="Test2"),
+                ],
+                [GoogleEvent(id="3", status=EventStatus.cancelled, summary="Test3")],
             ]
             handle_sqs_event(sqs_event, db, boto_session)
 
@@ -299,7 +324,7 @@ class TestReceiveCreateRuleEvent:
 
             ids = {"1", "2", "3"}
             for msg in messages:
-                parsed_sqs_event = SQSEvent.parse_raw(msg['Body'])
+                parsed_sqs_event = decode_sqs_event(msg['Body'])
                 assert parsed_sqs_event.kind == QueueEvent.UPDATED_EVENT
                 update_event: UpdateGoogleEvent = UpdateGoogleEvent.parse_obj(parsed_sqs_event.data)
                 assert not update_event.delete
@@ -324,7 +349,7 @@ class TestReceiveCreateRuleEvent:
             patch("calensync.gwrapper.GoogleCalendarWrapper") as GoogleCalendarWrapper,
         ):
 
-            GoogleCalendarWrapper.return_value.get_events.return_value = [
+            GoogleCalendarWrapper.return_value.iter_event_pages.return_value = [[
                 GoogleEvent(id="1", status=EventStatus.confirmed, summary="Summary1",
                             extendedProperties=ExtendedProperties.from_sources("Test1", str(calendar1_1.uuid),
                                                                                str(rule1.uuid))),
@@ -334,7 +359,7 @@ class TestReceiveCreateRuleEvent:
                 GoogleEvent(id="3", status=EventStatus.cancelled, summary="Summary3",
                             extendedProperties=ExtendedProperties.from_sources("Test3", str(calendar1_1.uuid),
                                                                                str(rule1.uuid))),
-            ]
+            ]]
             handle_sqs_event(sqs_event, db, boto_session)
 
             assert SyncRule.get(id=rule1.id).deleted == True
@@ -363,7 +388,7 @@ class TestReceiveCreateRuleEvent:
 
             ids = {"Test1", "Test2", "Test3"}
             for msg in messages:
-                parsed_sqs_event = SQSEvent.parse_raw(msg['Body'])
+                parsed_sqs_event = decode_sqs_event(msg['Body'])
                 assert parsed_sqs_event.kind == QueueEvent.UPDATED_EVENT
                 update_event: UpdateGoogleEvent = UpdateGoogleEvent.parse_obj(parsed_sqs_event.data)
                 assert update_event.delete
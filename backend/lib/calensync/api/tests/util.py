@@ -1,7 +1,7 @@
 import os
 
 from calensync.api.service import handle_sqs_event
-from calensync.dataclass import SQSEvent
+from calensync.sqs import decode_sqs_event
 
 
 def simulate_sqs_receiver(boto_session, queue_url, db):
@@ -27,5 +27,5 @@ def simulate_sqs_receiver(boto_session, queue_url, db):
             ReceiptHandle=response["Messages"][0]['ReceiptHandle']
         )
         for msg in response["Messages"]:
-            parsed_sqs_event = SQSEvent.parse_raw(msg['Body'])
+            parsed_sqs_event = decode_sqs_event(msg['Body'])
             handle_sqs_event(parsed_sqs_event, db, boto_session)
@@ -1,7 +1,9 @@
 import datetime
+import os
+import random
 import time
 import traceback
-from typing import Iterable, List
+from typing import Iterable, List, Tuple, Dict, Set
 
 import boto3
 import google.auth.exceptions
@@ -9,34 +11,64 @@ import peewee
 
 from calensync.api.service import run_initial_sync, delete_calensync_events
 from calensync.api.common import number_of_days_to_sync_in_advance
-from calensync.database.model import User, Calendar, CalendarAccount, SyncRule, EmailDB
+from calensync.database.model import User, Calendar, CalendarAccount, SyncRule, EmailDB, DailySyncRun, \
+    DailySyncStepStatus
+from calensync.dataclass import DailySyncEvent, SQSEvent, QueueEvent
 from calensync.libemail import send_trial_ending_email, send_account_to_be_deleted_email
-from calensync.gwrapper import GoogleCalendarWrapper, service_from_account, handle_refresh_error
+from calensync.gwrapper import GoogleCalendarWrapper, get_account_service, handle_refresh_error
+from calensync.libcalendar import events_to_reconcile
 from calensync.log import get_logger
-from calensync.utils import utcnow, INVALID_GRANT_ERROR
+from calensync.queries.common import get_sync_rules_with_calendars
+from calensync.queue_backend import get_queue_backend
+from calensync.sqs import prepare_event_to_push, push_update_event_to_queue
+from calensync.utils import utcnow, INVALID_GRANT_ERROR, run_async, gather_with_concurrency, run_in_thread
 
 logger = get_logger("daily_sync.main")
 
+# watches are renewed once they expire within this margin. The renewal runs several times a day,
+# so that a failed renewal is retried before the watch expires
+WATCH_RENEWAL_MARGIN = datetime.timedelta(hours=36)
+WATCH_EXPIRATION_MINUTES = 60 * 24 * 14
+# the new expirations are spread over a day, so that calendars registered at the same time
+# (e.g. by a mass re-registration) aren't all renewed in the same run afterwards
+WATCH_EXPIRATION_JITTER_MINUTES = 60 * 24
+WATCH_RENEWAL_CONCURRENCY = int(os.environ.get("WATCH_RENEWAL_CONCURRENCY", 8))
+# the steps of the daily sync, in order, named after their status in DailySyncRun
+DAILY_SYNC_STEPS = ["calendar_sync", "watch_renewal", "trial_emails"]
+DAILY_SYNC_DISPATCH_BATCH = 500
+
 
 def load_calendars(accounts: List[CalendarAccount], start_date: datetime.datetime, end_date: datetime.datetime,
-                   boto_session: boto3.Session) -> list[GoogleCalendarWrapper]:
+                   boto_session: boto3.Session) -> Tuple[List[GoogleCalendarWrapper], Set[int]]:
+    """
+    Lists the events of the active calendars of the accounts. Returns their wrappers, and the ids of the calendars
+    whose listing failed: their events are empty, which doesn't mean the calendars are
+    """
     calendars = []
     for account in accounts:
-        for calendar in account.calendars:
-            if calendar.paused is not None:
-                continue
+        active_calendars = [calendar for calendar in account.calendars if calendar.paused is None]
+        if not active_calendars:
+            continue
 
-            # setting this avoid having to re-fetch it from the database to get the credentials
-            service = service_from_account(account, boto_session)
+        # the calendars of an account share its service, setting it avoids having to re-fetch the account
+        # from the database to get the credentials
+        service = get_account_service(account, boto_session)
+        for calendar in active_calendars:
             calendars.append(GoogleCalendarWrapper(calendar, service=service, session=boto_session))
 
-    for cal in calendars:
-        try:
-            cal.get_events(start_date, end_date)
-        except Exception as e:
-            logger.info(f"Skipping calendar {cal.db_id} due to {e}")
+    async def fetch_events():
+        return await gather_with_concurrency(cal.get_events_async(start_date, end_date) for cal in calendars)
+
+    failed = set()
+    for cal, result in zip(calendars, run_async(fetch_events())):
+        if isinstance(result, Exception):
+            logger.info(f"Skipping calendar {cal.db_id} due to {result}")
+            failed.add(cal.calendar_db.id)
+        elif cal.listing_failed:
+            logger.info(f"Skipping calendar {cal.db_id}, its events couldn't be listed")
+            failed.add(cal.calendar_db.id)
 
-    return calendars
+    return calendars, failed
 
 
 def get_users_query_with_active_sync_rules():
@@ -89,71 +121,230 @@ def hard_sync(db):
 
 def sync_single_user_calendar_by_date(
         user: User, start_date: datetime.datetime, end_date: datetime.datetime, boto_session
-):
+) -> int:
+    """
+    Lists the calendars of the user once, and for each sync rule between them compares the source with the
+    destination (see events_to_reconcile): only the differences are queued. Returns the number of events queued
+    """
     logger.info(f"Syncing {user.uuid}")
-    calendar_wrappers = load_calendars(user.accounts, start_date, end_date, boto_session)
-    for wrapper in calendar_wrappers:
-        wrapper.solve_update_in_calendar(wrapper.events, only_preloaded=True)
+    calendar_wrappers, failed = load_calendars(user.accounts, start_date, end_date, boto_session)
+    wrappers = {wrapper.calendar_db.id: wrapper for wrapper in calendar_wrappers}
+    if not wrappers:
+        return 0
 
+    # pylint: disable=no-member
+    rule_ids = [
+        rule_id for rule_id, in
+        SyncRule.select(SyncRule.id).where(SyncRule.source << list(wrappers.keys()), ~SyncRule.deleted).tuples()
+    ]
+    prepared_events = []
+    for rule in get_sync_rules_with_calendars(rule_ids).values():
+        source, destination = wrappers[rule.source_id], wrappers.get(rule.destination_id)
+        if destination is None:
+            # paused, nothing can be written to it
+            continue
+        if rule.source_id in failed or rule.destination_id in failed:
+            # an unknown calendar would look empty, and all the events would be queued
+            logger.info(f"Skipping rule {rule.uuid}, its calendars couldn't be listed")
+            continue
+        events = events_to_reconcile(rule, source.events, destination.events)
+        logger.info(f"Found {len(events)} events to reconcile for rule {rule.uuid}")
+        prepared_events.extend(prepare_event_to_push(event, rule.id, False) for event in events)
 
-def sync_user_calendars_by_date(db, boto_session):
-    users_query = get_users_query_with_active_sync_rules()
-    start: datetime.datetime = datetime.datetime.today()
-    start_date = datetime.datetime.fromtimestamp(start.timestamp())
-    start_date = start_date.replace(hour=0, minute=0, second=0)
+    if prepared_events:
+        push_update_event_to_queue(prepared_events, boto_session, calendar_wrappers[0].db)
+    return len(prepared_events)
+
+
+def get_daily_sync_dates(day: datetime.date = None) -> Tuple[datetime.datetime, datetime.datetime]:
+    start_date = datetime.datetime.combine(day or datetime.date.today(), datetime.time())
     end_date = start_date + datetime.timedelta(days=14)
 
     # because the dates are exclusive in the Google API, this will fetch from 00:00:00 of day, to 23:59:59
     start_date = start_date - datetime.timedelta(seconds=1)
     logger.info(f"Start/end date: {start_date.isoformat()} -> {end_date.isoformat()}")
-    for user in users_query:
-        try:
-            sync_single_user_calendar_by_date(user, start_date, end_date, boto_session)
-        except Exception as e:
-            logger.error(f"Error occurred while updating calendar {user.uuid}: {e}\n\n{traceback.format_exc()}")
-            time.sleep(1)
+    return start_date, end_date
+
 
+def get_user_ids_with_active_sync_rules(after_id: int = 0, limit: int = None) -> List[int]:
+    """ Ids of the users with active sync rules, in increasing order, greater than after_id """
+    # pylint: disable=no-member
+    query = (
+        User.select(User.id).distinct()
+        .join(CalendarAccount)
+        .join(Calendar)
+        .join(SyncRule, on=(SyncRule.source == Calendar.id))
+        .where(User.id > after_id)
+        .order_by(User.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return [user_id for user_id, in query.tuples()]
+
+
+def dispatch_daily_sync(db, boto_session: boto3.Session, run: DailySyncRun = None) -> int:
+    """
+    Queues a DAILY_SYNC event per user with active sync rules, so that the users are synced by the SQS
+    receiver, concurrently and each one within its own time limit. A failed sync is retried by the queue
+    without holding back the other users. The users are queued by batches of DAILY_SYNC_DISPATCH_BATCH:
+    with a run, its cursor is saved after each batch, and the users queued before an interruption aren't
+    queued again. Returns the number of users queued
+    """
+    start_date, end_date = get_daily_sync_dates(run.day if run is not None else None)
+    after_id = run.cursor if run is not None else 0
+    queued = 0
+    while user_ids := get_user_ids_with_active_sync_rules(after_id, DAILY_SYNC_DISPATCH_BATCH):
+        sqs_events = [
+            SQSEvent(kind=QueueEvent.DAILY_SYNC,
+                     data=DailySyncEvent(user_id=user_id, start_date=start_date, end_date=end_date).dict())
+            for user_id in user_ids
+        ]
+        get_queue_backend().send(sqs_events, boto_session, db, delay=0)
+        queued += len(user_ids)
+        after_id = user_ids[-1]
+        if run is not None:
+            run.cursor = after_id
+            run.users_queued += len(user_ids)
+            run.save()
+        logger.info(f"Queued the daily sync of {queued} users")
+    return queued
+
+
+def get_daily_sync_run(day: datetime.date = None) -> DailySyncRun:
+    run, created = DailySyncRun.get_or_create(day=day or datetime.date.today())
+    if not created:
+        logger.info(f"Resuming daily sync of {run.day}: {get_daily_sync_progress(run)}")
+    return run
+
+
+def get_daily_sync_progress(run: DailySyncRun) -> Dict:
+    return {
+        "day": run.day.isoformat(),
+        "users_queued": run.users_queued,
+        "cursor": run.cursor,
+        "steps": {step: getattr(run, step).name for step in DAILY_SYNC_STEPS},
+        "finished": run.finished.isoformat() if run.finished is not None else None,
+    }
+
+
+def run_daily_sync(db, boto_session: boto3.Session, day: datetime.date = None) -> Dict:
+    """
+    Runs the steps of the daily sync which aren't done yet: a failed or interrupted step is run again
+    by the next invocation of the same day, the done ones are skipped. Returns the progress of the run
+    """
+    run = get_daily_sync_run(day)
+    steps = {
+        "calendar_sync": lambda: dispatch_daily_sync(db, boto_session, run),
+        "watch_renewal": lambda: update_watches(db),
+        "trial_emails": lambda: send_trial_finishing_email(boto_session, db),
+    }
+    for step in DAILY_SYNC_STEPS:
+        if getattr(run, step) == DailySyncStepStatus.DONE:
+            logger.info(f"Skipping step {step}, already done")
+            continue
 
-def update_watches(db: peewee.Database):
+        setattr(run, step, DailySyncStepStatus.RUNNING)
+        run.save()
+        try:
+            logger.info(f"Starting step {step}")
+            steps[step]()
+            setattr(run, step, DailySyncStepStatus.DONE)
+        except Exception as e:
+            logger.error(f"Step {step} of the daily sync failed: {e}\n\n{traceback.format_exc()}")
+            setattr(run, step, DailySyncStepStatus.FAILED)
+        run.save()
+
+    if all(getattr(run, step) == DailySyncStepStatus.DONE for step in DAILY_SYNC_STEPS):
+        run.finished = utcnow()
+        run.save()
+    progress = get_daily_sync_progress(run)
+    logger.info(f"Daily sync progress: {progress}")
+    return progress
+
+
+def handle_daily_sync_event(e: DailySyncEvent, boto_session: boto3.Session):
+    """ Daily sync of a single user, queued by dispatch_daily_sync. Errors are left to the queue to retry """
+    users = peewee.prefetch(
+        User.select().where(User.id == e.user_id),
+        CalendarAccount.select(),
+        Calendar.select()
+    )
+    if len(users) == 0:
+        logger.warning(f"User {e.user_id} not found, skipping daily sync")
+        return
+    sync_single_user_calendar_by_date(users[0], e.start_date, e.end_date, boto_session)
+
+
+def get_calendars_to_renew(reregister_all: bool = False) -> Iterable[Calendar]:
+    """
+    Returns the source calendars whose watch expires within WATCH_RENEWAL_MARGIN, each one once
+    whatever its number of sync rules. With reregister_all, all the watched calendars are returned,
+    e.g. to register the watches again after WATCH_URL changed
+    """
     # pylint: disable=no-member
-    now = utcnow()
-    calendars_db: Iterable[Calendar] = peewee.prefetch(
+    conditions = [
+        Calendar.expiration.is_null(False),
+        (Calendar.paused_reason.is_null(True) | (Calendar.paused_reason != INVALID_GRANT_ERROR))
+    ]
+    if not reregister_all:
+        conditions.append(Calendar.expiration <= utcnow() + WATCH_RENEWAL_MARGIN)
+
+    return peewee.prefetch(
         Calendar.select()
         .join(SyncRule, on=(Calendar.id == SyncRule.source))
-        .where(
-            Calendar.expiration.is_null(False),
-            Calendar.expiration <= now + datetime.timedelta(hours=36),
-            (Calendar.paused_reason.is_null(True) | (Calendar.paused_reason != INVALID_GRANT_ERROR))
-        ),
+        .where(*conditions)
+        .distinct(),
         CalendarAccount.select(),
         User.select()
     )
 
-    for calendar_db in calendars_db:
-        iteration = 0
-        deleted = False
-        while iteration < 3:
-            try:
-                logger.info(f"Updating watch of calendar {calendar_db.uuid}")
-                gcalendar = GoogleCalendarWrapper(calendar_db)
 
-                try:
-                    if not deleted:
-                        deleted = True
-                        gcalendar.delete_watch()
-                        logger.info("Watch deleted")
-
-                    gcalendar.create_watch()
-                    break
-                except google.auth.exceptions.RefreshError as e:
-                    handle_refresh_error(calendar_db, e)
-                    break
-            except Exception as e:
-                logger.error(
-                    f"Error occured while updating calendar {calendar_db.uuid}: {e}\n\n{traceback.format_exc()}")
-                time.sleep(1)
-            finally:
-                iteration += 1
+def update_watches(db: peewee.Database, reregister_all: bool = False) -> int:
+    """ Renews the watches of get_calendars_to_renew, returns their number """
+    calendars_db = get_calendars_to_renew(reregister_all)
+    logger.info(f"Renewing {len(calendars_db)} watches")
+
+    async def renew_all():
+        return await gather_with_concurrency(
+            (run_in_thread(db, renew_watch, calendar_db, jittered_watch_expiration())
+             for calendar_db in calendars_db),
+            limit=WATCH_RENEWAL_CONCURRENCY
+        )
+
+    run_async(renew_all(), max_workers=WATCH_RENEWAL_CONCURRENCY)
+    return len(calendars_db)
+
+
+def jittered_watch_expiration() -> int:
+    """ Expiration in minutes of a renewed watch """
+    return WATCH_EXPIRATION_MINUTES - random.randint(0, WATCH_EXPIRATION_JITTER_MINUTES)
+
+
+def renew_watch(calendar_db: Calendar, expiration_minutes: int = WATCH_EXPIRATION_MINUTES):
+    iteration = 0
+    deleted = False
+    while iteration < 3:
+        try:
+            logger.info(f"Updating watch of calendar {calendar_db.uuid}")
+            gcalendar = GoogleCalendarWrapper(calendar_db)
+
+            try:
+                if not deleted:
+                    deleted = True
+                    gcalendar.delete_watch()
+                    logger.info("Watch deleted")
+
+                gcalendar.create_watch(expiration_minutes)
+                break
+            except google.auth.exceptions.RefreshError as e:
+                handle_refresh_error(calendar_db, e)
+                break
+        except Exception as e:
+            logger.error(
+                f"Error occured while updating calendar {calendar_db.uuid}: {e}\n\n{traceback.format_exc()}")
+            time.sleep(1)
+        finally:
+            iteration += 1
 
 
 def get_trial_users_with_create_before_date(start: datetime.datetime):
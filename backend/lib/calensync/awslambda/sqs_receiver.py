@@ -0,0 +1,278 @@
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import os
+import random
+import threading
+import traceback
+from typing import List, Dict, Optional, Tuple, Set
+
+import boto3
+
+from calensync.api.service import handle_sqs_event, superseded_updated_events, handle_updated_events
+from calensync.database.model import SyncRule
+from calensync.dataclass import SQSEvent, QueueEvent, UpdateGoogleEvent
+from calensync.libcalendar import PushToQueueException
+from calensync.log import get_logger
+from calensync.sqs import decode_sqs_event
+from calensync.utils import utcnow, BackoffException, non_blocking_backoff
+
+logger = get_logger("sqs_receiver")
+
+# well below the 12 hours maximum of the SQS visibility timeout
+MAX_BACKOFF_DELAY = 15 * 60
+# number of records of a batch processed at the same time, 1 processes them one after the other
+SQS_RECEIVER_WORKERS = int(os.environ.get("SQS_RECEIVER_WORKERS", 1))
+
+_executors: Dict[int, concurrent.futures.ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def parse_record(record: Dict) -> SQSEvent:
+    sqs_event = decode_sqs_event(record["body"])
+    first_received_timestamp = record.get("attributes", {}).get("ApproximateFirstReceiveTimestamp", "nan")
+    try:
+        first_received_timestamp = int(first_received_timestamp) / 1000
+    except ValueError:
+        logger.warning(f"Can't parse {first_received_timestamp} as int")
+        first_received_timestamp = utcnow().timestamp()
+    sqs_event.first_received = datetime.datetime.utcfromtimestamp(first_received_timestamp).replace(
+        tzinfo=datetime.timezone.utc)
+    return sqs_event
+
+
+def get_receive_count(record: Dict) -> int:
+    try:
+        return int(record.get("attributes", {}).get("ApproximateReceiveCount", 1))
+    except ValueError:
+        return 1
+
+
+def backoff_delay(delay: int, receive_count: int) -> int:
+    """ Delay before the next attempt: exponential in the number of receptions of the message, with jitter """
+    exponential = delay * 2 ** max(0, receive_count - 1)
+    return int(min(MAX_BACKOFF_DELAY, exponential + random.uniform(0, delay)))
+
+
+def queue_url_from_record(record: Dict) -> Optional[str]:
+    if (queue_url := os.environ.get("SQS_QUEUE_URL")) is not None:
+        return queue_url
+    arn = record.get("eventSourceARN")
+    if arn is None:
+        return None
+    # arn:aws:sqs:<region>:<account id>:<queue name>
+    _, _, _, region, account_id, queue_name = arn.split(":")
+    return f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}"
+
+
+def reschedule_record(sqs_client, record: Dict, delay: int) -> bool:
+    """
+    Makes the message visible again only after `delay` seconds. The record must also be reported as
+    a batch item failure, so that it's not deleted
+    """
+    queue_url = queue_url_from_record(record)
+    if queue_url is None:
+        logger.warning(f"Can't find queue of message {record['messageId']}, using the default visibility timeout")
+        return False
+    try:
+        sqs_client.change_message_visibility(
+            QueueUrl=queue_url, ReceiptHandle=record["receiptHandle"], VisibilityTimeout=delay
+        )
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to reschedule message {record['messageId']}: {e}")
+        return False
+
+
+def get_ordering_keys(sqs_events: Dict[str, SQSEvent]) -> Dict[str, Tuple]:
+    """
+    Returns the ordering key of each message. The messages with the same key are processed one after the
+    other: the ones writing to the same destination calendar, so that copies aren't created concurrently,
+    and the notifications of the same channel
+    """
+    rule_ids = {}
+    for message_id, sqs_event in sqs_events.items():
+        if sqs_event.kind == QueueEvent.UPDATED_EVENT:
+            rule_ids[message_id] = sqs_event.data.get("rule_id")
+        elif sqs_event.kind in (QueueEvent.POST_SYNC_RULE, QueueEvent.DELETE_SYNC_RULE):
+            rule_ids[message_id] = sqs_event.data.get("sync_rule_id")
+
+    destinations = {}
+    if rule_ids:
+        query = SyncRule.select(SyncRule.id, SyncRule.destination).where(SyncRule.id << list(set(rule_ids.values())))
+        destinations = {rule_id: destination_id for rule_id, destination_id in query.tuples()}
+
+    keys = {}
+    for message_id, sqs_event in sqs_events.items():
+        if message_id in rule_ids:
+            rule_id = rule_ids[message_id]
+            keys[message_id] = ("destination", destinations[rule_id]) if rule_id in destinations else ("rule", rule_id)
+        elif sqs_event.kind == QueueEvent.GOOGLE_WEBHOOK:
+            keys[message_id] = ("channel", sqs_event.data.get("channel_id"))
+        else:
+            keys[message_id] = ("message", message_id)
+    return keys
+
+
+def thread_boto_session(boto_session: boto3.Session) -> boto3.Session:
+    """
+    boto3 sessions aren't thread safe, each worker gets its own one with the same credentials.
+    Without credentials, the worker's session only keeps the region and resolves them itself
+    """
+    credentials = boto_session.get_credentials()
+    if credentials is None:
+        return boto3.Session(region_name=boto_session.region_name)
+    credentials = credentials.get_frozen_credentials()
+    return boto3.Session(aws_access_key_id=credentials.access_key, aws_secret_access_key=credentials.secret_key,
+                         aws_session_token=credentials.token, region_name=boto_session.region_name)
+
+
+def get_executor(workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Executor of the records, kept for the lifetime of the lambda: its worker threads, and the pools
+    they hold (services, calendar wrappers), are reused by the next invocations
+    """
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="sqs-receiver")
+        return _executors[workers]
+
+
+def handle_sqs_records(records: List[Dict], db, boto_session: boto3.Session, workers: int = None,
+                       sqs_client=None) -> Dict:
+    """
+    Handles the records of an SQS batch, returns the batch response with the records to retry.
+    Nothing sleeps in here: rate limited records are rescheduled through their visibility timeout,
+    so that a throttled calendar doesn't hold back the other records of the batch.
+    With several workers, the records are processed concurrently, except the ones with the same
+    ordering key (see get_ordering_keys) which are processed in order by the same worker.
+    `sqs_client` reschedules the records, by default a client of the session
+    """
+    workers = workers or SQS_RECEIVER_WORKERS
+    failed = set()
+    sqs_events = {}
+    for record in records:
+        try:
+            sqs_events[record['messageId']] = parse_record(record)
+        except Exception as e:
+            logger.error(f"Failed to parse record {e}\n{traceback.format_exc()}")
+            failed.add(record['messageId'])
+
+    # the same event is often updated several times in a row, only its latest update is processed
+    # and the other messages are acknowledged
+    message_ids = list(sqs_events.keys())
+    superseded = {message_ids[i] for i in superseded_updated_events(list(sqs_events.values()))}
+    if superseded:
+        logger.info(f"Acknowledging {len(superseded)} superseded updated events")
+    sqs_events = {message_id: e for message_id, e in sqs_events.items() if message_id not in superseded}
+
+    sqs_client_lock = threading.Lock()
+    sqs_clients = [sqs_client] if sqs_client is not None else []
+
+    def get_sqs_client():
+        with sqs_client_lock:
+            if not sqs_clients:
+                sqs_clients.append(boto_session.client("sqs"))
+            return sqs_clients[0]
+
+    def process_records(group: List[Dict], session: boto3.Session):
+        # the consecutive updated events are processed together, grouped by rule
+        runs = itertools.groupby(group, key=lambda r: sqs_events[r['messageId']].kind == QueueEvent.UPDATED_EVENT)
+        for is_updated_event, run in runs:
+            run = list(run)
+            if is_updated_event:
+                failed.update(process_updated_event_records(run, sqs_events, session, get_sqs_client))
+                continue
+            for record in run:
+                if not process_record(record, sqs_events[record['messageId']], db, session, get_sqs_client):
+                    failed.add(record['messageId'])
+
+    records_to_process = [record for record in records if record['messageId'] in sqs_events]
+    if workers <= 1:
+        process_records(records_to_process, boto_session)
+    else:
+        keys = get_ordering_keys(sqs_events)
+        groups = collections.defaultdict(list)
+        for record in records_to_process:
+            groups[keys[record['messageId']]].append(record)
+        sessions = [thread_boto_session(boto_session) for _ in groups]
+
+        def process_group(group: List[Dict], session: boto3.Session):
+            try:
+                # peewee connections are per thread
+                with db.connection_context():
+                    process_records(group, session)
+            except Exception as e:
+                logger.error(f"Failed to process records {e}\n{traceback.format_exc()}")
+                failed.update(record['messageId'] for record in group)
+
+        executor = get_executor(workers)
+        for future in [executor.submit(process_group, group, session)
+                       for group, session in zip(groups.values(), sessions)]:
+            future.result()
+
+    batch_item_failures = [{"itemIdentifier": record['messageId']} for record in records
+                           if record['messageId'] in failed]
+    sqs_batch_response = {"batchItemFailures": batch_item_failures}
+    if len(batch_item_failures) > 0:
+        logger.warning(f"Returning SQS Batch response: {sqs_batch_response}")
+    return sqs_batch_response
+
+
+def handle_record_error(record: Dict, e: Exception, get_sqs_client):
+    if isinstance(e, BackoffException):
+        delay = backoff_delay(e.delay, get_receive_count(record))
+        logger.warning(f"BackoffException, retrying message {record['messageId']} in {delay} seconds")
+        reschedule_record(get_sqs_client(), record, delay)
+    elif isinstance(e, PushToQueueException):
+        logger.warning(f"{e.__class__.__name__}")
+    else:
+        logger.error(f"Failed to process record {e}\n{traceback.format_exc()}")
+
+
+def process_record(record: Dict, sqs_event: SQSEvent, db, boto_session: boto3.Session, get_sqs_client) -> bool:
+    """ Processes a single record, returns whether it succeeded """
+    try:
+        with non_blocking_backoff():
+            handle_sqs_event(sqs_event, db, boto_session)
+        return True
+    except Exception as e:
+        handle_record_error(record, e, get_sqs_client)
+        return False
+
+
+def process_updated_event_records(records: List[Dict], sqs_events: Dict[str, SQSEvent], boto_session: boto3.Session,
+                                  get_sqs_client) -> Set[str]:
+    """
+    Processes UPDATED_EVENT records together: their rules are loaded at once, and the events of a rule share
+    the destination wrapper and copy index (see handle_updated_events). Returns the ids of the failed records
+    """
+    failed = set()
+    update_events = []
+    records_by_event = {}
+    for record in records:
+        try:
+            e = sqs_events[record['messageId']].get_update_event()
+        except Exception as exc:
+            handle_record_error(record, exc, get_sqs_client)
+            failed.add(record['messageId'])
+            continue
+        update_events.append(e)
+        records_by_event[id(e)] = record
+
+    def on_error(e: UpdateGoogleEvent, exc: Exception):
+        record = records_by_event[id(e)]
+        handle_record_error(record, exc, get_sqs_client)
+        failed.add(record['messageId'])
+
+    try:
+        with non_blocking_backoff():
+            handle_updated_events(update_events, boto_session, on_error=on_error)
+    except Exception as exc:
+        # e.g. the rules couldn't be loaded, none of the records was processed
+        for record in records_by_event.values():
+            if record['messageId'] not in failed:
+                handle_record_error(record, exc, get_sqs_client)
+                failed.add(record['messageId'])
+    return failed
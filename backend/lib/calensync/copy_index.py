@@ -0,0 +1,72 @@
+import datetime
+from typing import Dict, List, Optional, Set, Iterable
+
+from calensync.dataclass import GoogleEvent
+from calensync.log import get_logger
+from calensync.utils import replace_timezone_if_naive
+
+logger = get_logger(__file__)
+
+
+class DestinationCopyIndex:
+    """
+    Copies of the events of a source calendar in a destination calendar, indexed by source id.
+
+    It's built from a single listing of the destination between start_date and end_date, and replaces the
+    per-event lookups by source id. For a new source event starting within that window, a missing copy is
+    authoritative. Otherwise the index can't tell and the destination must be queried: the copy of a
+    modified event is where the event was before, possibly outside of the window.
+    The index must be kept up to date with the writes made in the destination, see GoogleCalendarWrapper.copy_index
+    """
+
+    def __init__(self, copies: Iterable[GoogleEvent], start_date: datetime.datetime, end_date: datetime.datetime):
+        self.start_date = replace_timezone_if_naive(start_date)
+        self.end_date = replace_timezone_if_naive(end_date)
+        self._copies: Dict[str, Dict[str, GoogleEvent]] = {}
+        self._source_ids: Dict[str, str] = {}
+        self._invalidated: Set[str] = set()
+        for copy in copies:
+            self.add(copy)
+
+    def __len__(self):
+        return len(self._source_ids)
+
+    def covers(self, event: GoogleEvent) -> bool:
+        if event.start is None:
+            return False
+        start = replace_timezone_if_naive(event.start.to_datetime())
+        return self.start_date <= start <= self.end_date
+
+    def find(self, source_id: str, event: GoogleEvent = None) -> Optional[List[GoogleEvent]]:
+        """
+        Returns the copies of the source event, or None if the index can't tell. `event` is the source event,
+        it's used to know whether a missing copy is authoritative
+        """
+        if source_id in self._invalidated:
+            return None
+        copies = self._copies.get(source_id)
+        if copies:
+            # the callers are free to modify what they get
+            return [copy.copy() for copy in copies.values()]
+        if event is not None and event.is_new and self.covers(event):
+            return []
+        return None
+
+    def add(self, copy: GoogleEvent):
+        source_id = copy.source_id
+        if source_id is None:
+            logger.warning(f"Can't index event {copy.id} without source id")
+            return
+        self.remove(copy.id)
+        self._copies.setdefault(source_id, {})[copy.id] = copy
+        self._source_ids[copy.id] = source_id
+        self._invalidated.discard(source_id)
+
+    def remove(self, copy_id: str):
+        source_id = self._source_ids.pop(copy_id, None)
+        if source_id is not None:
+            self._copies[source_id].pop(copy_id, None)
+
+    def invalidate(self, source_id: str):
+        """ The copies of the source event are unknown, they will be looked up in the destination """
+        self._invalidated.add(source_id)
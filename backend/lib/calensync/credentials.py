@@ -0,0 +1,66 @@
+import collections
+import dataclasses
+import threading
+import time
+from typing import Optional
+
+import boto3
+import google.oauth2.credentials
+
+from calensync.database.model import CalendarAccount
+from calensync.log import get_logger
+from calensync.secure import decrypt_credentials
+
+logger = get_logger(__file__)
+
+CREDENTIALS_CACHE_TTL = 30 * 60
+CREDENTIALS_CACHE_SIZE = 256
+
+
+@dataclasses.dataclass
+class _CachedCredentials:
+    credentials: google.oauth2.credentials.Credentials
+    account_uuid: str
+    encrypted_credentials: str
+    loaded_at: float
+
+
+_credentials_cache: collections.OrderedDict = collections.OrderedDict()
+_credentials_lock = threading.Lock()
+
+
+def get_credentials(account: CalendarAccount, boto_session: boto3.Session) -> google.oauth2.credentials.Credentials:
+    """
+    Returns the google credentials of the account. The credentials are kept in memory, so that the
+    decryption is skipped and the access token refreshed by google-auth is reused until it expires.
+    The entry is dropped when it's older than the TTL or when the encrypted credentials of the account changed
+    """
+    now = time.monotonic()
+    with _credentials_lock:
+        cached: Optional[_CachedCredentials] = _credentials_cache.get(account.id)
+        if cached is not None:
+            if (cached.encrypted_credentials == account.encrypted_credentials
+                    and cached.account_uuid == str(account.uuid)
+                    and now - cached.loaded_at < CREDENTIALS_CACHE_TTL):
+                _credentials_cache.move_to_end(account.id)
+                return cached.credentials
+            del _credentials_cache[account.id]
+
+    credentials_dict = decrypt_credentials(account.encrypted_credentials, boto_session)
+    credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(credentials_dict)
+
+    with _credentials_lock:
+        _credentials_cache[account.id] = _CachedCredentials(
+            credentials, str(account.uuid), account.encrypted_credentials, now
+        )
+        _credentials_cache.move_to_end(account.id)
+        while len(_credentials_cache) > CREDENTIALS_CACHE_SIZE:
+            _credentials_cache.popitem(last=False)
+    return credentials
+
+
+def invalidate_credentials(account_id: int):
+    """ Drops the cached credentials of the account, to be called whenever its credentials change or are revoked """
+    with _credentials_lock:
+        if _credentials_cache.pop(account_id, None) is not None:
+            logger.info(f"Invalidated cached credentials of account {account_id}")
@@ -22,6 +22,13 @@ class OAuthKind(enum.IntEnum):
     ADD_GOOGLE_ACCOUNT = 2
 
 
+class DailySyncStepStatus(enum.IntEnum):
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+
 class EnumField(IntegerField, ABC):
     """
     This class enable an Enum like field for Peewee
@@ -137,6 +144,8 @@ class Calendar(UUIDBaseModel):
     last_received = DateTimeField(default=utcnow)
     last_processed = DateTimeField(default=utcnow)
     last_resync = DateTimeField(default=utcnow)
+    # Google nextSyncToken of the last incremental listing, used to only fetch the changes on each webhook
+    sync_token = peewee.TextField(null=True, default=None)
     paused = DateTimeField(null=True, default=None)
     paused_reason = CharField(null=True, default=None)
     readonly = peewee.BooleanField(default=False)
@@ -211,4 +220,18 @@ class MagicLinkDB(UUIDBaseModel):
     used = IntegerField(default=0)
 
 
-MODELS = [MagicLinkDB, Session, OAuthState, EmailDB, SyncRule, Calendar, CalendarAccount, User]
+class DailySyncRun(BaseModel):
+    """
+    Progress of the daily sync of a day, so that an interrupted run resumes where it stopped. `cursor` is
+    the id of the last user whose sync was queued, and each step has its own status
+    """
+    day = peewee.DateField(unique=True)
+    cursor = IntegerField(default=0)
+    users_queued = IntegerField(default=0)
+    calendar_sync = EnumField(enum_type=DailySyncStepStatus, default=DailySyncStepStatus.PENDING)
+    watch_renewal = EnumField(enum_type=DailySyncStepStatus, default=DailySyncStepStatus.PENDING)
+    trial_emails = EnumField(enum_type=DailySyncStepStatus, default=DailySyncStepStatus.PENDING)
+    finished = DateTimeField(null=True, default=None)
+
+
+MODELS = [DailySyncRun, MagicLinkDB, Session, OAuthState, EmailDB, SyncRule, Calendar, CalendarAccount, User]
@@ -6,7 +6,7 @@ from enum import Enum, IntEnum
 from typing import Dict, List, Optional, Union
 
 import pydantic
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 from calensync.log import get_logger
 from calensync.utils import datetime_to_google_time
@@ -165,7 +165,8 @@ class GoogleEvent(BaseModel):
     @staticmethod
     def parse_event_list_response(response: Dict) -> List[GoogleEvent]:
         events = []
-        for item in response["items"]:
+        # with a partial response mask, "items" is omitted when there are none
+        for item in response.get("items", []):
             try:
                 events.append(GoogleEvent.parse_obj(item))
             except pydantic.ValidationError:
@@ -173,6 +174,17 @@ class GoogleEvent(BaseModel):
                 logger.error(f"Couldn't parse item with id {item.get('id')}: {traceback.format_exc()}")
         return events
 
+    @property
+    def is_new(self) -> bool:
+        """ Whether the event was never modified since its creation """
+        # for some reason the created and updated time are not exactly the same, even when the event is new
+        # it looks like google doesn't use a transaction. Bad google. So 1 second threshold for equality
+        return (
+                self.created is not None
+                and self.updated is not None
+                and abs((self.updated - self.created).total_seconds()) < 1
+        )
+
     @property
     def source_id(self) -> Optional[str]:
         if self.extendedProperties:
@@ -199,6 +211,7 @@ class QueueEvent(IntEnum):
     POST_SYNC_RULE = 3
     DELETE_SYNC_RULE = 4
     UPDATED_EVENT = 5
+    DAILY_SYNC = 6
 
 
 class GoogleWebhookEvent(BaseModel):
@@ -227,6 +240,12 @@ class DeleteSyncRuleEvent(BaseModel):
     sync_rule_id: int
 
 
+class DailySyncEvent(BaseModel):
+    user_id: int
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+
+
 class UpdateGoogleEvent(BaseModel):
     event: GoogleEvent
     rule_id: int
@@ -240,6 +259,25 @@ class SQSEvent(BaseModel):
     kind: QueueEvent
     data: Dict
     first_received: Optional[datetime.datetime] = Field(None)
+    _update_event: Optional[UpdateGoogleEvent] = PrivateAttr(None)
+
+    @classmethod
+    def from_update_event(cls, update_event: UpdateGoogleEvent, data: Dict = None,
+                          first_received: datetime.datetime = None) -> "SQSEvent":
+        """
+        UPDATED_EVENT of `update_event`, which get_update_event returns without parsing the data again.
+        `data` is its serialized form, by default update_event.dict()
+        """
+        sqs_event = cls(kind=QueueEvent.UPDATED_EVENT, data=data if data is not None else update_event.dict(),
+                        first_received=first_received)
+        sqs_event._update_event = update_event
+        return sqs_event
+
+    def get_update_event(self) -> UpdateGoogleEvent:
+        """ Data of an UPDATED_EVENT, parsed only once """
+        if self._update_event is None:
+            self._update_event = UpdateGoogleEvent.parse_obj(self.data)
+        return self._update_event
 
 
 class PatchCalendarBody(BaseModel):
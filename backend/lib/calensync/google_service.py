@@ -0,0 +1,68 @@
+import collections
+import functools
+import json
+import threading
+from typing import Dict
+
+import httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+from calensync.log import get_logger
+
+logger = get_logger(__file__)
+
+
+@functools.lru_cache(maxsize=None)
+def get_discovery_document(service_name: str, version: str) -> Dict:
+    """
+    Returns the parsed discovery document bundled with googleapiclient. Parsing it is the
+    costly part of googleapiclient.discovery.build, so it's only done once per process
+    """
+    content = discovery_cache.get_static_doc(service_name, version)
+    if content is None:
+        raise RuntimeError(f"No bundled discovery document for {service_name} {version}")
+    logger.info(f"Loaded discovery document {service_name} {version}")
+    return json.loads(content)
+
+
+def build_service(service_name: str, version: str, **kwargs):
+    """ Same as googleapiclient.discovery.build, but from the cached discovery document """
+    return build_from_document(get_discovery_document(service_name, version), **kwargs)
+
+
+def build_calendar_service(**kwargs):
+    return build_service('calendar', 'v3', **kwargs)
+
+
+def build_oauth2_service(**kwargs):
+    return build_service('oauth2', 'v2', **kwargs)
+
+
+MAX_POOLED_TRANSPORTS = 64
+
+_transports = threading.local()
+
+
+def get_http_transport(key: str) -> httplib2.Http:
+    """
+    Returns the pooled httplib2.Http of the given key (usually the account) for the current thread.
+    httplib2 keeps the TLS connection to googleapis.com open between the requests of the same Http object,
+    so reusing it avoids a new handshake per request, also across warm lambda invocations.
+    Http objects are not thread safe, so each thread has its own pool.
+    """
+    pool = getattr(_transports, "pool", None)
+    if pool is None:
+        pool = _transports.pool = collections.OrderedDict()
+
+    http = pool.get(key)
+    if http is not None:
+        pool.move_to_end(key)
+        return http
+
+    http = httplib2.Http()
+    pool[key] = http
+    if len(pool) > MAX_POOLED_TRANSPORTS:
+        _, evicted = pool.popitem(last=False)
+        evicted.close()
+    return http
@@ -1,3 +1,8 @@
+import base64
+import hashlib
+import os
+
+
 def get_recurrent_event_id(original_event_id: str, fetched_recurrent_instance_id: str):
     """
     Given an source event part of a recurrence, and the fetched source recurrence, creates
@@ -24,3 +29,21 @@ def get_recurrent_event_id(original_event_id: str, fetched_recurrent_instance_id
         final_id = f'{fetched_recurrent_instance_id}_{original_event_id.split("_")[1]}'
 
     return final_id
+
+
+def use_deterministic_copy_ids() -> bool:
+    return os.environ.get("DETERMINISTIC_COPY_IDS", "").lower() in ("1", "true")
+
+
+# base64.b32hexencode only exists from python 3.10, the lambdas run 3.9
+_BASE32_TO_BASE32HEX = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", "0123456789abcdefghijklmnopqrstuv")
+
+
+def copy_event_id(rule_uuid: str, source_event_id: str) -> str:
+    """
+    Id of the copy of a source event made by a sync rule. It only depends on the rule and the source event,
+    so the copy can be addressed without being looked up. Google event ids must use the base32hex alphabet
+    (lowercase letters a-v and digits), and contain between 5 and 1024 characters
+    """
+    digest = hashlib.sha256(f"{rule_uuid}:{source_event_id}".encode()).digest()
+    return base64.b32encode(digest).decode().rstrip("=").translate(_BASE32_TO_BASE32HEX)
@@ -1,63 +1,125 @@
 from __future__ import annotations
 
+import collections
+import dataclasses
 import datetime
+import itertools
 import json
+import logging
 import os
+import threading
 import traceback
 from copy import copy
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 
 import boto3
 import google.auth
 import google.auth.exceptions
-import google.oauth2.credentials
 import google_auth_httplib2
 import googleapiclient
-import googleapiclient.http
-import httplib2
 import peewee
-from googleapiclient.discovery import build
+import pydantic
 from googleapiclient.errors import HttpError
 
 from calensync.api.common import ApiError, number_of_days_to_sync_in_advance
+from calensync.copy_index import DestinationCopyIndex
+from calensync.credentials import get_credentials, invalidate_credentials
 from calensync.database.model import Calendar, CalendarAccount, User, SyncRule
 from calensync.dataclass import GoogleDatetime, EventExtendedProperty, GoogleCalendar, GoogleEvent, EventStatus, \
     ExtendedProperties, GoogleDate
-from calensync.google_utils import get_recurrent_event_id
+from calensync.google_service import build_calendar_service, build_oauth2_service, get_http_transport
+from calensync.google_utils import get_recurrent_event_id, copy_event_id, use_deterministic_copy_ids
 
-from calensync.libcalendar import EventsModificationHandler, PushToQueueException, set_declined_event_if_necessary
+from calensync.libcalendar import EventsModificationHandler, PushToQueueException, set_declined_event_if_necessary, \
+    recurrences_first
 from calensync.log import get_logger
+from calensync.ratelimit import get_rate_limiter, RateLimitedHttpRequest
 from calensync.queries.common import get_sync_rules_from_source
-from calensync.secure import decrypt_credentials
 from calensync.sqs import push_update_event_to_queue, prepare_event_to_push
 from calensync.utils import get_api_url, utcnow, datetime_to_google_time, format_calendar_text, \
-    google_error_handling_with_backoff, is_local
+    google_error_handling_with_backoff, is_local, google_batch_with_backoff, replace_timezone_if_naive, run_in_thread, \
+    BackoffException
 
 logger = get_logger(__file__)
 
+# Partial response masks for events.list, so that Google only sends the fields we read.
+# nextPageToken must always be part of them, otherwise the pagination stops after the first page
+COPY_LOOKUP_FIELDS = ("nextPageToken,items(id,status,created,updated,start,end,originalStartTime,recurringEventId,"
+                      "extendedProperties,summary,description)")
+COPY_DELETION_FIELDS = "nextPageToken,items(id,status,updated,recurringEventId,extendedProperties)"
+
+SERVICE_POOL_SIZE = int(os.environ.get("SERVICE_POOL_SIZE", 128))
+# per thread
+WRAPPER_POOL_SIZE = int(os.environ.get("WRAPPER_POOL_SIZE", 128))
+
 
 def service_from_account(account: CalendarAccount, boto_session: boto3.Session):
-    credentials = decrypt_credentials(account.encrypted_credentials, boto_session)
-    creds = google.oauth2.credentials.Credentials.from_authorized_user_info(
-        credentials
-    )
+    creds = get_credentials(account, boto_session)
+    transport_key = str(account.uuid)
+    rate_limiter = get_rate_limiter(transport_key)
 
     def build_request(http, *args, **kwargs):
-        new_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
-        return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)
+        new_http = google_auth_httplib2.AuthorizedHttp(creds, http=get_http_transport(transport_key))
+        return RateLimitedHttpRequest(rate_limiter, new_http, *args, **kwargs)
+
+    authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=get_http_transport(transport_key))
+    return build_calendar_service(requestBuilder=build_request, http=authorized_http)
+
+
+@dataclasses.dataclass
+class _PooledService:
+    service: Any
+    account_uuid: str
+    encrypted_credentials: str
+
+
+_service_pool: collections.OrderedDict = collections.OrderedDict()
+_service_pool_lock = threading.Lock()
+
+
+def get_account_service(account: CalendarAccount, boto_session: boto3.Session):
+    """
+    Returns the google service of the account, shared by its calendars and kept across messages and warm
+    invocations. The requests of a service are sent with the transport of the calling thread (see
+    service_from_account), so it can be used from several threads. The entry is rebuilt when the
+    credentials of the account changed, see also invalidate_account_service
+    """
+    with _service_pool_lock:
+        pooled: Optional[_PooledService] = _service_pool.get(account.id)
+        if pooled is not None:
+            if (pooled.account_uuid == str(account.uuid)
+                    and pooled.encrypted_credentials == account.encrypted_credentials):
+                _service_pool.move_to_end(account.id)
+                return pooled.service
+            del _service_pool[account.id]
+
+    service = service_from_account(account, boto_session)
+    with _service_pool_lock:
+        _service_pool[account.id] = _PooledService(service, str(account.uuid), account.encrypted_credentials)
+        _service_pool.move_to_end(account.id)
+        while len(_service_pool) > SERVICE_POOL_SIZE:
+            _service_pool.popitem(last=False)
+    return service
 
-    authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
-    return build('calendar', 'v3', requestBuilder=build_request, http=authorized_http)
+
+def invalidate_account_service(account_id: int):
+    """ Drops the pooled service of the account, to be called when its credentials are revoked """
+    with _service_pool_lock:
+        _service_pool.pop(account_id, None)
+
+
+def delete_event_request(service, calendar_id: str, event_id: str):
+    return service.events().delete(calendarId=calendar_id, eventId=event_id, sendNotifications=None,
+                                   sendUpdates=None)
 
 
 def delete_event(service, calendar_id: str, event_id: str):
-    service.events().delete(calendarId=calendar_id, eventId=event_id, sendNotifications=None,
-                            sendUpdates=None).execute()
+    delete_event_request(service, calendar_id, event_id).execute()
 
 
-def insert_event(service, calendar_id: str, start: GoogleDatetime, end: GoogleDatetime,
-                 properties: List[EventExtendedProperty] = None, display_name="Calensync", summary="Busy",
-                 description=None, **kwargs) -> Dict:
+def insert_event_request(service, calendar_id: str, start: GoogleDatetime, end: GoogleDatetime,
+                         properties: List[EventExtendedProperty] = None, display_name="Calensync", summary="Busy",
+                         description=None, **kwargs):
     pp = EventExtendedProperty.list_to_dict(properties)
     event = {
         "creator": {"displayName": display_name},
@@ -70,30 +132,68 @@ def insert_event(service, calendar_id: str, start: GoogleDatetime, end: GoogleDa
         **kwargs
     }
     logger.info(f"Inserting event with private properties: {pp}")
-    return service.events().insert(calendarId=calendar_id, body=event).execute()
+    return service.events().insert(calendarId=calendar_id, body=event)
 
 
-def update_event(service, calendar_id: str, event_id: str, start: GoogleDatetime, end: GoogleDatetime, **kwargs):
+def insert_event(service, calendar_id: str, start: GoogleDatetime, end: GoogleDatetime,
+                 properties: List[EventExtendedProperty] = None, display_name="Calensync", summary="Busy",
+                 description=None, **kwargs) -> Dict:
+    return insert_event_request(service, calendar_id, start, end, properties, display_name, summary, description,
+                                **kwargs).execute()
+
+
+def update_event_request(service, calendar_id: str, event_id: str, start: GoogleDatetime, end: GoogleDatetime,
+                         **kwargs):
     body = {
         "start": start.to_google_dict(),
         "end": end.to_google_dict(),
         **kwargs
     }
     logger.debug(f"Updating event {event_id}: {body}")
-    service.events().patch(calendarId=calendar_id, eventId=event_id, body=body).execute()
+    return service.events().patch(calendarId=calendar_id, eventId=event_id, body=body)
+
+
+def update_event(service, calendar_id: str, event_id: str, start: GoogleDatetime, end: GoogleDatetime,
+                 **kwargs) -> Dict:
+    return update_event_request(service, calendar_id, event_id, start, end, **kwargs).execute()
+
+
+def patch_event_from_insert_request(service, calendar_id: str, event_id: str, start: GoogleDatetime,
+                                    end: GoogleDatetime, properties: List[EventExtendedProperty] = None,
+                                    display_name="Calensync", summary="Busy", description=None, **kwargs):
+    """
+    Patch request giving the event the body it would have been inserted with. Used when the insertion
+    of an event with a chosen id conflicts with an existing event, e.g. a copy with a deterministic id
+    """
+    return update_event_request(service, calendar_id, event_id, start, end, summary=summary, description=description,
+                                extendedProperties={"private": EventExtendedProperty.list_to_dict(properties)},
+                                status=EventStatus.confirmed.value, **kwargs)
+
+
+def is_conflict_error(e: HttpError) -> bool:
+    return e.status_code == 409
+
+
+def is_not_found_error(e: HttpError) -> bool:
+    return e.status_code == 404
+
+
+def is_already_deleted_error(e: HttpError) -> bool:
+    return (
+            e.resp.get('content-type', '').startswith('application/json')
+            and json.loads(e.content).get('error', {}).get('errors', {})[0].get('reason', '') == 'deleted'
+    )
 
 
 def get_google_email(credentials):
-    oauth2_client = build(
-        'oauth2', 'v2',
-        credentials=credentials)
+    oauth2_client = build_oauth2_service(credentials=credentials)
 
     # pylint: disable-next=no-member
     return oauth2_client.userinfo().get().execute()["email"]
 
 
 def get_google_calendars(credentials) -> List[GoogleCalendar]:
-    service = build('calendar', 'v3', credentials=credentials)
+    service = build_calendar_service(credentials=credentials)
     try:
         # pylint: disable-next=no-member
         items = service.calendarList().list().execute()["items"]
@@ -103,8 +203,9 @@ def get_google_calendars(credentials) -> List[GoogleCalendar]:
         raise ApiError("Failed to process request due to Google credentials error") from e
 
 
-def get_events(service, google_id: str, start_date: datetime.datetime, end_date: datetime.datetime,
-               private_extended_properties: Optional[Dict] = None, **kwargs):
+def events_list_request(service, google_id: str, start_date: datetime.datetime, end_date: datetime.datetime,
+                        private_extended_properties: Optional[Dict] = None, **kwargs):
+    """ Returns the events service and the events.list request of the first page """
     start_date_str = datetime_to_google_time(start_date) if start_date is not None else start_date
     end_date_str = datetime_to_google_time(end_date) if end_date is not None else end_date
 
@@ -126,15 +227,109 @@ def get_events(service, google_id: str, start_date: datetime.datetime, end_date:
         privateExtendedProperty=privateExtendedProperty,
         **kwargs
     )
-    events = []
+    return events_service, request
+
+
+def get_events(service, google_id: str, start_date: datetime.datetime, end_date: datetime.datetime,
+               private_extended_properties: Optional[Dict] = None, **kwargs):
+    events_service, request = events_list_request(service, google_id, start_date, end_date,
+                                                  private_extended_properties, **kwargs)
+    events, _ = execute_list_request(events_service, request, google_id)
+    return events
+
+
+def iter_event_pages(service, google_id: str, start_date: datetime.datetime, end_date: datetime.datetime,
+                     private_extended_properties: Optional[Dict] = None, **kwargs) -> Iterator[List[GoogleEvent]]:
+    """
+    Same as get_events, but yields the events page by page as they are fetched, so that only one
+    page is held in memory at a time
+    """
+    events_service, request = events_list_request(service, google_id, start_date, end_date,
+                                                  private_extended_properties, **kwargs)
+    for events, _ in iter_list_request_pages(events_service, request, google_id):
+        yield events
+
+
+def sync_token_list_request(service, google_id: str, sync_token: Optional[str] = None,
+                            start_date: datetime.datetime = None, **kwargs):
+    """ Returns the events service and the events.list request of the first page of an incremental listing """
+    if 'maxResults' not in kwargs:
+        kwargs['maxResults'] = 2500
+
+    if sync_token is not None:
+        # timeMin, timeMax, updatedMin, orderBy and privateExtendedProperty can't be used with a sync token
+        kwargs['syncToken'] = sync_token
+    else:
+        kwargs['showDeleted'] = True
+        if start_date is not None:
+            kwargs['timeMin'] = datetime_to_google_time(start_date)
+
+    events_service = service.events()
+    request = events_service.list(calendarId=google_id, timeZone="UCT", **kwargs)
+    return events_service, request
+
+
+def is_in_sync_window(event: GoogleEvent, start_date: datetime.datetime, end_date: datetime.datetime) -> bool:
+    """
+    Whether the event would be part of a listing between start_date and end_date, i.e. it overlaps the window.
+    Recurrences starting before the end of the window are kept, and so are the events without dates (deleted ones)
+    """
+    if event.start is None:
+        return True
+    if replace_timezone_if_naive(event.start.to_datetime()) > end_date:
+        return False
+    if event.recurrence:
+        return True
+    end = event.end if event.end is not None else event.start
+    return replace_timezone_if_naive(end.to_datetime()) >= start_date
+
+
+def get_events_with_sync_token(service, google_id: str, sync_token: Optional[str] = None,
+                               start_date: datetime.datetime = None, **kwargs
+                               ) -> Tuple[List[GoogleEvent], Optional[str]]:
+    """
+    Lists the events through Google incremental synchronization. With a sync_token, only the events
+    changed since the token was issued are returned (deleted ones included). Without it, this is
+    a full listing from start_date, which provides the first token.
+
+    Returns the events and the next sync token. Raises an HttpError with status 410 if the token expired.
+    """
+    events_service, request = sync_token_list_request(service, google_id, sync_token, start_date, **kwargs)
+    return execute_list_request(events_service, request, google_id)
+
+
+def iter_event_pages_with_sync_token(service, google_id: str, sync_token: Optional[str] = None,
+                                     start_date: datetime.datetime = None, **kwargs
+                                     ) -> Iterator[Tuple[List[GoogleEvent], Optional[str]]]:
+    """ Same as get_events_with_sync_token, page by page. The next sync token is only set on the last page """
+    events_service, request = sync_token_list_request(service, google_id, sync_token, start_date, **kwargs)
+    return iter_list_request_pages(events_service, request, google_id)
+
+
+def iter_list_request_pages(events_service, request, google_id: str
+                            ) -> Iterator[Tuple[List[GoogleEvent], Optional[str]]]:
+    """ Follows the pages of an events.list request, yields the parsed events of each page and its nextSyncToken """
+    n_events = 0
     while request is not None:
         response = request.execute()
-        logger.debug(f"{google_id}: {response.get('items', [])}")
-        events.extend(GoogleEvent.parse_event_list_response(response))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{google_id}: {response.get('items', [])}")
+        events = GoogleEvent.parse_event_list_response(response)
+        n_events += len(events)
+        logger.info(f"Fetched {n_events}")
         request = events_service.list_next(request, response)
-        logger.info(f"Fetched {len(events)}")
+        yield events, response.get("nextSyncToken")
 
-    return events
+
+def execute_list_request(events_service, request, google_id: str) -> Tuple[List[GoogleEvent], Optional[str]]:
+    """ Follows the pages of an events.list request, returns the events and the nextSyncToken if any """
+    events = []
+    next_sync_token = None
+    for page, page_sync_token in iter_list_request_pages(events_service, request, google_id):
+        events.extend(page)
+        next_sync_token = page_sync_token or next_sync_token
+
+    return events, next_sync_token
 
 
 def delete_google_watch(service, resource_id: str, channel_id: str):
@@ -200,7 +395,6 @@ def make_summary_and_description(source_event: GoogleEvent, rule: SyncRule):
 
 
 class GoogleCalendarWrapper:
-    user_db: User
     calendar_db: Calendar
     credentials: Dict
     """ google service """
@@ -216,8 +410,8 @@ class GoogleCalendarWrapper:
 
     def __init__(self, calendar_db: Calendar, service=None, db=None, session=None):
         self._service = None
+        self._user_db = None
         self.calendar_db = calendar_db
-        self.user_db = calendar_db.account.user
         if db is None:
             # this is really not great
             from calensync.database.model import db
@@ -229,6 +423,28 @@ class GoogleCalendarWrapper:
 
         self.events_handler = EventsModificationHandler()
         self.events = []
+        # set by get_events when the listing failed, the events are then empty but the calendar might not be
+        self.listing_failed = False
+        # when set, copies are looked up in the index, and the writes in this calendar are reflected in it
+        self.copy_index: Optional[DestinationCopyIndex] = None
+
+    def reset(self, calendar_db: Calendar, session=None):
+        """ Prepares the wrapper for a new use, with the latest state of its calendar """
+        self.calendar_db = calendar_db
+        self._session = session
+        self._user_db = None
+        # the pooled service of the account is checked against the credentials of the calendar's account
+        self._service = None
+        self.events_handler = EventsModificationHandler()
+        self.events = []
+        self.listing_failed = False
+        self.copy_index = None
+
+    @property
+    def user_db(self) -> User:
+        if self._user_db is None:
+            self._user_db = self.calendar_db.account.user
+        return self._user_db
 
     @property
     def session(self):
@@ -247,7 +463,7 @@ class GoogleCalendarWrapper:
     def service(self):
         """ Lazy service loader with cache """
         if self._service is None:
-            self._service = service_from_account(self.calendar_db.account, self.session)
+            self._service = get_account_service(self.calendar_db.account, self.session)
         return self._service
 
     @property
@@ -265,22 +481,138 @@ class GoogleCalendarWrapper:
         # start_date = start_date if start_date is not None else datetime.datetime.utcnow()
         # end_date = end_date if end_date is not None else datetime.datetime.utcnow() + datetime.timedelta(
         #     days=number_of_days_to_sync_in_advance())
+        self.listing_failed = False
         try:
             events = get_events(self.service, self.google_id, start_date, end_date, private_extended_properties,
                                 **kwargs)
 
             self.events = events
         except googleapiclient.errors.HttpError as e:
-            if e.status_code == 403 and e.reason == "You need to have writer access to this calendar.":
-                self.calendar_db.paused = utcnow()
-                self.calendar_db.paused_reason = e.reason
-                self.calendar_db.save()
+            self._handle_list_error(e)
             self.events = []
+            self.listing_failed = True
         except google.auth.exceptions.RefreshError as e:
             handle_refresh_error(self.calendar_db, e)
             self.events = []
+            self.listing_failed = True
         return self.events
 
+    def find_copies(self, source_id: str, event: GoogleEvent = None) -> List[GoogleEvent]:
+        """
+        Returns the copies of the source event in this calendar. They're taken from the copy index when it can
+        tell, otherwise the calendar is queried by source id. `event` is the source event, if known
+        """
+        if self.copy_index is not None and (copies := self.copy_index.find(source_id, event)) is not None:
+            return copies
+        return self.get_events(
+            private_extended_properties=EventExtendedProperty.for_source_id(source_id).to_google_dict(),
+            fields=COPY_LOOKUP_FIELDS
+        )
+
+    def update_copy(self, event: GoogleEvent, rule: SyncRule, copy_id: str) -> bool:
+        """
+        Updates the copy of the event addressed by its id, without looking it up. Returns False if
+        there's no event with this id, e.g. a copy inserted before deterministic ids were used
+        """
+        if self.calendar_db.is_read_only or rule.destination.paused:
+            return True
+
+        summary, description = make_summary_and_description(event, rule)
+        inner = lambda: update_event(service=self.service, calendar_id=self.google_id,  # noqa: E731
+                                     event_id=copy_id, start=event.start.clone(), end=event.end.clone(),
+                                     summary=summary, description=description,
+                                     recurrence=event.recurrence, status=event.status.value)
+        try:
+            response = google_error_handling_with_backoff(inner, self.calendar_db)
+        except HttpError as e:
+            if is_not_found_error(e):
+                return False
+            logger.warning(f"Failed to process event {copy_id}: {e}")
+            return True
+        self._index_write(event.id, response)
+        return True
+
+    def delete_copy(self, copy_id: str) -> bool:
+        """
+        Deletes the copy with the given id, without looking it up. Returns False if there's no event with
+        this id, e.g. a copy inserted before deterministic ids were used
+        """
+        if self.calendar_db.is_read_only:
+            return True
+
+        logger.info(f"Deleting event {copy_id} in {self.google_id}")
+        inner = lambda: delete_event(self.service, self.google_id, copy_id)  # noqa: E731
+        try:
+            google_error_handling_with_backoff(inner, self.calendar_db)
+        except HttpError as e:
+            if is_not_found_error(e):
+                return False
+            if not is_already_deleted_error(e):
+                logger.warning(f"Failed to delete event {copy_id} in calendar {self.calendar_db.id}: {e}")
+                return True
+        if self.copy_index is not None:
+            self.copy_index.remove(copy_id)
+        return True
+
+    def build_copy_index(self, source_calendar_uuid: str, start_date: datetime.datetime,
+                         end_date: datetime.datetime) -> Optional[DestinationCopyIndex]:
+        """
+        Lists once all the copies of the source calendar in this calendar between the two dates, and indexes them.
+        Returns None if the listing failed, since an incomplete index would make existing copies look missing
+        """
+        try:
+            pages = iter_event_pages(
+                self.service, self.google_id, start_date, end_date,
+                EventExtendedProperty.for_calendar_id(source_calendar_uuid).to_google_dict(),
+                fields=COPY_LOOKUP_FIELDS
+            )
+            copy_index = DestinationCopyIndex(itertools.chain.from_iterable(pages), start_date, end_date)
+        except (googleapiclient.errors.HttpError, google.auth.exceptions.RefreshError) as e:
+            logger.warning(f"Failed to index the copies of {source_calendar_uuid} in {self.calendar_db.uuid}: {e}")
+            return None
+        logger.info(f"Indexed {len(copy_index)} copies of {source_calendar_uuid} in {self.calendar_db.uuid}")
+        return copy_index
+
+    def _index_write(self, source_id: Optional[str], response):
+        """
+        Reflects the insertion or update of a copy of source_id in the copy index. The source event can't be
+        used for this, the events handler clears its id
+        """
+        if self.copy_index is None:
+            return
+        if isinstance(response, dict):
+            try:
+                copy = GoogleEvent.parse_obj(response)
+                if copy.source_id is not None:
+                    self.copy_index.add(copy)
+                    return
+            except pydantic.ValidationError:
+                pass
+        if source_id is not None:
+            self.copy_index.invalidate(source_id)
+
+    def iter_event_pages(self, start_date: datetime.datetime = None, end_date: datetime.datetime = None,
+                         private_extended_properties: Dict = None, **kwargs) -> Iterator[List[GoogleEvent]]:
+        """ Same as get_events, but yields the events page by page. Stops early if the listing fails """
+        try:
+            yield from iter_event_pages(self.service, self.google_id, start_date, end_date,
+                                        private_extended_properties, **kwargs)
+        except googleapiclient.errors.HttpError as e:
+            self._handle_list_error(e)
+        except google.auth.exceptions.RefreshError as e:
+            handle_refresh_error(self.calendar_db, e)
+
+    async def get_events_async(self, start_date: datetime.datetime = None, end_date: datetime.datetime = None,
+                               private_extended_properties: Dict = None, **kwargs):
+        return await run_in_thread(self.db, self.get_events, start_date, end_date, private_extended_properties,
+                                   **kwargs)
+
+    def _handle_list_error(self, e: googleapiclient.errors.HttpError):
+        if e.status_code == 403 and e.reason == "You need to have writer access to this calendar.":
+            self.calendar_db.paused = utcnow()
+            self.calendar_db.paused_reason = e.reason
+            self.calendar_db.save()
+
     def add_watch(self, watch_id: str, token: str, expiration: datetime.datetime, url: str):
         body = {
             "id": watch_id,
@@ -348,7 +680,36 @@ class GoogleCalendarWrapper:
             self.calendar_db.save()
             delete_google_watch(self.service, resource_id, channel_id)
 
-    def insert_events(self):
+    @staticmethod
+    def _patch_request_from_insert(insert_kwargs: Dict):
+        """ Patch request of an insertion, prepared by _prepare_insert, whose chosen id conflicted """
+        kwargs = dict(insert_kwargs)
+        return patch_event_from_insert_request(event_id=kwargs.pop("id"), **kwargs)
+
+    def _prepare_insert(self, event: GoogleEvent, properties: List[EventExtendedProperty], rule: SyncRule) -> Dict:
+        summary, description = make_summary_and_description(event, rule)
+
+        kwargs = {}
+        if event.id:
+            logger.info(f"Keeping id for event {event.id}")
+            kwargs['id'] = event.id
+        elif event.recurringEventId is None and use_deterministic_copy_ids():
+            # instances of recurrences get their id from the copy of the recurrence root
+            source_id = EventExtendedProperty.list_to_dict(properties).get(EventExtendedProperty.get_source_id_key())
+            if source_id is not None:
+                kwargs['id'] = copy_event_id(str(rule.uuid), source_id)
+        if event.originalStartTime is not None:
+            kwargs['originalStartTime'] = event.originalStartTime.to_google_dict()
+        if event.recurringEventId is not None:
+            kwargs['recurringEventId'] = event.recurringEventId
+
+        return dict(
+            service=self.service, calendar_id=self.google_id,
+            start=event.start, end=event.end, properties=properties, recurrence=event.recurrence,
+            summary=summary, description=description, **kwargs
+        )
+
+    def insert_events(self, batch: bool = False):
         if self.calendar_db.is_read_only:
             return None
         elif self.calendar_db.paused is not None:
@@ -359,6 +720,9 @@ class GoogleCalendarWrapper:
         self.calendar_db.save()
 
         logger.info(f"Adding {len(self.events_handler.events_to_add)} events")
+        if batch:
+            return self._insert_events_batch()
+
         while self.events_handler.events_to_add:
             # order of popping is important for recurrence race condition
             (event, properties, rule) = self.events_handler.events_to_add.pop(0)
@@ -366,33 +730,79 @@ class GoogleCalendarWrapper:
                 # never copy an event created by us
                 continue
 
-            summary, description = make_summary_and_description(event, rule)
-
-            kwargs = {}
-            if event.id:
-                logger.info(f"Keeping id for event {event.id}")
-                kwargs['id'] = event.id
-            if event.originalStartTime is not None:
-                kwargs['originalStartTime'] = event.originalStartTime.to_google_dict()
-            if event.recurringEventId is not None:
-                kwargs['recurringEventId'] = event.recurringEventId
+            insert_kwargs = self._prepare_insert(event, properties, rule)
+            responses = []
 
             def _inner():
-                insert_event(
-                    service=self.service, calendar_id=self.google_id,
-                    start=event.start, end=event.end, properties=properties, recurrence=event.recurrence,
-                    summary=summary, description=description, **kwargs
-                )
-
-            return google_error_handling_with_backoff(_inner, self.calendar_db)
+                try:
+                    responses.append(insert_event(**insert_kwargs))
+                except HttpError as e:
+                    if "id" not in insert_kwargs or not is_conflict_error(e):
+                        raise e
+                    # the event already exists, which makes the insertion idempotent
+                    logger.info(f"Event {insert_kwargs['id']} already exists, patching it")
+                    responses.append(self._patch_request_from_insert(insert_kwargs).execute())
+
+            result = google_error_handling_with_backoff(_inner, self.calendar_db)
+            if responses:
+                self._index_write(EventExtendedProperty.list_to_dict(properties).get(
+                    EventExtendedProperty.get_source_id_key()), responses[0])
+            return result
 
         return None
 
-    def update_events(self):
+    def _insert_events_batch(self) -> int:
+        """
+        Inserts all the queued events through the batch endpoint. Recurrence roots are queued first
+        by the EventsModificationHandler, and since a batch doesn't guarantee any ordering, they're
+        sent in a batch of their own before the other events.
+        """
+        roots, others = {}, {}
+        source_ids = {}
+        insert_kwargs = {}
+        while self.events_handler.events_to_add:
+            (event, properties, rule) = self.events_handler.events_to_add.pop(0)
+            if event.extendedProperties.private.get("source-id") is not None:
+                # never copy an event created by us
+                continue
+            requests = roots if event.recurrence is not None else others
+            request_id = str(len(roots) + len(others))
+            insert_kwargs[request_id] = self._prepare_insert(event, properties, rule)
+            requests[request_id] = insert_event_request(**insert_kwargs[request_id])
+            source_ids[request_id] = EventExtendedProperty.list_to_dict(properties).get(
+                EventExtendedProperty.get_source_id_key())
+
+        inserted = 0
+        for requests in (roots, others):
+            if not requests:
+                continue
+            results = google_batch_with_backoff(self.service, requests, self.calendar_db)
+            conflicts = {
+                request_id: self._patch_request_from_insert(insert_kwargs[request_id])
+                for request_id, result in results.items()
+                if isinstance(result, HttpError) and is_conflict_error(result) and "id" in insert_kwargs[request_id]
+            }
+            if conflicts:
+                # the events already exist, which makes the insertion idempotent
+                logger.info(f"{len(conflicts)} events already exist, patching them")
+                results.update(google_batch_with_backoff(self.service, conflicts, self.calendar_db))
+            for request_id, result in results.items():
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to insert event in calendar {self.calendar_db.id}: {result}")
+                    self._index_write(source_ids[request_id], None)
+                elif result is not False:
+                    inserted += 1
+                    self._index_write(source_ids[request_id], result)
+        logger.info(f"Inserted {inserted} events")
+        return inserted
+
+    def update_events(self, batch: bool = False):
         """ Only used to update start/end datetime"""
         if self.calendar_db.is_read_only:
             return
 
+        requests = {}
+        source_ids = {}
         for (source_event, to_update, rule) in self.events_handler.events_to_update:
             source_event: GoogleEvent
             to_update: GoogleEvent
@@ -406,30 +816,50 @@ class GoogleCalendarWrapper:
                         continue
 
                     summary, description = make_summary_and_description(source_event, rule)
+                    update_kwargs = dict(service=self.service,
+                                         calendar_id=self.google_id,
+                                         event_id=to_update.id,
+                                         start=start, end=end,
+                                         summary=summary,
+                                         description=description,
+                                         recurrence=source_event.recurrence,
+                                         status=source_event.status.value)
+
+                    if batch:
+                        requests[to_update.id] = update_event_request(**update_kwargs)
+                        source_ids[to_update.id] = to_update.source_id
+                        continue
 
-                    inner = lambda: update_event(service=self.service,  # noqa: E731
-                                                 calendar_id=self.google_id,
-                                                 event_id=to_update.id,
-                                                 start=start, end=end,
-                                                 summary=summary,
-                                                 description=description,
-                                                 recurrence=source_event.recurrence,
-                                                 status=source_event.status.value
-                                                 )
+                    inner = lambda: update_event(**update_kwargs)  # noqa: E731
 
-                    google_error_handling_with_backoff(inner, self.calendar_db)
+                    response = google_error_handling_with_backoff(inner, self.calendar_db)
+                    self._index_write(to_update.source_id, response)
 
+            except BackoffException as e:
+                # the whole message must be retried later
+                raise e
             except Exception as e:
                 # todo: non-retryable exceptions should throw the error
-                logger.warn(f"Failed to process event {to_update.id}: {e}. {traceback.format_exc()}")
+                logger.warning(f"Failed to process event {to_update.id}: {e}. {traceback.format_exc()}")
 
-    def delete_events(self):
+        if requests:
+            results = google_batch_with_backoff(self.service, requests, self.calendar_db)
+            for event_id, result in results.items():
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to process event {event_id}: {result}")
+                self._index_write(source_ids[event_id], result)
+
+    def delete_events(self, batch: bool = False):
         """
         Calls google API to delete events stored in self.events_handler.
         """
         if self.calendar_db.is_read_only:
             return
 
+        if batch:
+            self._delete_events_batch()
+            return
+
         deleted_events = 0
         while self.events_handler.events_to_delete:
             event_id = self.events_handler.events_to_delete.pop()
@@ -438,39 +868,137 @@ class GoogleCalendarWrapper:
                 inner = lambda: delete_event(self.service, self.google_id, event_id)  # noqa: E731
                 if google_error_handling_with_backoff(inner, self.calendar_db):
                     deleted_events += 1
+                if self.copy_index is not None:
+                    self.copy_index.remove(event_id)
             except googleapiclient.errors.HttpError as e:
-                if (
-                        e.resp.get('content-type', '').startswith('application/json')
-                        and json.loads(e.content).get('error', {}).get('errors', {})[0].get('reason', '') == 'deleted'
-                ):
+                if is_already_deleted_error(e):
                     # resource already deleted
-                    pass
+                    if self.copy_index is not None:
+                        self.copy_index.remove(event_id)
                 else:
-                    logger.warn(f"Failed to delete event {event_id} in calendar {self.calendar_db.id}: {e}")
+                    logger.warning(f"Failed to delete event {event_id} in calendar {self.calendar_db.id}: {e}")
+            except BackoffException as e:
+                # the whole message must be retried later
+                raise e
             except Exception as e:
-                logger.warn(f"Failed to delete event {event_id} in calendar {self.calendar_db.id}: {e}")
+                logger.warning(f"Failed to delete event {event_id} in calendar {self.calendar_db.id}: {e}")
         logger.info(f"Deleted {deleted_events} events")
 
-    def get_updated_events(self, updated_min: int = None) -> List[GoogleEvent]:
-        """ Returns the events updated since last_processed """
-        if updated_min is None:
-            updated_min = max(
-                self.calendar_db.last_processed.replace(tzinfo=datetime.timezone.utc),
-                utcnow() - datetime.timedelta(days=3)
-            )
+    def _delete_events_batch(self):
+        requests = {}
+        while self.events_handler.events_to_delete:
+            event_id = self.events_handler.events_to_delete.pop()
+            requests[event_id] = delete_event_request(self.service, self.google_id, event_id)
+
+        if not requests:
+            return
+
+        logger.info(f"Deleting {len(requests)} events in {self.google_id}")
+        results = google_batch_with_backoff(self.service, requests, self.calendar_db)
+        deleted_events = 0
+        for event_id, result in results.items():
+            if self.copy_index is not None and result is not False and not isinstance(result, Exception):
+                self.copy_index.remove(event_id)
+            if isinstance(result, googleapiclient.errors.HttpError) and is_already_deleted_error(result):
+                # resource already deleted
+                if self.copy_index is not None:
+                    self.copy_index.remove(event_id)
+                continue
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to delete event {event_id} in calendar {self.calendar_db.id}: {result}")
+            elif result is not False:
+                deleted_events += 1
+        logger.info(f"Deleted {deleted_events} events")
+
+    def get_updated_events(self, updated_min: datetime.datetime = None) -> List[GoogleEvent]:
+        """
+        Returns the events updated since last_processed. When the calendar has a sync token, only the delta
+        since the previous call is fetched. Otherwise (first call, or token expired) the whole sync window
+        is listed once to obtain a new token.
+        """
+        events = [event for page in self.iter_updated_event_pages(updated_min) for event in page]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Found updated events: {[(e.id, e.start, e.end) for e in events]}")
+        return events
+
+    def iter_updated_event_pages(self, updated_min: datetime.datetime = None) -> Iterator[List[GoogleEvent]]:
+        """
+        Same as get_updated_events, page by page. The new sync token is only saved once the last page
+        was consumed, so that an interrupted iteration is fetched again on the next call
+        """
+        if updated_min is not None:
+            yield self.get_updated_events_by_date(updated_min)
+            return
+
+        sync_token = self.calendar_db.sync_token
+        start_date = utcnow() - datetime.timedelta(days=30)
+        # the changes listed with a sync token aren't bounded by the sync window, unlike full listings
+        end_date = utcnow() + datetime.timedelta(days=number_of_days_to_sync_in_advance())
+        # first listing of this calendar: only the events updated since the last processing are new
+        min_updated = self.default_updated_min() if sync_token is None else None
+        next_sync_token = None
+        try:
+            pages = iter_event_pages_with_sync_token(self.service, self.google_id, sync_token, start_date=start_date)
+            try:
+                first_page = next(pages, None)
+            except googleapiclient.errors.HttpError as e:
+                if sync_token is None or e.status_code != 410:
+                    raise e
+                # the token expired, a full re-sync is required, and all events of the window must be processed
+                logger.info(f"Sync token of calendar {self.calendar_db.uuid} expired, running full sync")
+                self.calendar_db.sync_token = None
+                pages = iter_event_pages_with_sync_token(self.service, self.google_id, None, start_date=start_date)
+                first_page = next(pages, None)
+
+            if first_page is not None:
+                pages = itertools.chain([first_page], pages)
+
+            for events, next_sync_token in pages:
+                events = [e for e in events if is_in_sync_window(e, start_date, end_date)]
+                if min_updated is not None:
+                    events = [
+                        e for e in events
+                        if e.updated is None or replace_timezone_if_naive(e.updated) >= min_updated
+                    ]
+                yield events
+
+        except googleapiclient.errors.HttpError as e:
+            self._handle_list_error(e)
+            return
+        except google.auth.exceptions.RefreshError as e:
+            handle_refresh_error(self.calendar_db, e)
+            return
+
+        if next_sync_token is not None:
+            self.calendar_db.sync_token = next_sync_token
+            self.calendar_db.save()
+
+    def default_updated_min(self) -> datetime.datetime:
+        return max(
+            self.calendar_db.last_processed.replace(tzinfo=datetime.timezone.utc),
+            utcnow() - datetime.timedelta(days=3)
+        )
 
+    def get_updated_events_by_date(self, updated_min: datetime.datetime) -> List[GoogleEvent]:
+        """ Returns the events updated since updated_min within the sync window """
         start_date = utcnow() - datetime.timedelta(days=30)
         end_date = utcnow() + datetime.timedelta(days=number_of_days_to_sync_in_advance())
         events = self.get_events(start_date=start_date, end_date=end_date, updatedMin=updated_min, orderBy="updated",
                                  showDeleted=True, maxResults=200)
 
-        logger.debug(f"Found updated events: {[(e.id, e.start, e.end) for e in events]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Found updated events: {[(e.id, e.start, e.end) for e in events]}")
         return events
 
     @staticmethod
-    def push_event_to_rule(event: GoogleEvent, rule: SyncRule, session: boto3.Session = None) -> int:
+    def push_event_to_rule(event: GoogleEvent, rule: SyncRule, session: boto3.Session = None,
+                           copy_index: DestinationCopyIndex = None,
+                           destination_wrapper: GoogleCalendarWrapper = None) -> int:
         """
-        Solves a single event update (by updating all other calendars where this event exists)
+        Solves a single event update (by updating all other calendars where this event exists).
+        When processing several events of the same rule, the copies can be looked up in a copy index
+        of the destination (see build_copy_index) instead of querying the destination for each event,
+        and the wrapper of the destination can be shared
         """
         logger.info(f"Pushing event {event.id} to rule {rule.id}")
         counter_event_changed = 0
@@ -480,7 +1008,15 @@ class GoogleCalendarWrapper:
 
         set_declined_event_if_necessary(rule, event)
 
-        c = GoogleCalendarWrapper(rule.destination, session=session)
+        if destination_wrapper is None:
+            c = get_calendar_wrapper(rule.destination, session=session)
+        else:
+            c = destination_wrapper
+            c.events_handler = EventsModificationHandler()
+        c.copy_index = copy_index
+        # with deterministic ids, copies are addressed directly. Updates and deletions fall back to the
+        # lookup by source id when the copy isn't found under its id
+        deterministic_ids = use_deterministic_copy_ids()
 
         if event.status == EventStatus.tentative:
             # this means an invitation was received, but not yet accepted, so nothing to do
@@ -491,10 +1027,11 @@ class GoogleCalendarWrapper:
             logger.info(f"Found event to delete")
             if event.recurringEventId is not None:
                 logger.info("Event part of recurrent sequence")
-                fetched_events = c.get_events(
-                    private_extended_properties=EventExtendedProperty.for_source_id(
-                        event.recurringEventId).to_google_dict()
-                )
+                if deterministic_ids and c.delete_copy(
+                        get_recurrent_event_id(event.id, copy_event_id(str(rule.uuid), event.recurringEventId))):
+                    return 1
+
+                fetched_events = c.find_copies(event.recurringEventId)
                 if fetched_events is None or len(fetched_events) == 0:
                     logger.info(f"Did not find recurrent source with source id {event.recurringEventId}")
                     raise PushToQueueException(event)
@@ -508,9 +1045,10 @@ class GoogleCalendarWrapper:
                     counter_event_changed += 1
             else:
                 logger.info("Event not part of recurring sequence")
-                fetched_events = c.get_events(
-                    private_extended_properties=EventExtendedProperty.for_source_id(event.id).to_google_dict()
-                )
+                if deterministic_ids and c.delete_copy(copy_event_id(str(rule.uuid), event.id)):
+                    return 1
+
+                fetched_events = c.find_copies(event.id, event)
                 if len(fetched_events) == 0:
                     logger.info(f"Did not find source with source id {event.id}")
                     raise PushToQueueException(event)
@@ -519,20 +1057,14 @@ class GoogleCalendarWrapper:
                 c.delete_events()
                 counter_event_changed += 1
 
-        # for some reason the created and updated time are not exactly the same, even when the event is new
-        # it looks like google doesn't use a transaction. Bad google. So 1 second threshold for equality
-        elif (
-                event.created is not None
-                and event.updated is not None
-                and (event.updated - event.created).seconds < 1
-        ):
+        elif event.is_new:
             # new event, we don't need to check anything more
             logger.info(f"Potential new event")
 
             source_calendar_uuid = str(rule.source.uuid)
-            existing_events = c.get_events(
-                private_extended_properties=EventExtendedProperty.for_source_id(event.id).to_google_dict()
-            )
+            # the copies are looked up even with deterministic ids: the event may have been copied under
+            # a random id, before they were used
+            existing_events = c.find_copies(event.id, event)
 
             if len(existing_events) > 0:
                 if (
@@ -559,9 +1091,14 @@ class GoogleCalendarWrapper:
                 logger.info(f"Found confirmed event, updating")
                 is_recurrence_instance = event.recurringEventId is not None
 
-                events = c.get_events(
-                    private_extended_properties=EventExtendedProperty.for_source_id(event.id).to_google_dict()
-                )
+                if (
+                        deterministic_ids
+                        and not is_recurrence_instance
+                        and c.update_copy(event, rule, copy_event_id(str(rule.uuid), event.id))
+                ):
+                    return 1
+
+                events = c.find_copies(event.id, event)
 
                 found_event = None
                 skip_normal_update = False
@@ -590,10 +1127,7 @@ class GoogleCalendarWrapper:
                 else:
                     # i.e. is_recurrence_instance == True
                     logger.info("Verifying that recurrence root exists")
-                    recurrence_source_exists = c.get_events(
-                        private_extended_properties=EventExtendedProperty.for_source_id(
-                            event.recurringEventId).to_google_dict()
-                    )
+                    recurrence_source_exists = c.find_copies(event.recurringEventId)
                     if not recurrence_source_exists:
                         # This signals that the root recurrence is missing, and so the instance of the
                         # recurrence update can't be correctly handled
@@ -647,32 +1181,34 @@ class GoogleCalendarWrapper:
             return 0
 
         if self.calendar_db.paused is not None:
-            logger.warn("Calendar is paused. Skipping update")
+            logger.warning("Calendar is paused. Skipping update")
 
-        events = []
-        if not only_preloaded:
-            events = self.get_updated_events()
-            events = [event for event in events if len(event.extendedProperties.private) == 0]
+        pages = iter([]) if only_preloaded else (
+            [event for event in page if len(event.extendedProperties.private) == 0]
+            for page in self.iter_updated_event_pages()
+        )
         if preloaded_events:
-            events.extend(preloaded_events)
+            pages = itertools.chain(pages, [preloaded_events])
+
+        # events are pushed page by page, so that only one page is held in memory at a time. The recurrences are
+        # pushed before their instances, also across pages
+        n_events = 0
+        for events in recurrences_first(pages):
+            prepared_events = []
+            for event in events:
+                # go towards a really micro-service architecture: sync rules are handled separately
+                for sr in sync_rules:
+                    prepared_events.append(
+                        prepare_event_to_push(event, sr.id, False)
+                    )
+            push_update_event_to_queue(prepared_events, self.session, self.db)
+            n_events += len(events)
 
-        logger.info(f"Found events to update: {len(events)}")
-        if not events:
+        logger.info(f"Found events to update: {n_events}")
+        if n_events == 0:
             logger.info(f"No updates found for channel {self.calendar_db.channel_id}")
-            return 0
-
-        # sorts them so that even that have a recurrence are handled first
-        events.sort(key=lambda x: x.recurrence is None)
-        prepared_events = []
-        for event in events:
-            # go towards a really micro-service architecture: sync rules are handled separately
-            for sr in sync_rules:
-                prepared_events.append(
-                    prepare_event_to_push(event, sr.id, False)
-                )
-        push_update_event_to_queue(prepared_events, self.session, self.db)
 
-        return len(events)
+        return n_events
 
     @classmethod
     def from_channel_id(cls, channel_id: str):
@@ -684,48 +1220,89 @@ class GoogleCalendarWrapper:
         return cls(calendar)
 
 
+_wrapper_pools = threading.local()
+
+
+def get_calendar_wrapper(calendar_db: Calendar, session: boto3.Session = None, db=None) -> GoogleCalendarWrapper:
+    """
+    Returns a wrapper of the calendar from the pool of the current thread, reset with the given calendar
+    (see GoogleCalendarWrapper.reset), so that the wrappers and their services are reused across messages
+    and warm invocations. A wrapper holds the state of a single use, so it's only valid until the next call
+    for the same calendar in the same thread. Paused calendars are dropped from the pool
+    """
+    pool = getattr(_wrapper_pools, "pool", None)
+    if pool is None:
+        pool = _wrapper_pools.pool = collections.OrderedDict()
+
+    key = str(calendar_db.uuid)
+    wrapper: Optional[GoogleCalendarWrapper] = pool.pop(key, None)
+    if calendar_db.paused is not None:
+        return GoogleCalendarWrapper(calendar_db, db=db, session=session)
+
+    if wrapper is None or (db is not None and wrapper.db is not db):
+        wrapper = GoogleCalendarWrapper(calendar_db, db=db, session=session)
+    else:
+        wrapper.reset(calendar_db, session)
+    pool[key] = wrapper
+    if len(pool) > WRAPPER_POOL_SIZE:
+        pool.popitem(last=False)
+    return wrapper
+
+
+def build_rule_copy_index(rule: SyncRule, events: List[GoogleEvent], session: boto3.Session = None,
+                          destination_wrapper: GoogleCalendarWrapper = None) -> Optional[DestinationCopyIndex]:
+    """ Indexes the copies of the rule's destination around the given source events """
+    # the index only tells that a copy is missing for new events, see DestinationCopyIndex.find. The start of
+    # a recurrence can be long ago, its copy is looked up instead of widening the window
+    starts = [replace_timezone_if_naive(e.start.to_datetime()) for e in events
+              if e.start is not None and not e.recurrence]
+    if not starts:
+        return None
+    if destination_wrapper is None:
+        destination_wrapper = get_calendar_wrapper(rule.destination, session=session)
+    return destination_wrapper.build_copy_index(
+        str(rule.source.uuid), min(starts) - datetime.timedelta(days=1), max(starts) + datetime.timedelta(days=1)
+    )
+
+
 def delete_events_for_sync_rule(sync_rule: SyncRule, boto_session, db, use_queue=True):
     destination_wrapper = GoogleCalendarWrapper(calendar_db=sync_rule.destination, session=boto_session)
 
-    events = destination_wrapper.get_events(
+    pages = destination_wrapper.iter_event_pages(
         private_extended_properties=EventExtendedProperty.for_calendar_id(str(sync_rule.source.uuid)).to_google_dict(),
         start_date=datetime.datetime.now() - datetime.timedelta(days=14),
         end_date=datetime.datetime.now() + datetime.timedelta(days=number_of_days_to_sync_in_advance()),
-        showDeleted=False
+        showDeleted=False,
+        fields=COPY_DELETION_FIELDS
     )
-    logger.info(f"Setting {len(events)} for deletion")
-
-    if use_queue:
-        prepared_events = []
-        for event in events:
-            if (
-                    source_event_id := event.extendedProperties.private.get(
-                        EventExtendedProperty.get_source_id_key())) is None:
-                logger.warn("Shouldn't be possible to have a copied event without source id")
-                continue
 
-            event.id = source_event_id
-            event.extendedProperties = ExtendedProperties()
-            event.status = EventStatus.cancelled
-            prepared_events.append(
-                prepare_event_to_push(event, sync_rule.id, True)
-            )
+    n_events = 0
+    for events in pages:
+        n_events += len(events)
+        if use_queue:
+            prepared_events = []
+            for event in events:
+                if (
+                        source_event_id := event.extendedProperties.private.get(
+                            EventExtendedProperty.get_source_id_key())) is None:
+                    logger.warning("Shouldn't be possible to have a copied event without source id")
+                    continue
+
+                event.id = source_event_id
+                event.extendedProperties = ExtendedProperties()
+                event.status = EventStatus.cancelled
+                prepared_events.append(
+                    prepare_event_to_push(event, sync_rule.id, True)
+                )
 
-        push_update_event_to_queue(prepared_events, session=boto_session, db=db)
-    else:
-        # for i, event in enumerate(events):
-        def _inner(event):
-            try:
-                GoogleCalendarWrapper.push_event_to_rule(event, sync_rule)
-            except Exception as e:
-                logger.error(e)
+            push_update_event_to_queue(prepared_events, session=boto_session, db=db)
+        else:
+            # only the ids are kept, the deletion happens once the listing is over to not shift its pages
+            destination_wrapper.events_handler.delete(events)
 
-        for i, event in enumerate(events):
-            if i % 50 == 0:
-                logger.info(f"Sent {i}/{len(events)} events")
-            _inner(event)
-        # with ThreadPool(8) as p:
-        #     print(p.map(_inner, events))
+    logger.info(f"Set {n_events} for deletion")
+    if not use_queue:
+        destination_wrapper.delete_events(batch=True)
 
 
 def handle_refresh_error(calendar_db: Calendar, exc: google.auth.exceptions.RefreshError):
@@ -734,3 +1311,5 @@ def handle_refresh_error(calendar_db: Calendar, exc: google.auth.exceptions.Refr
     calendar_db.paused = utcnow()
     calendar_db.paused_reason = reason
     calendar_db.save()
+    invalidate_credentials(calendar_db.account_id)
+    invalidate_account_service(calendar_db.account_id)
@@ -1,11 +1,13 @@
 from __future__ import annotations
 
-from typing import List, Tuple
+from typing import List, Tuple, Iterable, Iterator
 
 import peewee
 
 from calensync.database.model import User, SyncRule
-from calensync.dataclass import GoogleEvent, EventStatus, event_list_to_source_id_map, EventExtendedProperty
+from calensync.dataclass import GoogleEvent, EventStatus, event_list_to_source_id_map, EventExtendedProperty, \
+    ExtendedProperties
+from calensync.google_utils import get_recurrent_event_id
 
 
 # def create_watch(calendar: Calendar, url: str, service, db: peewee.Database, expiration_minutes: int = 120):
@@ -51,7 +53,7 @@ def events_to_update(events1: List[GoogleEvent], events2: List[GoogleEvent]) ->
     # only keep events with source_id == None (i.e. which are not original from that calendar)
     copied_events2 = event_list_to_source_id_map(events2)
     for event1 in events1:
-        if event1.start == EventStatus.cancelled:
+        if event1.status == EventStatus.cancelled:
             continue
 
         event2 = copied_events2.get(event1.id)
@@ -82,6 +84,98 @@ def events_to_delete(events1: List[GoogleEvent], events2: List[GoogleEvent]) ->
     return [e for e in events1 if e.id in events_to_delete_list]
 
 
+def copies_of_rule(rule: SyncRule, destination_events: List[GoogleEvent]) -> List[GoogleEvent]:
+    """
+    Returns the copies made by the rule among the events of its destination. The instances of a copied
+    recurrence carry the source id of the recurrence, or nothing when cancelled: they're returned with the
+    id of the matching source instance as source id instead (see get_recurrent_event_id)
+    """
+    source_calendar_uuid = str(rule.source.uuid)
+
+    def is_copy(event: GoogleEvent) -> bool:
+        private = event.extendedProperties.private or {}
+        if (rule_uuid := private.get(EventExtendedProperty.get_rule_id_key())) is not None:
+            return rule_uuid == str(rule.uuid)
+        return private.get(EventExtendedProperty.get_calendar_id_key()) == source_calendar_uuid
+
+    copied_recurrences = {e.id: e.source_id for e in destination_events if e.recurrence and is_copy(e)}
+    copies = []
+    for event in destination_events:
+        if event.recurringEventId in copied_recurrences:
+            instance = event.copy(deep=True)
+            instance.extendedProperties = ExtendedProperties(private={
+                **(event.extendedProperties.private or {}),
+                EventExtendedProperty.get_source_id_key(): get_recurrent_event_id(
+                    event.id, copied_recurrences[event.recurringEventId]
+                )
+            })
+            copies.append(instance)
+        elif is_copy(event):
+            copies.append(event)
+    return copies
+
+
+def events_to_reconcile(rule: SyncRule, source_events: List[GoogleEvent],
+                        destination_events: List[GoogleEvent]) -> List[GoogleEvent]:
+    """
+    Returns the source events which must be pushed to the rule for its destination to match the source:
+    the events without copy, the ones whose copy has a different start or end, and the cancelled or
+    declined ones which still have a copy. `source_events` and `destination_events` must be listed over
+    the same period. The rule must have its source calendar, with its account and calendars
+    """
+    originals = [e for e in source_events if not e.extendedProperties.private]
+    copies = copies_of_rule(rule, destination_events)
+    copied_ids = {e.source_id for e in copies}
+    live_copied_ids = {e.source_id for e in copies if e.status != EventStatus.cancelled}
+
+    active, declined = [], []
+    for event in originals:
+        checked = event.copy()
+        set_declined_event_if_necessary(rule, checked)
+        (declined if checked.status == EventStatus.declined else active).append(event)
+
+    to_push = events_to_add([e for e in active if e.status != EventStatus.tentative], copies)
+    updated_source_ids = {e.source_id for e in events_to_update(active, copies)}
+    to_push.extend(e for e in active if e.id in updated_source_ids)
+    to_push.extend(events_to_delete(originals, copies))
+    to_push.extend(e for e in declined if e.id in live_copied_ids)
+
+    # a cancelled instance of a copied recurrence whose copy isn't listed is still an occurrence of the copy
+    copied_recurrences = {e.source_id for e in copies if e.recurrence}
+    to_push.extend(
+        e for e in originals
+        if e.status == EventStatus.cancelled and e.recurringEventId in copied_recurrences and e.id not in copied_ids
+    )
+
+    unique = {}
+    for event in to_push:
+        unique.setdefault(event.id, event)
+    return list(unique.values())
+
+
+def recurrences_first(pages: Iterable[List[GoogleEvent]]) -> Iterator[List[GoogleEvent]]:
+    """
+    Yields the pages of events with the recurrences first, so that their instances are pushed after them.
+    The instances whose recurrence wasn't seen yet are held back until the last page: without singleEvents,
+    a listing only returns the modified instances, so few of them are kept in memory
+    """
+    seen_recurrences = set()
+    held_back = []
+    for page in pages:
+        page = sorted(page, key=lambda e: e.recurrence is None)
+        seen_recurrences.update(e.id for e in page if e.recurrence)
+        ready = []
+        for event in page:
+            if event.recurringEventId is not None and event.recurringEventId not in seen_recurrences:
+                held_back.append(event)
+            else:
+                ready.append(event)
+        if ready:
+            yield ready
+    if held_back:
+        yield held_back
+
+
 class EventsModificationHandler:
     events_to_add: List[Tuple[GoogleEvent, List[EventExtendedProperty], SyncRule]]
     """ We need both the db event (outdated copy), and the original google event, to be able to update it """
@@ -1,6 +1,9 @@
+import collections
+from typing import Iterable, Dict
+
 import peewee
 
-from calensync.database.model import Calendar, SyncRule
+from calensync.database.model import Calendar, SyncRule, CalendarAccount, User
 
 
 def get_sync_rules_from_source(calendar: Calendar):
@@ -13,3 +16,35 @@ def get_sync_rules_from_source(calendar: Calendar):
         .where(Destination.paused.is_null()),
         Calendar.select()
     )
+
+
+def get_sync_rules_with_calendars(rule_ids: Iterable[int]) -> Dict[int, SyncRule]:
+    """
+    Returns the SyncRules by id, with everything pushing an event to them walks through: source and destination
+    calendars with their account and user, and the calendars of the source account. Two queries in total
+    """
+    Source, Destination = Calendar.alias(), Calendar.alias()
+    SourceAccount, DestinationAccount = CalendarAccount.alias(), CalendarAccount.alias()
+    SourceUser, DestinationUser = User.alias(), User.alias()
+    query = (
+        SyncRule.select(SyncRule, Source, SourceAccount, SourceUser, Destination, DestinationAccount, DestinationUser)
+        .join(Source, on=(SyncRule.source == Source.id), attr="source")
+        .join(SourceAccount, on=(Source.account == SourceAccount.id), attr="account")
+        .join(SourceUser, on=(SourceAccount.user == SourceUser.id), attr="user")
+        .switch(SyncRule)
+        .join(Destination, on=(SyncRule.destination == Destination.id), attr="destination")
+        .join(DestinationAccount, on=(Destination.account == DestinationAccount.id), attr="account")
+        .join(DestinationUser, on=(DestinationAccount.user == DestinationUser.id), attr="user")
+        .where(SyncRule.id << list(rule_ids))
+    )
+    rules = {rule.id: rule for rule in query}
+
+    source_accounts = {rule.source.account.id: rule.source.account for rule in rules.values()}
+    calendars_by_account = collections.defaultdict(list)
+    if source_accounts:
+        for calendar in Calendar.select().where(Calendar.account << list(source_accounts.keys())):
+            calendars_by_account[calendar.account_id].append(calendar)
+    for rule in rules.values():
+        # same as peewee.prefetch, the backref is replaced by the list of calendars
+        rule.source.account.calendars = calendars_by_account[rule.source.account.id]
+    return rules
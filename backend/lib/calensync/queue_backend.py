@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import dataclasses
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Callable
+
+import boto3
+
+from calensync.dataclass import SQSEvent
+from calensync.log import get_logger
+from calensync.sqs import send_messages, encode_sqs_event
+from calensync.utils import is_local
+
+logger = get_logger("queue_backend")
+
+# "sqs", "inline" or "local", by default the events are handled inline when running locally without queue
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND")
+LOCAL_QUEUE_WORKERS = int(os.environ.get("LOCAL_QUEUE_WORKERS", 4))
+LOCAL_QUEUE_VISIBILITY_TIMEOUT = int(os.environ.get("LOCAL_QUEUE_VISIBILITY_TIMEOUT", 30))
+LOCAL_QUEUE_ARN = "arn:aws:sqs:local:000000000000:calensync-local"
+
+_local_queue_backend = None
+_local_queue_backend_lock = threading.Lock()
+
+
+class QueueBackend(ABC):
+    @abstractmethod
+    def send(self, sqs_events: List[SQSEvent], session: boto3.Session, db, delay: Optional[int] = None):
+        """ Queues the events, `delay` is the number of seconds before they can be received """
+        pass
+
+
+class InlineQueueBackend(QueueBackend):
+    """ Handles the events right away, in the caller's thread """
+
+    def send(self, sqs_events: List[SQSEvent], session: boto3.Session, db, delay: Optional[int] = None):
+        from calensync.api.service import handle_sqs_events
+        handle_sqs_events(sqs_events, db=db, boto_session=session)
+
+
+class SQSQueueBackend(QueueBackend):
+    def send(self, sqs_events: List[SQSEvent], session: boto3.Session, db, delay: Optional[int] = None):
+        """ Raises SQSSendException if some events couldn't be queued, the caller must not record them as synced """
+        send_messages(session, [encode_sqs_event(e) for e in sqs_events], delay=delay)
+
+
+@dataclasses.dataclass
+class LocalMessage:
+    message_id: str
+    body: str
+    sent_at: float
+    visible_at: float
+    receipt_handle: Optional[str] = None
+    receive_count: int = 0
+    first_received_at: Optional[float] = None
+
+
+def handle_local_records(records: List[Dict], db, session: boto3.Session, sqs_client) -> Dict:
+    from calensync.awslambda.sqs_receiver import handle_sqs_records
+    return handle_sqs_records(records, db, session, workers=1, sqs_client=sqs_client)
+
+
+class LocalQueueBackend(QueueBackend):
+    """
+    In-process queue behaving like SQS: the messages can be delayed, a received message is invisible until
+    it's deleted or its visibility timeout expires, and the receiver can change its visibility timeout.
+    The messages are received in batches by a pool of worker threads, and handled like the SQS receiver
+    lambda does (see handle_sqs_records). It records the queue lag, i.e. how long the messages waited
+    once visible, to measure the throughput of the pipeline without AWS
+    """
+
+    def __init__(self, workers: int = LOCAL_QUEUE_WORKERS, visibility_timeout: float = LOCAL_QUEUE_VISIBILITY_TIMEOUT,
+                 batch_size: int = 10, poll_interval: float = 0.05,
+                 handler: Callable[[List[Dict], object, boto3.Session, LocalQueueBackend], Dict] = handle_local_records):
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.handler = handler
+        self._messages: Dict[str, LocalMessage] = {}
+        # receipt handle -> message id, of the received messages
+        self._receipts: Dict[str, str] = {}
+        # (visible_at, sequence number, message id), the entries of messages which were deleted
+        # or whose visibility changed since are skipped
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._in_flight = 0
+        self._lags = []
+        self.sent = 0
+        self.deleted = 0
+
+    def send(self, sqs_events: List[SQSEvent], session: boto3.Session, db, delay: Optional[int] = None):
+        self.send_messages([encode_sqs_event(e) for e in sqs_events], delay or 0)
+        self.start(db)
+
+    def send_messages(self, bodies: List[str], delay: float = 0):
+        now = time.monotonic()
+        with self._condition:
+            for body in bodies:
+                message = LocalMessage(str(uuid.uuid4()), body, sent_at=now, visible_at=now + delay)
+                self._messages[message.message_id] = message
+                heapq.heappush(self._heap, (message.visible_at, next(self._sequence), message.message_id))
+            self.sent += len(bodies)
+            self._condition.notify_all()
+
+    def receive(self, max_messages: int = 10) -> List[Dict]:
+        """ Returns the records of up to max_messages visible messages, which become invisible """
+        now = time.monotonic()
+        records = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(records) < max_messages:
+                visible_at, _, message_id = heapq.heappop(self._heap)
+                message = self._messages.get(message_id)
+                if message is None or message.visible_at != visible_at:
+                    continue
+                if message.first_received_at is None:
+                    message.first_received_at = time.time()
+                    self._lags.append(now - message.visible_at)
+                message.receive_count += 1
+                self._receipts.pop(message.receipt_handle, None)
+                message.receipt_handle = str(uuid.uuid4())
+                self._receipts[message.receipt_handle] = message.message_id
+                self._set_visible_at(message, now + self.visibility_timeout)
+                records.append({
+                    "messageId": message.message_id,
+                    "receiptHandle": message.receipt_handle,
+                    "body": message.body,
+                    "attributes": {
+                        "ApproximateReceiveCount": str(message.receive_count),
+                        "ApproximateFirstReceiveTimestamp": str(int(message.first_received_at * 1000)),
+                    },
+                    "eventSourceARN": LOCAL_QUEUE_ARN,
+                })
+            self._in_flight += len(records)
+        return records
+
+    def _set_visible_at(self, message: LocalMessage, visible_at: float):
+        message.visible_at = visible_at
+        heapq.heappush(self._heap, (visible_at, next(self._sequence), message.message_id))
+
+    def _find(self, receipt_handle: str) -> Optional[LocalMessage]:
+        return self._messages.get(self._receipts.get(receipt_handle))
+
+    def delete_message(self, ReceiptHandle: str, QueueUrl: str = None):
+        with self._condition:
+            if (message := self._find(ReceiptHandle)) is not None:
+                del self._messages[message.message_id]
+                del self._receipts[ReceiptHandle]
+                self.deleted += 1
+                self._condition.notify_all()
+
+    def change_message_visibility(self, ReceiptHandle: str, VisibilityTimeout: int, QueueUrl: str = None):
+        """ Same as the method of the SQS client, the receiver reschedules the messages with it """
+        with self._lock:
+            if (message := self._find(ReceiptHandle)) is not None:
+                self._set_visible_at(message, time.monotonic() + VisibilityTimeout)
+
+    def start(self, db, session_factory: Callable[[], boto3.Session] = boto3.Session):
+        """ Starts the workers if they aren't running, each one has its own boto3 session """
+        with self._lock:
+            if self._threads:
+                return
+            self._stopped.clear()
+            self._threads = [
+                threading.Thread(target=self._work, args=(db, session_factory()), daemon=True,
+                                 name=f"local-queue-{i}")
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self, db, session: boto3.Session):
+        while not self._stopped.is_set():
+            records = self.receive(self.batch_size)
+            if not records:
+                self._stopped.wait(self.poll_interval)
+                continue
+
+            failed = {record['messageId'] for record in records}
+            try:
+                # peewee connections are per thread
+                with db.connection_context():
+                    response = self.handler(records, db, session, self)
+                failed = {failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])}
+            except Exception as e:
+                logger.error(f"Failed to handle records {e}\n{traceback.format_exc()}")
+
+            # the failed messages become visible again after their visibility timeout
+            for record in records:
+                if record['messageId'] not in failed:
+                    self.delete_message(record['receiptHandle'])
+            with self._condition:
+                self._in_flight -= len(records)
+                self._condition.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """ Waits until all the messages are deleted, returns False on timeout """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._messages and self._in_flight == 0, timeout)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lags = list(self._lags)
+            return {
+                "sent": self.sent,
+                "deleted": self.deleted,
+                "pending": len(self._messages),
+                "mean_lag": sum(lags) / len(lags) if lags else 0.,
+                "max_lag": max(lags, default=0.),
+            }
+
+
+def get_queue_backend() -> QueueBackend:
+    """ Backend chosen by QUEUE_BACKEND, the local one is shared by the whole process """
+    global _local_queue_backend
+    kind = QUEUE_BACKEND
+    if kind is None:
+        kind = "inline" if is_local() and os.getenv("SQS_QUEUE_URL") is None else "sqs"
+
+    if kind == "inline":
+        return InlineQueueBackend()
+    elif kind == "sqs":
+        return SQSQueueBackend()
+    elif kind == "local":
+        with _local_queue_backend_lock:
+            if _local_queue_backend is None:
+                _local_queue_backend = LocalQueueBackend()
+            return _local_queue_backend
+    raise ValueError(f"Unknown queue backend {kind}")
@@ -0,0 +1,112 @@
+import math
+import threading
+import time
+from typing import Dict
+
+import googleapiclient.errors
+import googleapiclient.http
+
+from calensync.log import get_logger
+from calensync.utils import is_rate_limit_error, is_non_blocking_backoff, BackoffException
+
+logger = get_logger(__file__)
+
+# Google Calendar allows by default 600 requests per minute and per user, the limiter starts below that
+# and goes up to it as long as no request is rate limited
+DEFAULT_RATE = 5.
+MAX_RATE = 10.
+MIN_RATE = 0.5
+RATE_INCREASE = 0.05
+BUCKET_CAPACITY = 10.
+# with non-blocking backoff, longer waits are not slept but raised as BackoffException
+MAX_NON_BLOCKING_WAIT = 1.
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket. Each request takes a token, tokens are refilled at `rate` per second up to `capacity`.
+    The rate adapts to Google: it's halved whenever a request is rate limited, and slowly increased on success.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: float = BUCKET_CAPACITY,
+                 min_rate: float = MIN_RATE, max_rate: float = MAX_RATE):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Takes the tokens, waiting until they are available. The tokens are reserved before waiting, so that
+        concurrent callers queue up instead of all waking up at the same time. Returns the time waited.
+        When the backoff is non-blocking, it raises BackoffException instead of waiting longer than
+        MAX_NON_BLOCKING_WAIT. A request bigger than the bucket (a batch) is then sent as soon as the bucket
+        is full, without waiting for the tokens above its capacity: the bucket goes into debt, which the next
+        requests pay back by backing off
+        """
+        with self._lock:
+            self._refill()
+            non_blocking = is_non_blocking_backoff()
+            if non_blocking:
+                wait = max(0., min(tokens, self.capacity) - self.tokens) / self.rate
+                if wait > MAX_NON_BLOCKING_WAIT:
+                    raise BackoffException(math.ceil(wait))
+            self.tokens -= tokens
+            if not non_blocking:
+                wait = max(0., -self.tokens / self.rate)
+
+        if wait > 0:
+            logger.info(f"Rate limiting, waiting {wait:.2f} seconds")
+            time.sleep(wait)
+        return wait
+
+    def on_rate_limited(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.)
+            logger.info(f"Rate limited by Google, lowering rate to {self.rate:.2f} requests per second")
+
+    def on_success(self, n_requests: int = 1):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE * n_requests)
+
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str) -> TokenBucket:
+    """ Returns the rate limiter of the given key (the account), shared by all the threads of the process """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = _rate_limiters[key] = TokenBucket()
+        return limiter
+
+
+class RateLimitedHttpRequest(googleapiclient.http.HttpRequest):
+    """ HttpRequest that goes through the rate limiter of its account, and feeds it the rate limit errors """
+
+    def __init__(self, rate_limiter: TokenBucket, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def execute(self, http=None, num_retries=0):
+        self.rate_limiter.acquire()
+        try:
+            response = super().execute(http=http, num_retries=num_retries)
+        except googleapiclient.errors.HttpError as e:
+            if is_rate_limit_error(e):
+                self.rate_limiter.on_rate_limited()
+            raise e
+        self.rate_limiter.on_success()
+        return response
@@ -1,34 +1,123 @@
 from __future__ import annotations
 
+import base64
+import concurrent.futures
 import datetime
 import enum
+import json
 import os
-from typing import List
+import threading
+import time
+import weakref
+import zlib
+from typing import List, Dict, Optional
 
 import boto3
+from pydantic.json import pydantic_encoder
 
 from calensync.database.model import Calendar
-from calensync.dataclass import UpdateGoogleEvent, GoogleEvent, QueueEvent, SQSEvent
+from calensync.dataclass import UpdateGoogleEvent, GoogleEvent, QueueEvent, SQSEvent, GoogleEventResponseStatus
 from calensync.log import get_logger
 from calensync.utils import utcnow, is_local
 
 logger = get_logger("sqs")
 
+_sqs_client = None
+_session_clients = weakref.WeakKeyDictionary()
+_session_clients_lock = threading.Lock()
+
+# version of the compact encoding of the messages, see encode_sqs_event. The messages without version
+# are the json of an SQSEvent
+WIRE_VERSION = 2
+# the encoded messages larger than this number of bytes are compressed, 0 never compresses them
+SQS_COMPRESSION_THRESHOLD = int(os.environ.get("SQS_COMPRESSION_THRESHOLD", 4096))
+# fields of the events which push_event_to_rule doesn't use
+UNUSED_EVENT_FIELDS = {"htmlLink", "visibility"}
+
+# limits of send_message_batch
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+# number of batches sent at the same time
+SQS_SEND_WORKERS = int(os.environ.get("SQS_SEND_WORKERS", 8))
+# attempts at sending the entries which failed, and delay before the first one, doubled at each attempt
+SQS_SEND_RETRIES = 3
+SQS_SEND_RETRY_DELAY = 0.2
+
+
+def get_sqs_client(session: boto3.Session = None):
+    """
+    SQS client kept for the lifetime of the process, or of the session if given: creating a session and
+    a client is slow. Unlike the sessions, the clients can be shared between threads
+    """
+    global _sqs_client
+    if session is not None:
+        with _session_clients_lock:
+            if (client := _session_clients.get(session)) is None:
+                client = _session_clients[session] = session.client("sqs")
+            return client
+    if _sqs_client is None:
+        _sqs_client = boto3.session.Session().client("sqs")
+    return _sqs_client
+
 
 def send_event(session, content: str):
     queue_url = os.environ["SQS_QUEUE_URL"]
-    client = session.client("sqs")
+    client = get_sqs_client(session)
     client.send_message(QueueUrl=queue_url, MessageBody=content)
 
 
-def send_batched_events(session, contents: List[str]):
-    queue_url = os.environ["SQS_QUEUE_URL"]
-    client = session.client("sqs")
-    delay = 0 if is_local() else 3
-    client.send_message_batch(
-        QueueUrl=queue_url,
-        Entries=[{"Id": str(i), "MessageBody": content, 'DelaySeconds': delay} for i, content in enumerate(contents)],
-    )
+def pack_batches(contents: List[str], max_entries: int = SQS_MAX_BATCH_ENTRIES,
+                 max_bytes: int = SQS_MAX_BATCH_BYTES) -> List[List[str]]:
+    """ Splits the messages in batches within the number of entries and size limits of send_message_batch """
+    batches = []
+    batch, batch_bytes = [], 0
+    for content in contents:
+        size = len(content.encode())
+        if batch and (len(batch) == max_entries or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        if size > max_bytes:
+            # can't be sent, it's left to send_message_batch to report it
+            logger.error(f"Message of {size} bytes is larger than the SQS limit")
+        batch.append(content)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def send_batched_events(session, contents: List[str], queue_url: str = None, delay: int = None) -> List[str]:
+    """
+    Sends a batch of messages, the entries which failed are sent again up to SQS_SEND_RETRIES times.
+    Returns the messages which couldn't be sent
+    """
+    queue_url = queue_url or os.environ["SQS_QUEUE_URL"]
+    client = get_sqs_client(session)
+    if delay is None:
+        delay = 0 if is_local() else 3
+
+    entries = {str(i): content for i, content in enumerate(contents)}
+    not_sent = []
+    for attempt in range(SQS_SEND_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(SQS_SEND_RETRY_DELAY * 2 ** (attempt - 1))
+        response = client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{"Id": i, "MessageBody": content, 'DelaySeconds': delay} for i, content in entries.items()],
+        )
+        failed = response.get("Failed", [])
+        for failure in failed:
+            if failure.get("SenderFault"):
+                logger.error(f"Can't send message: {failure.get('Code')} {failure.get('Message')}")
+        retryable = {failure["Id"] for failure in failed if not failure.get("SenderFault")}
+        not_sent.extend(entries[failure["Id"]] for failure in failed if failure.get("SenderFault"))
+        entries = {i: content for i, content in entries.items() if i in retryable}
+        if not entries:
+            return not_sent
+        logger.warning(f"Failed to send {len(entries)} messages, attempt {attempt + 1}")
+
+    logger.error(f"Gave up sending {len(entries)} messages")
+    return not_sent + list(entries.values())
 
 
 class SQSEventRun(enum.IntEnum):
@@ -50,21 +139,95 @@ def check_if_should_run_time_or_wait(calendar_db: Calendar, first_received: date
         return SQSEventRun.DELETE
 
 
+def compact_event_dict(event: GoogleEvent) -> Dict:
+    """
+    Fields of the event needed to push it to a rule: the empty and unused ones are left out, and of the
+    attendees only the ones who declined are kept (see set_declined_event_if_necessary)
+    """
+    data = event.dict(exclude_none=True, exclude=UNUSED_EVENT_FIELDS | {"attendees"})
+    declined = [attendee.dict() for attendee in event.attendees
+                if attendee.responseStatus == GoogleEventResponseStatus.declined]
+    if declined:
+        data["attendees"] = declined
+    return data
+
+
 def prepare_event_to_push(event: GoogleEvent, rule_id: int, delete: bool) -> SQSEvent:
-    event = UpdateGoogleEvent(event=event, rule_id=rule_id, delete=delete)
-    sqs_event = SQSEvent(kind=QueueEvent.UPDATED_EVENT, data=event.dict(), first_received=utcnow())
-    return sqs_event
+    update_event = UpdateGoogleEvent(event=event, rule_id=rule_id, delete=delete)
+    data = {"event": compact_event_dict(event), "rule_id": rule_id, "delete": delete}
+    # the events handled without going through the queue don't need to be parsed again
+    return SQSEvent.from_update_event(update_event, data=data, first_received=utcnow())
+
+
+def encode_sqs_event(sqs_event: SQSEvent) -> str:
+    """
+    Encodes the event as a message body, with short keys. It's compressed when larger than
+    SQS_COMPRESSION_THRESHOLD bytes, to keep the batches of messages under the size limit of SQS
+    """
+    content = {"v": WIRE_VERSION, "k": sqs_event.kind.value, "d": sqs_event.data}
+    if sqs_event.first_received is not None:
+        content["t"] = sqs_event.first_received
+    body = json.dumps(content, default=pydantic_encoder, separators=(",", ":"))
+    if 0 < SQS_COMPRESSION_THRESHOLD < len(body):
+        compressed = base64.b64encode(zlib.compress(body.encode())).decode()
+        body = json.dumps({"v": WIRE_VERSION, "z": compressed}, separators=(",", ":"))
+    return body
+
+
+def decode_sqs_event(body: str) -> SQSEvent:
+    """ Decodes a message body, either encoded by encode_sqs_event or the json of an SQSEvent """
+    content = json.loads(body)
+    if content.get("v") != WIRE_VERSION:
+        return SQSEvent.parse_obj(content)
+    if "z" in content:
+        content = json.loads(zlib.decompress(base64.b64decode(content["z"])))
+
+    if content["k"] == QueueEvent.UPDATED_EVENT.value:
+        # parsed right away, so that the data isn't validated again by each of its users
+        return SQSEvent.from_update_event(UpdateGoogleEvent.parse_obj(content["d"]), data=content["d"],
+                                          first_received=content.get("t"))
+    return SQSEvent(kind=content["k"], data=content["d"], first_received=content.get("t"))
+
+
+class SQSSendException(Exception):
+    """ Some messages couldn't be sent, even after retrying """
+
+    def __init__(self, not_sent: List[str], total: int):
+        super().__init__(f"{len(not_sent)} messages out of {total} couldn't be sent")
+        self.not_sent = not_sent
 
 
 def push_update_event_to_queue(prepared_sqs_events: List[SQSEvent], session: boto3.Session, db):
-    if is_local() and os.getenv("SQS_QUEUE_URL") is None:
-        from calensync.api.service import handle_sqs_event
-        for sqs_event in prepared_sqs_events:
-            handle_sqs_event(sqs_event=sqs_event, db=db, boto_session=session)
+    from calensync.queue_backend import get_queue_backend
+    get_queue_backend().send(prepared_sqs_events, session, db)
+
+
+def send_messages(session: boto3.Session, contents: List[str], workers: Optional[int] = None,
+                  delay: Optional[int] = None):
+    """
+    Sends the messages in as few batches as possible, several batches at the same time.
+    Raises SQSSendException with the messages which couldn't be sent, so that the caller doesn't
+    move on as if they were queued
+    """
+    queue_url = os.environ["SQS_QUEUE_URL"]
+    if delay is None:
+        delay = 0 if is_local() else 3
+    batches = pack_batches(contents)
+    logger.info(f"Sending {len(contents)} messages in {len(batches)} batches")
+    # created here, the session must not be used by several threads
+    get_sqs_client(session)
+
+    not_sent = []
+    workers = min(workers or SQS_SEND_WORKERS, len(batches))
+    if workers <= 1:
+        for batch in batches:
+            not_sent.extend(send_batched_events(session, batch, queue_url, delay))
     else:
-        batch_size = 10
-        batches = [prepared_sqs_events[i:i + batch_size] for i in range(0, len(prepared_sqs_events), batch_size)]
-        for batch_idx, batched_events in enumerate(batches):
-            batched_events: List[GoogleEvent]
-            logger.info(f"Sending batch {batch_idx} of {len(batches)}")
-            send_batched_events(session, [b.json() for b in batched_events])
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for result in executor.map(lambda b: send_batched_events(session, b, queue_url, delay), batches):
+                not_sent.extend(result)
+
+    if not_sent:
+        exception = SQSSendException(not_sent, len(contents))
+        logger.error(str(exception))
+        raise exception
@@ -6,8 +6,10 @@ import random
 import uuid
 from pathlib import Path
 from time import sleep
+from unittest.mock import MagicMock
 
 import boto3
+import googleapiclient.errors
 import pytest
 from _pytest.fixtures import fixture
 from moto import mock_aws
@@ -97,6 +99,16 @@ def uuid4():
     return str(uuid.uuid4())
 
 
+def make_http_error(status: int, reason: str = None) -> googleapiclient.errors.HttpError:
+    resp = MagicMock()
+    resp.status = status
+    resp.reason = reason
+    resp.get.return_value = 'application/json'
+    return googleapiclient.errors.HttpError(
+        resp, content=json.dumps({'error': {'errors': [{'reason': reason}]}}).encode()
+    )
+
+
 def random_dates():
     start = datetime.datetime.now() + datetime.timedelta(days=random.randint(0, 15), hours=random.randint(0, 24))
     end = start + datetime.timedelta(hours=random.randint(0, 2), minutes=random.randint(30, 59))
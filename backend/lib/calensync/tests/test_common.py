@@ -1,5 +1,7 @@
+from unittest.mock import patch
+
 from calensync.database.model import SyncRule
-from calensync.queries.common import get_sync_rules_from_source
+from calensync.queries.common import get_sync_rules_from_source, get_sync_rules_with_calendars
 from calensync.tests.fixtures import *
 from calensync.utils import utcnow
 
@@ -27,3 +29,22 @@ class TestGetSyncRulesFromSource:
         rules = get_sync_rules_from_source(calendar1_1)
         assert len(rules) == 1
         assert {r.id for r in rules} == {sr1.id}
+
+
+class TestGetSyncRulesWithCalendars:
+    def test_preloaded(self, db, user, calendar1_1, calendar1_2, calendar1_2_2, calendar1_1_2):
+        sr1 = SyncRule(source_id=calendar1_1.id, destination_id=calendar1_2.id).save_new()
+        sr2 = SyncRule(source_id=calendar1_2.id, destination_id=calendar1_2_2.id).save_new()
+
+        with patch.object(db, "execute_sql", wraps=db.execute_sql) as execute_sql:
+            rules = get_sync_rules_with_calendars([sr1.id, sr2.id, -1])
+            assert execute_sql.call_count == 2
+
+            assert set(rules.keys()) == {sr1.id, sr2.id}
+            rule = rules[sr1.id]
+            assert rule.source.id == calendar1_1.id
+            assert rule.destination.id == calendar1_2.id
+            assert rule.destination.account.user.id == user.id
+            assert {c.id for c in rule.source.account.calendars} == {calendar1_1.id, calendar1_1_2.id}
+            assert {c.id for c in rules[sr2.id].source.account.calendars} == {calendar1_2.id, calendar1_2_2.id}
+            assert execute_sql.call_count == 2
@@ -0,0 +1,60 @@
+import datetime
+
+from calensync.copy_index import DestinationCopyIndex
+from calensync.dataclass import GoogleEvent, EventStatus, GoogleDatetime, ExtendedProperties
+from calensync.utils import utcnow
+
+
+def make_event(event_id, start, source_id=None, created=None):
+    extended_properties = ExtendedProperties()
+    if source_id is not None:
+        extended_properties = ExtendedProperties(private={"source-id": source_id})
+    # new by default
+    updated = utcnow()
+    return GoogleEvent(id=event_id, status=EventStatus.confirmed, start=GoogleDatetime(dateTime=start),
+                       end=GoogleDatetime(dateTime=start + datetime.timedelta(hours=1)),
+                       extendedProperties=extended_properties, created=created or updated, updated=updated)
+
+
+class TestDestinationCopyIndex:
+    @staticmethod
+    def test_find():
+        now = utcnow()
+        index = DestinationCopyIndex([make_event("copy1", now, "source1")], now - datetime.timedelta(days=1),
+                                     now + datetime.timedelta(days=1))
+        assert [e.id for e in index.find("source1")] == ["copy1"]
+        # missing copy within the window
+        assert index.find("source2", make_event("source2", now)) == []
+        # outside of the window, or without the source event, the index can't tell
+        assert index.find("source2", make_event("source2", now + datetime.timedelta(days=2))) is None
+        assert index.find("source2") is None
+
+    @staticmethod
+    def test_moved_event():
+        now = utcnow()
+        index = DestinationCopyIndex([], now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+        # its copy is where the event was before, which wasn't listed
+        moved = make_event("source1", now, created=now - datetime.timedelta(days=7))
+        assert index.find("source1", moved) is None
+
+    @staticmethod
+    def test_copies_are_not_shared():
+        now = utcnow()
+        index = DestinationCopyIndex([make_event("copy1", now, "source1")], now, now)
+        index.find("source1")[0].id = "modified"
+        assert [e.id for e in index.find("source1")] == ["copy1"]
+
+    @staticmethod
+    def test_writes():
+        now = utcnow()
+        source = make_event("source1", now)
+        index = DestinationCopyIndex([], now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+        index.add(make_event("copy1", now, "source1"))
+        assert [e.id for e in index.find("source1", source)] == ["copy1"]
+        index.remove("copy1")
+        assert index.find("source1", source) == []
+        index.invalidate("source1")
+        assert index.find("source1", source) is None
+        index.add(make_event("copy2", now, "source1"))
+        assert len(index) == 1
+        assert [e.id for e in index.find("source1", source)] == ["copy2"]
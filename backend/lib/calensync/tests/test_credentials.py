@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+from calensync.credentials import get_credentials, invalidate_credentials
+from calensync.tests.fixtures import *
+
+
+class TestGetCredentials:
+    @staticmethod
+    def test_cached_until_credentials_change(db, account1_1, boto_session):
+        with (
+            patch("calensync.credentials.decrypt_credentials") as decrypt,
+            patch("google.oauth2.credentials.Credentials.from_authorized_user_info") as from_info
+        ):
+            from_info.side_effect = lambda _: object()
+            first = get_credentials(account1_1, boto_session)
+            assert get_credentials(account1_1, boto_session) is first
+            assert decrypt.call_count == 1
+
+            account1_1.encrypted_credentials = "new"
+            assert get_credentials(account1_1, boto_session) is not first
+            assert decrypt.call_count == 2
+
+    @staticmethod
+    def test_invalidate(db, account1_1, boto_session):
+        with (
+            patch("calensync.credentials.decrypt_credentials") as decrypt,
+            patch("google.oauth2.credentials.Credentials.from_authorized_user_info")
+        ):
+            get_credentials(account1_1, boto_session)
+            invalidate_credentials(account1_1.id)
+            get_credentials(account1_1, boto_session)
+            assert decrypt.call_count == 2
+
+    @staticmethod
+    def test_expired(db, account1_1, boto_session):
+        with (
+            patch("calensync.credentials.decrypt_credentials") as decrypt,
+            patch("google.oauth2.credentials.Credentials.from_authorized_user_info"),
+            patch("calensync.credentials.CREDENTIALS_CACHE_TTL", 0)
+        ):
+            get_credentials(account1_1, boto_session)
+            get_credentials(account1_1, boto_session)
+            assert decrypt.call_count == 2
@@ -1,5 +1,6 @@
-import dataclasses
 import datetime
+from types import SimpleNamespace
+from typing import List
 from unittest.mock import patch
 
 import boto3
@@ -7,23 +8,19 @@ from moto import mock_aws
 from moto.core import DEFAULT_ACCOUNT_ID
 from moto.ses import ses_backends
 
-from calensync.awslambda.daily_sync import sync_user_calendars_by_date, update_watches, \
-    get_users_query_with_active_sync_rules, send_trial_finishing_email, get_trial_users_with_create_before_date
-from calensync.database.model import SyncRule
-from calensync.dataclass import GoogleDatetime, AbstractGoogleDate, EventStatus
+from calensync.awslambda.daily_sync import update_watches, \
+    get_users_query_with_active_sync_rules, send_trial_finishing_email, get_trial_users_with_create_before_date, \
+    WATCH_EXPIRATION_MINUTES, WATCH_EXPIRATION_JITTER_MINUTES, dispatch_daily_sync, run_daily_sync, \
+    sync_single_user_calendar_by_date
+from calensync.awslambda.sqs_receiver import handle_sqs_records
+from calensync.database.model import SyncRule, DailySyncRun, DailySyncStepStatus
+from calensync.dataclass import GoogleDatetime, EventStatus, QueueEvent, DailySyncEvent, SQSEvent, \
+    GoogleEvent, ExtendedProperties
+from calensync.sqs import decode_sqs_event
 from calensync.tests.fixtures import *
 from calensync.utils import utcnow, INVALID_GRANT_ERROR
 
 
-@dataclasses.dataclass
-class MockEvent:
-    id: str
-    source_id: str
-    start: AbstractGoogleDate
-    end: AbstractGoogleDate
-    status = EventStatus.confirmed
-
-
 def test_get_users_query_with_active_calendar(user, account1_1, calendar1_1, calendar1_2, boto_session):
     user2 = User().save_new()
     user2_account = CalendarAccount(
@@ -42,112 +39,179 @@ def test_get_users_query_with_active_calendar(user, account1_1, calendar1_1, cal
     assert result[0].id == user.id
 
 
-def test_daily_sync(db, user, account1_1, calendar1_1: Calendar, account1_2, calendar1_2: Calendar, boto_session):
+def test_sync_single_user_only_queues_differences(db, user, account1_1, calendar1_1, calendar1_2, calendar1_2_2,
+                                                  boto_session):
+    rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+    # its destination isn't loaded, e.g. paused
+    SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+
+    start = datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc)
+
+    def make_event(event_id: str, **kwargs):
+        return GoogleEvent(id=event_id, status=EventStatus.confirmed, start=GoogleDatetime(dateTime=start),
+                           end=GoogleDatetime(dateTime=start + datetime.timedelta(hours=1)), **kwargs)
+
+    copied, new = make_event("copied"), make_event("new")
+    copy = make_event("copy", extendedProperties=ExtendedProperties.from_sources(
+        "copied", str(calendar1_1.uuid), str(rule.uuid)))
+    wrappers = [
+        SimpleNamespace(calendar_db=calendar1_1, events=[copied, new], db=db),
+        SimpleNamespace(calendar_db=calendar1_2, events=[copy], db=db),
+    ]
+
     with (
-        patch("calensync.gwrapper.insert_event") as insert_event,
-        patch("calensync.gwrapper.get_events") as get_events,
-        patch("calensync.awslambda.daily_sync.service_from_account") as service_from_account
+        patch("calensync.awslambda.daily_sync.load_calendars", return_value=(wrappers, set())),
+        patch("calensync.awslambda.daily_sync.push_update_event_to_queue") as push_update_event_to_queue
     ):
+        assert sync_single_user_calendar_by_date(user, start, start, boto_session) == 1
 
-        calendar1_1.active = True
-        calendar1_1.save()
-        calendar1_2.active = True
-        calendar1_2.save()
-        calendar3 = Calendar(account=account1_2, platform_id="platform3", name="name3", active=True).save_new()
-        calendar3.save()
-
-        source_ids = ["1", "2", "3"]
-        times = [(13, 14), (13, 15), (17, 18)]
-
-        service_from_account.return_value = "fake"
-
-        insert_iteration = [0, 0, 0]
-
-        def mock_insert_event(*args, **kwargs):
-            calendar_id = kwargs["calendar_id"]
-            if calendar_id == calendar1_1.platform_id:
-                insert_iteration[0] += 1
-                return {"id": f"e1_{insert_iteration[0]}"}
-            elif calendar_id == calendar1_2.platform_id:
-                insert_iteration[1] += 1
-                return {"id": f"e2_{insert_iteration[1]}"}
-            elif calendar_id == calendar3.platform_id:
-                insert_iteration[2] += 1
-                return {"id": f"e3_{insert_iteration[2]}"}
-
-        insert_event.side_effect = mock_insert_event
-
-        # use an array instead of int because updating an int would only update the reference
-        iteration = [0]
-
-        def mock_get_events(_, __, s, ___, ____):
-            def make_event(source_id, time):
-                event_start = datetime.datetime.fromtimestamp(s.timestamp())
-                event_start.replace(hour=time[0])
-                event_end = datetime.datetime.fromtimestamp(s.timestamp())
-                event_end.replace(hour=time[1])
-
-                return MockEvent(source_id, "source_" + source_id, GoogleDatetime(dateTime=event_start),
-                                 GoogleDatetime(dateTime=event_end))
-
-            if iteration[0] == 0:
-                events = [make_event(source_ids[0], times[0])]
-            elif iteration[0] == 1:
-                events = [make_event(s, t) for s, t in zip(source_ids[1:], times[1:])]
-            else:
-                events = []
-            iteration[0] += 1
-            return events
-
-        get_events.side_effect = mock_get_events
-
-        sync_user_calendars_by_date(db, boto_session)
-
-        # events = list(Event.select().where(Event.calendar_id == calendar1_1.id, Event.source.is_null(False)))
-        # assert len(events) == 2
-        # assert next(filter(lambda x: x.source.event_id == "2", events))
-        # assert next(filter(lambda x: x.source.event_id == "3", events))
-        #
-        # events = list(Event.select().where(Event.calendar_id == calendar1_2.id, Event.source.is_null(False)))
-        # assert len(events) == 1
-        # assert next(filter(lambda x: x.source.event_id == "1", events))
-        #
-        # events = list(Event.select().where(Event.calendar_id == calendar3.id, Event.source.is_null(False)))
-        # assert len(events) == 3
-        # assert next(filter(lambda x: x.source.event_id == "1", events))
-        # assert next(filter(lambda x: x.source.event_id == "2", events))
-        # assert next(filter(lambda x: x.source.event_id == "3", events))
-        #
-        # # reset and retry: nothing should happen
-        # iteration = [0]
-        # insert_iteration = [0, 0, 0]
-        # sync_user_calendars_by_date(db)
-        # events = list(Event.select().where(Event.calendar_id == calendar1_1.id, Event.source.is_null(False)))
-        # assert len(events) == 2
-        # events = list(Event.select().where(Event.calendar_id == calendar1_2.id, Event.source.is_null(False)))
-        # assert len(events) == 1
-        # events = list(Event.select().where(Event.calendar_id == calendar3.id, Event.source.is_null(False)))
-        # assert len(events) == 3
-
-
-def test_sync_user_calendars_by_date_multiple_users(db, user, account1_1, calendar1_1: Calendar, account1_2,
-                                                    calendar1_2: Calendar, boto_session):
-    user2 = User(email="tes@t.io", is_admin=True, tos=datetime.datetime.now()).save_new()
-    account1_2_1 = CalendarAccount(user=user2, key="wat",
-                                   encrypted_credentials=encrypt_credentials({}, boto_session)).save_new()
-    c2_1 = Calendar(account=account1_2_1, platform_id="platform2_1", name="name2_1").save_new()
-    c2_2 = Calendar(account=account1_2_1, platform_id="platform2_2", name="name2_2").save_new()
-    SyncRule(source=c2_1, destination=c2_2, private=True).save_new()
+    [sqs_events] = push_update_event_to_queue.call_args.args[:1]
+    [e] = [sqs_event.get_update_event() for sqs_event in sqs_events]
+    assert e.rule_id == rule.id
+    assert e.event.id == "new"
+
+
+def test_sync_single_user_destination_listing_failed(db, user, account1_1, calendar1_1, calendar1_2, boto_session):
     SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+    start = datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc)
+    source_events = [
+        GoogleEvent(id=str(i), status=EventStatus.confirmed, start=GoogleDatetime(dateTime=start),
+                    end=GoogleDatetime(dateTime=start + datetime.timedelta(hours=1)))
+        for i in range(3)
+    ]
+
+    def mock_get_events(service, google_id, *args, **kwargs):
+        if google_id == calendar1_2.platform_id:
+            raise make_http_error(503)
+        return source_events
 
     with (
-        patch("calensync.awslambda.daily_sync.load_calendars") as load_calendars,
-        patch("calensync.awslambda.daily_sync.GoogleCalendarWrapper") as wrapper
+        patch("calensync.awslambda.daily_sync.get_account_service"),
+        patch("calensync.gwrapper.get_events", side_effect=mock_get_events),
+        patch("calensync.awslambda.daily_sync.push_update_event_to_queue") as push_update_event_to_queue
     ):
-        load_calendars.return_value = []
-        sync_user_calendars_by_date(db, boto_session)
-        assert load_calendars.call_count == 2
-        assert wrapper.call_count == 0
+        # the destination isn't known to be empty, nothing is queued
+        assert sync_single_user_calendar_by_date(user, start, start, boto_session) == 0
+    assert push_update_event_to_queue.call_count == 0
+
+
+class TestDispatchDailySync:
+    @staticmethod
+    def test_one_message_per_user(db, user, account1_1, calendar1_1, calendar1_2, calendar1_2_2, boto_session,
+                                  queue_url):
+        user2 = User().save_new()
+        account2 = CalendarAccount(user=user2, key="key2",
+                                   encrypted_credentials=encrypt_credentials({}, boto_session)).save_new()
+        Calendar(account=account2, platform_id="platform2", name="name2").save_new()
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+
+        with patch("calensync.queue_backend.QUEUE_BACKEND", "sqs"):
+            assert dispatch_daily_sync(db, boto_session) == 1
+
+        [message] = boto_session.client("sqs").receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+        sqs_event = decode_sqs_event(message["Body"])
+        assert sqs_event.kind == QueueEvent.DAILY_SYNC
+        event = DailySyncEvent.parse_obj(sqs_event.data)
+        assert event.user_id == user.id
+        assert event.end_date - event.start_date == datetime.timedelta(days=14, seconds=1)
+
+    @staticmethod
+    def test_handled_by_receiver(db, user, account1_1, calendar1_1, calendar1_2, boto_session):
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        start_date = datetime.datetime(2024, 1, 1)
+        end_date = start_date + datetime.timedelta(days=14)
+        records = [
+            {"messageId": str(user_id), "receiptHandle": str(user_id), "attributes": {},
+             "body": SQSEvent(kind=QueueEvent.DAILY_SYNC,
+                              data=DailySyncEvent(user_id=user_id, start_date=start_date, end_date=end_date).dict()
+                              ).json()}
+            for user_id in [user.id, -1]
+        ]
+
+        with patch("calensync.awslambda.daily_sync.sync_single_user_calendar_by_date") as sync_user:
+            assert handle_sqs_records(records, db, boto_session) == {"batchItemFailures": []}
+            assert sync_user.call_count == 1
+            synced_user, synced_start, synced_end, _ = sync_user.call_args.args
+            assert synced_user.id == user.id
+            assert {c.id for a in synced_user.accounts for c in a.calendars} == {calendar1_1.id, calendar1_2.id}
+            assert (synced_start, synced_end) == (start_date, end_date)
+
+            # the failed syncs are retried by the queue
+            sync_user.side_effect = Exception("failed")
+            assert handle_sqs_records(records[:1], db, boto_session) == {
+                "batchItemFailures": [{"itemIdentifier": str(user.id)}]
+            }
+
+
+class TestRunDailySync:
+    @staticmethod
+    def make_users_with_rules(boto_session, n: int) -> List[User]:
+        users = []
+        for i in range(n):
+            user = User().save_new()
+            account = CalendarAccount(user=user, key=f"key{i}",
+                                      encrypted_credentials=encrypt_credentials({}, boto_session)).save_new()
+            source = Calendar(account=account, platform_id=f"source{i}", name="source").save_new()
+            destination = Calendar(account=account, platform_id=f"destination{i}", name="destination").save_new()
+            SyncRule(source=source, destination=destination, private=True).save_new()
+            users.append(user)
+        return users
+
+    @staticmethod
+    def test_resumed(db, boto_session):
+        users = TestRunDailySync.make_users_with_rules(boto_session, 3)
+        queued = []
+
+        def send(sqs_events, *args, **kwargs):
+            if len(queued) == 1:
+                raise Exception("interrupted")
+            queued.extend(DailySyncEvent.parse_obj(e.data).user_id for e in sqs_events)
+
+        day = datetime.date(2024, 1, 1)
+        with (
+            patch("calensync.awslambda.daily_sync.DAILY_SYNC_DISPATCH_BATCH", 1),
+            patch("calensync.awslambda.daily_sync.get_queue_backend") as get_queue_backend,
+            patch("calensync.awslambda.daily_sync.update_watches") as update_watches,
+            patch("calensync.awslambda.daily_sync.send_trial_finishing_email") as send_trial_finishing_email,
+        ):
+            get_queue_backend.return_value.send.side_effect = send
+            progress = run_daily_sync(db, boto_session, day)
+            assert progress["users_queued"] == 1
+            assert progress["cursor"] == users[0].id
+            assert progress["steps"] == {"calendar_sync": "FAILED", "watch_renewal": "DONE", "trial_emails": "DONE"}
+            assert progress["finished"] is None
+
+            get_queue_backend.return_value.send.side_effect = lambda sqs_events, *args, **kwargs: queued.extend(
+                DailySyncEvent.parse_obj(e.data).user_id for e in sqs_events
+            )
+            progress = run_daily_sync(db, boto_session, day)
+            assert progress["users_queued"] == 3
+            assert progress["steps"] == {"calendar_sync": "DONE", "watch_renewal": "DONE", "trial_emails": "DONE"}
+            assert progress["finished"] is not None
+
+            # the steps already done aren't run again
+            run_daily_sync(db, boto_session, day)
+            assert queued == [user.id for user in users]
+            assert update_watches.call_count == 1
+            assert send_trial_finishing_email.call_count == 1
+
+        run = DailySyncRun.get(DailySyncRun.day == day)
+        assert run.calendar_sync == DailySyncStepStatus.DONE
+        assert run.cursor == users[-1].id
+
+    @staticmethod
+    def test_dates_of_the_run(db, boto_session):
+        TestRunDailySync.make_users_with_rules(boto_session, 1)
+        run = DailySyncRun(day=datetime.date(2024, 1, 1)).save_new()
+        with patch("calensync.awslambda.daily_sync.get_queue_backend") as get_queue_backend:
+            assert dispatch_daily_sync(db, boto_session, run) == 1
+            [sqs_event] = get_queue_backend.return_value.send.call_args.args[0]
+
+        event = DailySyncEvent.parse_obj(sqs_event.data)
+        assert event.start_date == datetime.datetime(2023, 12, 31, 23, 59, 59)
+        assert event.end_date == datetime.datetime(2024, 1, 15)
+        assert run.users_queued == 1
 
 
 class TestUpdateWatches:
@@ -166,7 +230,7 @@ class TestUpdateWatches:
             patch("calensync.gwrapper.GoogleCalendarWrapper.create_watch") as create_watch,
             patch("calensync.gwrapper.GoogleCalendarWrapper.delete_watch") as delete_watch,
         ):
-            update_watches(db)
+            assert update_watches(db) == 1
             assert create_watch.call_count == 1
             assert delete_watch.call_count == 1
 
@@ -239,6 +303,44 @@ class TestUpdateWatches:
             assert create_watch.call_count == 0
             assert delete_watch.call_count == 0
 
+    @staticmethod
+    def test_calendar_renewed_once(db, calendar1_1: Calendar, calendar1_2: Calendar, calendar1_2_2: Calendar):
+        calendar1_1.expiration = utcnow() + datetime.timedelta(hours=35)
+        calendar1_1.save()
+
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.create_watch") as create_watch,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.delete_watch") as delete_watch,
+        ):
+            update_watches(db)
+            assert create_watch.call_count == 1
+            assert delete_watch.call_count == 1
+            # the new expirations are spread
+            expiration_minutes = create_watch.call_args.args[0]
+            assert (WATCH_EXPIRATION_MINUTES - WATCH_EXPIRATION_JITTER_MINUTES
+                    <= expiration_minutes <= WATCH_EXPIRATION_MINUTES)
+
+    @staticmethod
+    def test_reregister_all(db, calendar1_1: Calendar, calendar1_2: Calendar):
+        calendar1_1.expiration = utcnow() + datetime.timedelta(days=10)
+        calendar1_1.save()
+
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.create_watch") as create_watch,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.delete_watch") as delete_watch,
+        ):
+            update_watches(db)
+            assert create_watch.call_count == 0
+
+            update_watches(db, reregister_all=True)
+            assert create_watch.call_count == 1
+            assert delete_watch.call_count == 1
+
 
 class TestTrialEmail:
     @staticmethod
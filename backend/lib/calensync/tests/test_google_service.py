@@ -0,0 +1,52 @@
+import threading
+from unittest.mock import patch
+
+import httplib2
+from googleapiclient import discovery_cache
+
+from calensync.google_service import get_discovery_document, build_calendar_service, build_oauth2_service, \
+    get_http_transport, MAX_POOLED_TRANSPORTS
+
+
+class TestBuildService:
+    @staticmethod
+    def test_document_parsed_once():
+        get_discovery_document.cache_clear()
+        with patch("calensync.google_service.discovery_cache.get_static_doc",
+                   wraps=discovery_cache.get_static_doc) as get_static_doc:
+            build_calendar_service(http=httplib2.Http())
+            build_calendar_service(http=httplib2.Http())
+            assert get_static_doc.call_count == 1
+
+    @staticmethod
+    def test_services_usable():
+        calendar = build_calendar_service(http=httplib2.Http())
+        request = calendar.events().list(calendarId="primary")
+        assert request.uri.startswith("https://www.googleapis.com/calendar/v3/calendars/primary/events")
+
+        oauth2 = build_oauth2_service(http=httplib2.Http())
+        assert oauth2.userinfo().get().uri.startswith("https://www.googleapis.com/oauth2/v2/userinfo")
+
+
+class TestGetHttpTransport:
+    @staticmethod
+    def test_reused_in_same_thread():
+        assert get_http_transport("account1") is get_http_transport("account1")
+        assert get_http_transport("account1") is not get_http_transport("account2")
+
+    @staticmethod
+    def test_one_transport_per_thread():
+        transports = []
+        thread = threading.Thread(target=lambda: transports.append(get_http_transport("account1")))
+        thread.start()
+        thread.join()
+        assert transports[0] is not get_http_transport("account1")
+
+    @staticmethod
+    def test_bounded():
+        first = get_http_transport("first")
+        with patch.object(first, "close") as close:
+            for i in range(MAX_POOLED_TRANSPORTS):
+                get_http_transport(f"other-{i}")
+            assert close.call_count == 1
+        assert get_http_transport("first") is not first
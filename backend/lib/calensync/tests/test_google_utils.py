@@ -1,4 +1,4 @@
-from calensync.google_utils import get_recurrent_event_id
+from calensync.google_utils import get_recurrent_event_id, copy_event_id
 
 
 class TestGetRecurrentEventId:
@@ -12,3 +12,23 @@ class TestGetRecurrentEventId:
         result = get_recurrent_event_id("_123_334", '321')
         assert result == "321_334"
 
+
+
+class TestCopyEventId:
+    @staticmethod
+    def test_deterministic():
+        copy_id = copy_event_id("rule1", "source1")
+        assert copy_id == copy_event_id("rule1", "source1")
+        assert copy_id != copy_event_id("rule2", "source1")
+        assert copy_id != copy_event_id("rule1", "source2")
+
+    @staticmethod
+    def test_known_id():
+        # the ids of existing copies must never change
+        assert copy_event_id("rule1", "source1") == "fg2am5baj8285gk0ih7hdpet2bot9pp7ahgnroef9dboj0mlj7mg"
+
+    @staticmethod
+    def test_base32hex():
+        copy_id = copy_event_id("rule1", "_123_20200103")
+        assert 5 <= len(copy_id) <= 1024
+        assert set(copy_id) <= set("0123456789abcdefghijklmnopqrstuv")
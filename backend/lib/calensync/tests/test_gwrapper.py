@@ -7,12 +7,15 @@ from googleapiclient.errors import HttpError
 from calensync.api.tests.util import simulate_sqs_receiver
 from calensync.database.model import SyncRule
 from calensync.dataclass import GoogleDatetime, EventStatus, ExtendedProperties, EventExtendedProperty
-from calensync.gwrapper import GoogleCalendarWrapper, make_summary_and_description, handle_refresh_error
+from calensync.gwrapper import GoogleCalendarWrapper, make_summary_and_description, handle_refresh_error, \
+    source_event_tuple, COPY_LOOKUP_FIELDS, get_account_service, get_calendar_wrapper
+from calensync.copy_index import DestinationCopyIndex
+from calensync.google_utils import copy_event_id
 from calensync.libcalendar import PushToQueueException
 from calensync.log import get_logger
 from calensync.tests.fixtures import *
 from calensync.tests.mock_service import MockedService
-from calensync.utils import utcnow, INVALID_GRANT_ERROR
+from calensync.utils import utcnow, INVALID_GRANT_ERROR, format_calendar_text
 
 logger = get_logger(__file__)
 
@@ -37,6 +40,13 @@ def test_google_wrapper_class(db, calendar1_1, events_fixture):
     assert len(events) > 1
 
 
+def test_get_events_fields_mask(db, calendar1_1):
+    service = make_list_service([{}])
+    wrapper = GoogleCalendarWrapper(calendar_db=calendar1_1, service=service)
+    assert wrapper.get_events(fields=COPY_LOOKUP_FIELDS) == []
+    assert service.events.return_value.list.call_args.kwargs["fields"] == COPY_LOOKUP_FIELDS
+
+
 def test_get_events_pagination(db, calendar1_1, events_fixture):
     number_of_events_in_fixture = len(events_fixture["items"])
     event_instances = Mock()
@@ -663,4 +673,406 @@ class TestCreateWatch:
         assert result is None
         assert calendar1_1.active == True
         assert 3590 < (calendar1_1.expiration - datetime.datetime.now()).seconds < 3600
-        mock_create_google_watch.assert_not_called()
\ No newline at end of file
+        mock_create_google_watch.assert_not_called()
+
+class TestBatchedModifications:
+    @staticmethod
+    def test_delete_events_batch(calendar1_1, calendar1_2):
+        rule = SyncRule(source_id=calendar1_1.id, destination_id=calendar1_2.id).save_new()
+        copies = [
+            GoogleEvent(id=str(i), status=EventStatus.confirmed,
+                        extendedProperties=ExtendedProperties.from_sources(f"s{i}", str(calendar1_1.uuid),
+                                                                           str(rule.uuid)))
+            for i in range(3)
+        ]
+        wrapper = GoogleCalendarWrapper(calendar1_2, service=MagicMock())
+        wrapper.events_handler.delete(copies)
+
+        with patch("calensync.gwrapper.google_batch_with_backoff") as batch_with_backoff:
+            batch_with_backoff.side_effect = lambda service, requests, calendar_db: {k: {} for k in requests}
+            wrapper.delete_events(batch=True)
+
+            assert batch_with_backoff.call_count == 1
+            assert set(batch_with_backoff.call_args.args[1].keys()) == {"0", "1", "2"}
+            assert wrapper.events_handler.events_to_delete == []
+
+    @staticmethod
+    def test_insert_events_batch_recurrence_first(calendar1_1, calendar1_2):
+        rule = SyncRule(source_id=calendar1_1.id, destination_id=calendar1_2.id).save_new()
+        start = GoogleDatetime(dateTime=utcnow() + datetime.timedelta(days=1))
+        end = GoogleDatetime(dateTime=utcnow() + datetime.timedelta(days=1, hours=1))
+        single = GoogleEvent(id="1", status=EventStatus.confirmed, start=start, end=end)
+        recurrent = GoogleEvent(id="2", status=EventStatus.confirmed, start=start, end=end,
+                                recurrence=["RRULE:FREQ=DAILY"])
+
+        wrapper = GoogleCalendarWrapper(calendar1_2, service=MagicMock())
+        wrapper.events_handler.add([
+            source_event_tuple(single, str(calendar1_1.uuid), rule),
+            source_event_tuple(recurrent, str(calendar1_1.uuid), rule)
+        ], rule)
+
+        with patch("calensync.gwrapper.google_batch_with_backoff") as batch_with_backoff:
+            batch_with_backoff.side_effect = lambda service, requests, calendar_db: {k: {} for k in requests}
+            assert wrapper.insert_events(batch=True) == 2
+
+            assert batch_with_backoff.call_count == 2
+            root_body = wrapper.service.events.return_value.insert.call_args_list[0].kwargs["body"]
+            assert root_body["recurrence"] == ["RRULE:FREQ=DAILY"]
+            assert wrapper.events_handler.events_to_add == []
+
+
+def make_list_service(responses):
+    service = MagicMock()
+    service.events.return_value.list.return_value.execute.side_effect = responses
+    service.events.return_value.list_next.return_value = None
+    return service
+
+
+def make_list_item(event_id, updated):
+    return {"id": event_id, "status": "confirmed", "updated": updated.isoformat()}
+
+
+class TestGetUpdatedEvents:
+    @staticmethod
+    def test_first_listing_stores_token(calendar1_1):
+        calendar1_1.last_processed = utcnow() - datetime.timedelta(minutes=10)
+        calendar1_1.save()
+        items = [
+            make_list_item("old", utcnow() - datetime.timedelta(days=1)),
+            make_list_item("new", utcnow()),
+        ]
+        service = make_list_service([{"items": items, "nextSyncToken": "token1"}])
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        events = wrapper.get_updated_events()
+        assert [e.id for e in events] == ["new"]
+        assert calendar1_1.refresh().sync_token == "token1"
+        list_kwargs = service.events.return_value.list.call_args.kwargs
+        assert "syncToken" not in list_kwargs
+        assert list_kwargs["showDeleted"]
+
+    @staticmethod
+    def test_incremental_listing(calendar1_1):
+        calendar1_1.sync_token = "token1"
+        calendar1_1.save()
+        items = [make_list_item("1", utcnow() - datetime.timedelta(days=10))]
+        service = make_list_service([{"items": items, "nextSyncToken": "token2"}])
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        events = wrapper.get_updated_events()
+        assert [e.id for e in events] == ["1"]
+        list_kwargs = service.events.return_value.list.call_args.kwargs
+        assert list_kwargs["syncToken"] == "token1"
+        assert "timeMin" not in list_kwargs
+        assert calendar1_1.refresh().sync_token == "token2"
+
+    @staticmethod
+    def test_incremental_listing_within_window(calendar1_1):
+        calendar1_1.sync_token = "token1"
+        calendar1_1.save()
+
+        def make_item(event_id, start, **kwargs):
+            start = start.isoformat()
+            return {**make_list_item(event_id, utcnow()), "start": {"dateTime": start}, "end": {"dateTime": start},
+                    **kwargs}
+
+        items = [
+            make_item("past", utcnow() - datetime.timedelta(days=60)),
+            make_item("far", utcnow() + datetime.timedelta(days=10 * 365)),
+            make_item("recurrence", utcnow() - datetime.timedelta(days=60), recurrence=["RRULE:FREQ=WEEKLY"]),
+            make_item("soon", utcnow() + datetime.timedelta(days=1)),
+            {"id": "deleted", "status": "cancelled"},
+        ]
+        service = make_list_service([{"items": items, "nextSyncToken": "token2"}])
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        events = wrapper.get_updated_events()
+        assert [e.id for e in events] == ["recurrence", "soon", "deleted"]
+
+    @staticmethod
+    def test_recurrence_pushed_before_instances_across_pages(calendar1_1, calendar1_2):
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        calendar1_1.sync_token = "token1"
+        calendar1_1.save()
+        # the instance was modified along with its recurrence, which is on the next page
+        instance = {**make_list_item("root_20240102", utcnow()), "recurringEventId": "root"}
+        root = {**make_list_item("root", utcnow()), "recurrence": ["RRULE:FREQ=DAILY"]}
+        service = make_list_service([{"items": [instance, make_list_item("single", utcnow())]}])
+        second_page = MagicMock()
+        second_page.execute.return_value = {"items": [root], "nextSyncToken": "token2"}
+        service.events.return_value.list_next.side_effect = [second_page, None]
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        with patch("calensync.gwrapper.push_update_event_to_queue") as push_update_event_to_queue:
+            assert wrapper.solve_update_in_calendar() == 3
+        pushed = [
+            sqs_event.get_update_event().event.id
+            for c in push_update_event_to_queue.call_args_list for sqs_event in c.args[0]
+        ]
+        assert pushed == ["single", "root", "root_20240102"]
+
+    @staticmethod
+    def test_expired_token_full_sync(calendar1_1):
+        calendar1_1.sync_token = "token1"
+        calendar1_1.save()
+        gone = HttpError(resp=MagicMock(status=410, get=lambda x, y: ''), content=b'')
+        items = [make_list_item("1", utcnow() - datetime.timedelta(days=10))]
+        service = make_list_service([gone, {"items": items, "nextSyncToken": "token2"}])
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        events = wrapper.get_updated_events()
+        # full re-sync, even old events must be processed again
+        assert [e.id for e in events] == ["1"]
+        assert "syncToken" not in service.events.return_value.list.call_args.kwargs
+        assert calendar1_1.refresh().sync_token == "token2"
+
+    @staticmethod
+    def test_token_saved_after_last_page(calendar1_1):
+        calendar1_1.sync_token = "token1"
+        calendar1_1.save()
+        service = make_list_service([{"items": [make_list_item("1", utcnow())]}])
+        second_page = MagicMock()
+        second_page.execute.return_value = {"items": [make_list_item("2", utcnow())], "nextSyncToken": "token2"}
+        service.events.return_value.list_next.side_effect = [second_page, None]
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        pages = wrapper.iter_updated_event_pages()
+        assert [e.id for e in next(pages)] == ["1"]
+        assert service.events.return_value.list_next.call_count == 1
+        assert calendar1_1.refresh().sync_token == "token1"
+        assert [e.id for e in next(pages)] == ["2"]
+        assert next(pages, None) is None
+        assert calendar1_1.refresh().sync_token == "token2"
+
+
+class TestIterEventPages:
+    @staticmethod
+    def test_pages_fetched_lazily(calendar1_1):
+        service = make_list_service([{"items": [make_list_item("1", utcnow())]}])
+        second_page = MagicMock()
+        second_page.execute.return_value = {"items": [make_list_item("2", utcnow())]}
+        service.events.return_value.list_next.side_effect = [second_page, None]
+        wrapper = GoogleCalendarWrapper(calendar1_1, service=service)
+
+        pages = wrapper.iter_event_pages()
+        assert [e.id for e in next(pages)] == ["1"]
+        assert second_page.execute.call_count == 0
+        assert [e.id for e in next(pages)] == ["2"]
+        assert next(pages, None) is None
+
+
+class TestCopyIndex:
+    @staticmethod
+    def test_push_event_to_rule_uses_index(db, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        now = utcnow()
+        event = GoogleEvent(id="source1", status=EventStatus.confirmed, created=now, updated=now,
+                            start=GoogleDatetime(dateTime=now), end=GoogleDatetime(dateTime=now))
+        copy_index = DestinationCopyIndex([], now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events") as get_events,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.insert_event") as insert_event,
+        ):
+            insert_event.return_value = {
+                "id": "copy1", "status": "confirmed", "extendedProperties": {"private": {"source-id": "source1"}}
+            }
+            # the source event is modified when queued for insertion
+            GoogleCalendarWrapper.push_event_to_rule(event.copy(deep=True), rule, copy_index=copy_index)
+            assert insert_event.call_count == 1
+            assert get_events.call_count == 0
+            assert [e.id for e in copy_index.find("source1", event)] == ["copy1"]
+
+            # the copy now exists, nothing to do
+            assert GoogleCalendarWrapper.push_event_to_rule(event.copy(deep=True), rule, copy_index=copy_index) == 0
+            assert get_events.call_count == 0
+            assert insert_event.call_count == 1
+
+    @staticmethod
+    def test_moved_event_not_duplicated(db, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        now = utcnow()
+        event = GoogleEvent(id="source1", status=EventStatus.confirmed, created=now - datetime.timedelta(days=7),
+                            updated=now, start=GoogleDatetime(dateTime=now), end=GoogleDatetime(dateTime=now))
+        # the copy is a week earlier, where the event was before being moved, so it's not in the index
+        old_start = GoogleDatetime(dateTime=now - datetime.timedelta(days=7))
+        copy = GoogleEvent(id="copy1", status=EventStatus.confirmed, start=old_start, end=old_start,
+                           extendedProperties=ExtendedProperties(private={"source-id": "source1"}))
+        copy_index = DestinationCopyIndex([], now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events") as get_events,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.insert_event") as insert_event,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.update_events") as update_events,
+        ):
+            get_events.return_value = [copy]
+            GoogleCalendarWrapper.push_event_to_rule(event, rule, copy_index=copy_index)
+            assert get_events.call_count == 1
+            assert insert_event.call_count == 0
+            assert update_events.call_count == 1
+
+    @staticmethod
+    def test_build_copy_index(db, calendar1_1, calendar1_2):
+        now = utcnow()
+        copy = {"id": "copy1", "status": "confirmed", "start": {"dateTime": now.isoformat()},
+                "extendedProperties": {"private": {"source-id": "source1"}}}
+        service = make_list_service([{"items": [copy]}])
+        wrapper = GoogleCalendarWrapper(calendar1_2, service=service)
+
+        copy_index = wrapper.build_copy_index(str(calendar1_1.uuid), now, now + datetime.timedelta(days=1))
+        assert [e.id for e in copy_index.find("source1")] == ["copy1"]
+        list_kwargs = service.events.return_value.list.call_args.kwargs
+        assert list_kwargs["privateExtendedProperty"] == [f"calendar-id={calendar1_1.uuid}"]
+
+        service.events.return_value.list.return_value.execute.side_effect = HttpError(
+            resp=MagicMock(status=500, get=lambda x, y: ''), content=b'')
+        assert wrapper.build_copy_index(str(calendar1_1.uuid), now, now) is None
+
+
+class TestDeterministicCopyIds:
+    @staticmethod
+    def make_event(status=EventStatus.confirmed, created_delta=datetime.timedelta(0)):
+        now = utcnow()
+        return GoogleEvent(id="source1", status=status, created=now - created_delta, updated=now,
+                           start=GoogleDatetime(dateTime=now), end=GoogleDatetime(dateTime=now))
+
+    @staticmethod
+    def test_insert_conflict_patches(db, calendar1_1, calendar1_2, monkeypatch):
+        monkeypatch.setenv("DETERMINISTIC_COPY_IDS", "true")
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        event = TestDeterministicCopyIds.make_event()
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events", return_value=[]),
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service") as service,
+            patch("calensync.gwrapper.insert_event") as insert_event,
+        ):
+            insert_event.side_effect = make_http_error(409)
+            GoogleCalendarWrapper.push_event_to_rule(event, rule)
+
+            copy_id = copy_event_id(str(rule.uuid), "source1")
+            assert insert_event.call_args.kwargs["id"] == copy_id
+            patch_kwargs = service.events.return_value.patch.call_args.kwargs
+            assert patch_kwargs["eventId"] == copy_id
+            assert patch_kwargs["body"]["extendedProperties"]["private"]["source-id"] == "source1"
+            assert "id" not in patch_kwargs["body"]
+
+    @staticmethod
+    def test_new_event_with_legacy_copy(db, calendar1_1, calendar1_2, monkeypatch):
+        monkeypatch.setenv("DETERMINISTIC_COPY_IDS", "true")
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        event = TestDeterministicCopyIds.make_event()
+        # copied before deterministic ids were used, e.g. a resync of a never modified event
+        legacy_copy = GoogleEvent(id="legacy", status=EventStatus.confirmed,
+                                  extendedProperties=ExtendedProperties(private={"source-id": "source1"}))
+        legacy_copy.summary = format_calendar_text(event.summary, rule.summary)
+        legacy_copy.description = format_calendar_text(event.description, rule.description)
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events") as get_events,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.insert_event") as insert_event,
+        ):
+            get_events.return_value = [legacy_copy]
+            assert GoogleCalendarWrapper.push_event_to_rule(event, rule) == 0
+            assert get_events.call_count == 1
+            assert insert_event.call_count == 0
+
+    @staticmethod
+    def test_delete_without_lookup(db, calendar1_1, calendar1_2, monkeypatch):
+        monkeypatch.setenv("DETERMINISTIC_COPY_IDS", "true")
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        event = TestDeterministicCopyIds.make_event(status=EventStatus.cancelled)
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events") as get_events,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.delete_event") as delete_event,
+        ):
+            assert GoogleCalendarWrapper.push_event_to_rule(event, rule) == 1
+            assert get_events.call_count == 0
+            assert delete_event.call_args.args[2] == copy_event_id(str(rule.uuid), "source1")
+
+    @staticmethod
+    def test_update_not_found_falls_back_to_lookup(db, calendar1_1, calendar1_2, monkeypatch):
+        monkeypatch.setenv("DETERMINISTIC_COPY_IDS", "true")
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        event = TestDeterministicCopyIds.make_event(created_delta=datetime.timedelta(hours=1))
+        legacy_copy = GoogleEvent(id="legacy", status=EventStatus.confirmed,
+                                  extendedProperties=ExtendedProperties(private={"source-id": "source1"}))
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.get_events") as get_events,
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.update_event") as update_event,
+        ):
+            get_events.return_value = [legacy_copy]
+            update_event.side_effect = [make_http_error(404), {}]
+            assert GoogleCalendarWrapper.push_event_to_rule(event, rule) == 1
+            assert get_events.call_count == 1
+            assert [c.kwargs["event_id"] for c in update_event.call_args_list] == [
+                copy_event_id(str(rule.uuid), "source1"), "legacy"
+            ]
+
+
+class TestServicePool:
+    @staticmethod
+    def test_shared_until_credentials_change(db, account1_1, calendar1_1, calendar1_1_2, boto_session):
+        with patch("calensync.gwrapper.service_from_account") as service_from_account:
+            service_from_account.side_effect = lambda *_: MagicMock()
+            first = GoogleCalendarWrapper(calendar1_1, session=boto_session).service
+            # another calendar of the same account
+            assert GoogleCalendarWrapper(calendar1_1_2, session=boto_session).service is first
+            assert service_from_account.call_count == 1
+
+            account1_1.encrypted_credentials = "new"
+            assert get_account_service(account1_1, boto_session) is not first
+            assert service_from_account.call_count == 2
+
+    @staticmethod
+    def test_refresh_error_drops_service(db, account1_1, calendar1_1, boto_session):
+        with patch("calensync.gwrapper.service_from_account") as service_from_account:
+            service_from_account.side_effect = lambda *_: MagicMock()
+            first = get_account_service(account1_1, boto_session)
+            handle_refresh_error(calendar1_1, google.auth.exceptions.RefreshError(
+                "error", {"error": INVALID_GRANT_ERROR}))
+            assert get_account_service(account1_1, boto_session) is not first
+
+
+class TestCalendarWrapperPool:
+    @staticmethod
+    def test_reused_and_reset(db, calendar1_1, calendar1_2, boto_session):
+        wrapper = get_calendar_wrapper(calendar1_1, session=boto_session)
+        wrapper.events = ["event"]
+        wrapper.events_handler.events_to_delete.append("event")
+        wrapper.copy_index = MagicMock()
+
+        calendar = Calendar.get_by_id(calendar1_1.id)
+        reused = get_calendar_wrapper(calendar, session=boto_session)
+        assert reused is wrapper
+        assert reused.calendar_db is calendar
+        assert reused.events == []
+        assert reused.events_handler.events_to_delete == []
+        assert reused.copy_index is None
+        assert get_calendar_wrapper(calendar1_2, session=boto_session) is not wrapper
+
+    @staticmethod
+    def test_paused_calendar_dropped(db, calendar1_1, boto_session):
+        wrapper = get_calendar_wrapper(calendar1_1, session=boto_session)
+        calendar1_1.paused = utcnow()
+        calendar1_1.save()
+        assert get_calendar_wrapper(calendar1_1, session=boto_session) is not wrapper
+
+        calendar1_1.paused = None
+        calendar1_1.save()
+        assert get_calendar_wrapper(calendar1_1, session=boto_session) is not wrapper
+
+    @staticmethod
+    def test_user_loaded_lazily(db, user, calendar1_1):
+        calendar = Calendar.get_by_id(calendar1_1.id)
+        wrapper = GoogleCalendarWrapper(calendar)
+        # the account wasn't fetched
+        assert "account" not in calendar.__rel__
+        assert wrapper.user_db == user
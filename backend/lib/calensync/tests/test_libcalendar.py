@@ -1,8 +1,10 @@
 import copy
 
 from calensync.database.model import SyncRule
-from calensync.dataclass import GoogleDatetime, EventStatus, GoogleEventAttendee, GoogleEventResponseStatus
-from calensync.libcalendar import set_declined_event_if_necessary
+from calensync.dataclass import GoogleDatetime, EventStatus, GoogleEventAttendee, GoogleEventResponseStatus, \
+    ExtendedProperties
+from calensync.libcalendar import set_declined_event_if_necessary, events_to_reconcile, recurrences_first
+from calensync.queries.common import get_sync_rules_with_calendars
 from calensync.tests.fixtures import *
 
 now = datetime.datetime.utcnow()
@@ -99,3 +101,102 @@ class TestSetDeclinedIfNecessary:
         copied = copy.deepcopy(event)
         set_declined_event_if_necessary(sr, copied)
         assert event == copied
+
+
+class TestEventsToReconcile:
+    @staticmethod
+    def make_event(event_id: str, hour: int = 10, status: EventStatus = EventStatus.confirmed, **kwargs) -> GoogleEvent:
+        start = datetime.datetime(2024, 1, 1, hour, tzinfo=datetime.timezone.utc)
+        return GoogleEvent(id=event_id, status=status, start=GoogleDatetime(dateTime=start),
+                           end=GoogleDatetime(dateTime=start + datetime.timedelta(hours=1)), **kwargs)
+
+    @staticmethod
+    def make_copy(rule: SyncRule, source: GoogleEvent, copy_id: str, **kwargs) -> GoogleEvent:
+        properties = ExtendedProperties.from_sources(source.id, str(rule.source.uuid), str(rule.uuid))
+        fields = {"start": source.start, "end": source.end, "status": source.status, **kwargs}
+        return GoogleEvent(id=copy_id, extendedProperties=properties, **fields)
+
+    @staticmethod
+    def test_only_differences(db, calendar1_1, calendar1_2, calendar1_2_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        other_rule = SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+        rule = get_sync_rules_with_calendars([rule.id])[rule.id]
+        make_event, make_copy = TestEventsToReconcile.make_event, TestEventsToReconcile.make_copy
+
+        unchanged = make_event("unchanged")
+        new = make_event("new")
+        moved = make_event("moved", hour=12)
+        cancelled = make_event("cancelled", status=EventStatus.cancelled)
+        already_deleted = make_event("already_deleted", status=EventStatus.cancelled)
+        tentative = make_event("tentative", status=EventStatus.tentative)
+        copied_from_elsewhere = make_copy(other_rule, make_event("elsewhere"), "elsewhere_copy")
+        source_events = [unchanged, new, moved, cancelled, already_deleted, tentative, copied_from_elsewhere]
+
+        destination_events = [
+            make_copy(rule, unchanged, "c1"),
+            make_copy(rule, make_event("moved", hour=10), "c2"),
+            make_copy(rule, make_event("cancelled"), "c3"),
+            make_copy(rule, already_deleted, "c4"),
+            # a copy of the same source, by another rule
+            make_copy(other_rule, new, "c5"),
+        ]
+
+        result = events_to_reconcile(rule, source_events, destination_events)
+        assert [e.id for e in result] == ["new", "moved", "cancelled"]
+        assert events_to_reconcile(rule, [unchanged], [make_copy(rule, unchanged, "c1")]) == []
+
+    @staticmethod
+    def test_declined(db, calendar1_1, calendar1_2):
+        calendar1_1.primary = True
+        calendar1_1.save()
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        rule = get_sync_rules_with_calendars([rule.id])[rule.id]
+        attendees = [GoogleEventAttendee(email=calendar1_1.platform_id, responseStatus=GoogleEventResponseStatus.declined)]
+
+        declined = TestEventsToReconcile.make_event("declined", attendees=attendees)
+        declined_without_copy = TestEventsToReconcile.make_event("declined_without_copy", attendees=attendees)
+        destination_events = [TestEventsToReconcile.make_copy(rule, declined, "c1")]
+
+        result = events_to_reconcile(rule, [declined, declined_without_copy], destination_events)
+        assert [e.id for e in result] == ["declined"]
+        # the source event itself isn't modified
+        assert declined.status == EventStatus.confirmed
+
+    @staticmethod
+    def test_recurrence_instances(db, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        rule = get_sync_rules_with_calendars([rule.id])[rule.id]
+        make_event, make_copy = TestEventsToReconcile.make_event, TestEventsToReconcile.make_copy
+
+        recurrence = make_event("root", recurrence=["RRULE:FREQ=DAILY"])
+        moved = make_event("root_20240102T100000Z", hour=11, recurringEventId="root")
+        unchanged = make_event("root_20240103T100000Z", recurringEventId="root")
+        cancelled = make_event("root_20240104T100000Z", status=EventStatus.cancelled, recurringEventId="root")
+        already_cancelled = make_event("root_20240105T100000Z", status=EventStatus.cancelled, recurringEventId="root")
+        source_events = [recurrence, moved, unchanged, cancelled, already_cancelled]
+
+        # the instances of the copy carry the source id of the recurrence, or nothing when cancelled
+        destination_events = [
+            make_copy(rule, recurrence, "copy", recurrence=recurrence.recurrence),
+            make_copy(rule, recurrence, "copy_20240102T100000Z", recurringEventId="copy"),
+            make_copy(rule, recurrence, "copy_20240103T100000Z", recurringEventId="copy"),
+            GoogleEvent(id="copy_20240105T100000Z", status=EventStatus.cancelled, recurringEventId="copy"),
+        ]
+
+        result = events_to_reconcile(rule, source_events, destination_events)
+        assert [e.id for e in result] == [moved.id, cancelled.id]
+
+
+class TestRecurrencesFirst:
+    @staticmethod
+    def test_across_pages():
+        root = GoogleEvent(id="root", status=EventStatus.confirmed, recurrence=["RRULE:FREQ=DAILY"])
+        instance = GoogleEvent(id="root_20240102", status=EventStatus.confirmed, recurringEventId="root")
+        other_root = GoogleEvent(id="other", status=EventStatus.confirmed, recurrence=["RRULE:FREQ=DAILY"])
+        other_instance = GoogleEvent(id="other_20240102", status=EventStatus.confirmed, recurringEventId="other")
+        single = GoogleEvent(id="single", status=EventStatus.confirmed)
+
+        pages = [[instance, single, other_instance, other_root], [root]]
+        result = [[e.id for e in page] for page in recurrences_first(pages)]
+        # the instance of the recurrence of the next page is held back until the end
+        assert result == [["other", "single", "other_20240102"], ["root"], ["root_20240102"]]
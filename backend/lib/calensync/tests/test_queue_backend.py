@@ -0,0 +1,147 @@
+import threading
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from calensync.api.service import handle_received_webhook
+from calensync.database.model import SyncRule, Calendar
+from calensync.dataclass import GoogleEvent, EventStatus
+from calensync.queue_backend import LocalQueueBackend, get_queue_backend, InlineQueueBackend, SQSQueueBackend, \
+    QueueBackend
+from calensync.sqs import prepare_event_to_push, decode_sqs_event, SQSSendException
+from calensync.tests.fixtures import *
+
+
+class TestLocalQueueBackend:
+    @staticmethod
+    def test_delay_and_visibility():
+        queue = LocalQueueBackend(visibility_timeout=30)
+        with patch("calensync.queue_backend.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            queue.send_messages(["a"], delay=10)
+            queue.send_messages(["b"])
+            assert [r["body"] for r in queue.receive()] == ["b"]
+            # b is invisible until it's deleted or its visibility timeout expires
+            assert queue.receive() == []
+
+            monotonic.return_value = 10
+            [a] = queue.receive()
+            assert a["body"] == "a"
+            assert a["attributes"]["ApproximateReceiveCount"] == "1"
+            queue.delete_message(ReceiptHandle=a["receiptHandle"])
+
+            monotonic.return_value = 31
+            [b] = queue.receive()
+            assert b["body"] == "b"
+            assert b["attributes"]["ApproximateReceiveCount"] == "2"
+            queue.change_message_visibility(QueueUrl="url", ReceiptHandle=b["receiptHandle"], VisibilityTimeout=100)
+            monotonic.return_value = 100
+            assert queue.receive() == []
+            monotonic.return_value = 131
+            assert [r["body"] for r in queue.receive()] == ["b"]
+
+            # an outdated receipt handle doesn't delete the message
+            queue.delete_message(ReceiptHandle=b["receiptHandle"])
+            assert queue.stats()["pending"] == 1
+
+    @staticmethod
+    def test_workers():
+        handled = []
+        lock = threading.Lock()
+
+        def handler(records, db, session, sqs_client):
+            with lock:
+                handled.extend(r["body"] for r in records)
+            # the first message is rescheduled once, like the receiver does for rate limited records
+            failures = []
+            for r in records:
+                if r["body"] == "0" and r["attributes"]["ApproximateReceiveCount"] == "1":
+                    sqs_client.change_message_visibility(ReceiptHandle=r["receiptHandle"], VisibilityTimeout=0)
+                    failures.append({"itemIdentifier": r["messageId"]})
+            return {"batchItemFailures": failures}
+
+        queue = LocalQueueBackend(workers=3, batch_size=4, poll_interval=0.01, handler=handler)
+        queue.send_messages([str(i) for i in range(50)])
+        queue.start(db=MagicMock())
+        try:
+            assert queue.join(timeout=10)
+        finally:
+            queue.stop()
+
+        assert sorted(handled, key=int) == ["0"] + [str(i) for i in range(50)]
+        stats = queue.stats()
+        assert stats["sent"] == 50
+        assert stats["deleted"] == 50
+        assert stats["pending"] == 0
+        assert stats["max_lag"] >= stats["mean_lag"] >= 0
+
+    @staticmethod
+    def test_receiver(db, boto_session, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        sqs_events = [
+            prepare_event_to_push(GoogleEvent(id=str(i), status=EventStatus.confirmed), rule.id, False)
+            for i in range(5)
+        ]
+        queue = LocalQueueBackend(workers=2, poll_interval=0.01)
+        with patch("calensync.gwrapper.GoogleCalendarWrapper.push_event_to_rule") as push_event_to_rule:
+            queue.send(sqs_events, boto_session, db)
+            try:
+                assert queue.join(timeout=10)
+            finally:
+                queue.stop()
+
+        assert sorted(c.args[0].id for c in push_event_to_rule.call_args_list) == [str(i) for i in range(5)]
+
+
+class TestGetQueueBackend:
+    @staticmethod
+    def test_default():
+        with patch.dict(os.environ, {"ENV": "test"}):
+            os.environ.pop("SQS_QUEUE_URL", None)
+            assert isinstance(get_queue_backend(), InlineQueueBackend)
+            os.environ["SQS_QUEUE_URL"] = "url"
+            assert isinstance(get_queue_backend(), SQSQueueBackend)
+
+        with patch("calensync.queue_backend.QUEUE_BACKEND", "local"):
+            assert isinstance(get_queue_backend(), LocalQueueBackend)
+            assert get_queue_backend() is get_queue_backend()
+
+    @staticmethod
+    def test_abstract():
+        with pytest.raises(TypeError):
+            QueueBackend()
+
+    @staticmethod
+    def test_sqs(boto_session, queue_url):
+        sqs_event = prepare_event_to_push(GoogleEvent(id="1", status=EventStatus.confirmed), 1, False)
+        with patch("calensync.queue_backend.QUEUE_BACKEND", "sqs"):
+            get_queue_backend().send([sqs_event], boto_session, None, delay=0)
+
+        [message] = boto_session.client("sqs").receive_message(QueueUrl=queue_url)["Messages"]
+        assert decode_sqs_event(message["Body"]).get_update_event().event.id == "1"
+
+    @staticmethod
+    def test_partial_failure_not_synced(db, boto_session, calendar1_1, calendar1_2, monkeypatch):
+        monkeypatch.setenv("SQS_QUEUE_URL", "queue")
+        SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        calendar1_1.sync_token = "token"
+        calendar1_1.save()
+        last_processed = Calendar.get_by_id(calendar1_1.id).last_processed
+
+        events = [GoogleEvent(id=str(i), status=EventStatus.confirmed) for i in range(3)]
+        client = MagicMock()
+        client.send_message_batch.return_value = {"Failed": [{"Id": "1", "SenderFault": False}]}
+        with (
+            patch("calensync.queue_backend.QUEUE_BACKEND", "sqs"),
+            patch("calensync.gwrapper.GoogleCalendarWrapper.service"),
+            patch("calensync.gwrapper.iter_event_pages_with_sync_token", return_value=iter([(events, "new token")])),
+            patch("calensync.sqs.get_sqs_client", return_value=client),
+            patch("calensync.sqs.time.sleep"),
+        ):
+            with pytest.raises(SQSSendException):
+                handle_received_webhook(calendar1_1, db, boto_session)
+
+        # the events will be listed again by the next notification
+        calendar = Calendar.get_by_id(calendar1_1.id)
+        assert calendar.sync_token == "token"
+        assert calendar.last_processed == last_processed
@@ -0,0 +1,136 @@
+import threading
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from calensync.ratelimit import TokenBucket, RateLimitedHttpRequest, get_rate_limiter
+from calensync.tests.fixtures import make_http_error
+from calensync.tests.test_util import make_batch_service
+from calensync.utils import google_batch_with_backoff, non_blocking_backoff, BackoffException
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    fake = FakeClock()
+    with (
+        patch("calensync.ratelimit.time.monotonic", fake.monotonic),
+        patch("calensync.ratelimit.time.sleep", fake.sleep)
+    ):
+        yield fake
+
+
+class TestTokenBucket:
+    @staticmethod
+    def test_burst_then_rate(clock):
+        bucket = TokenBucket(rate=2, capacity=3)
+        assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+        assert bucket.acquire() == 0.5
+        assert clock.now == 0.5
+
+    @staticmethod
+    def test_concurrent_callers_queue_up():
+        waits = []
+        # the clock doesn't move, so the threads all ask for their token at the same time
+        with (
+            patch("calensync.ratelimit.time.monotonic", return_value=0.),
+            patch("calensync.ratelimit.time.sleep")
+        ):
+            bucket = TokenBucket(rate=1, capacity=1)
+            threads = [threading.Thread(target=lambda: waits.append(bucket.acquire())) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # each thread reserved its own token, so the waits are all different
+        assert sorted(waits) == [0, 1, 2, 3, 4]
+
+    @staticmethod
+    def test_adapts_rate(clock):
+        bucket = TokenBucket(rate=4, capacity=1, min_rate=1, max_rate=5)
+        bucket.on_rate_limited()
+        assert bucket.rate == 2
+        bucket.on_rate_limited()
+        bucket.on_rate_limited()
+        assert bucket.rate == 1
+        # the bucket is drained after a rate limit
+        assert bucket.acquire() == 1
+        bucket.on_success(1000)
+        assert bucket.rate == 5
+
+    @staticmethod
+    def test_non_blocking(clock):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.acquire()
+        with non_blocking_backoff():
+            # short waits are still slept
+            assert bucket.acquire() == 1
+            # other callers already reserved the next tokens
+            bucket.tokens = -2
+            bucket.updated_at = clock.now
+            with pytest.raises(BackoffException) as e:
+                bucket.acquire()
+        assert e.value.delay == 3
+        assert bucket.tokens == -2
+
+    @staticmethod
+    def test_non_blocking_batch(clock):
+        bucket = TokenBucket(rate=5, capacity=10)
+        with non_blocking_backoff():
+            # sent right away, the bucket is full
+            assert bucket.acquire(50) == 0
+            assert clock.now == 0
+            # the next requests back off until the bucket's debt is paid back
+            with pytest.raises(BackoffException) as e:
+                bucket.acquire()
+            assert e.value.delay == 9
+            clock.now = 8
+            assert bucket.acquire() == pytest.approx(0.2)
+            with pytest.raises(BackoffException):
+                bucket.acquire(50)
+
+    @staticmethod
+    def test_shared_per_key():
+        assert get_rate_limiter("account1") is get_rate_limiter("account1")
+        assert get_rate_limiter("account1") is not get_rate_limiter("account2")
+
+
+class TestRateLimitedHttpRequest:
+    @staticmethod
+    def test_rate_limit_feedback():
+        limiter = MagicMock()
+        http = MagicMock()
+        http.request.return_value = (MagicMock(status=200), b'{}')
+        request = RateLimitedHttpRequest(limiter, http, lambda resp, content: content, "https://example.com")
+        request.execute()
+        assert limiter.acquire.call_count == 1
+        assert limiter.on_success.call_count == 1
+
+        with patch("googleapiclient.http.HttpRequest.execute") as execute:
+            execute.side_effect = make_http_error(429, "rateLimitExceeded")
+            with pytest.raises(Exception):
+                request.execute()
+        assert limiter.on_rate_limited.call_count == 1
+
+
+class TestBatchRateLimit:
+    @staticmethod
+    def test_batch_takes_one_token_per_request():
+        limiter = MagicMock()
+        requests = {str(i): MagicMock(rate_limiter=limiter) for i in range(60)}
+        responses = {request: (lambda request_id: {"id": request_id}) for request in requests.values()}
+        service, executed = make_batch_service(responses)
+
+        google_batch_with_backoff(service, requests)
+        assert [c.args for c in limiter.acquire.call_args_list] == [(50,), (10,)]
+        assert limiter.on_rate_limited.call_count == 0
@@ -0,0 +1,159 @@
+import datetime
+import json
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from calensync.dataclass import GoogleEvent, EventStatus, GoogleDatetime, GoogleEventAttendee, \
+    GoogleEventResponseStatus, SQSEvent, QueueEvent, PostSyncRuleEvent, UpdateGoogleEvent
+from calensync.sqs import prepare_event_to_push, encode_sqs_event, decode_sqs_event, pack_batches, \
+    send_batched_events, push_update_event_to_queue, get_sqs_client, send_messages, SQSSendException
+from calensync.tests.fixtures import *
+from calensync.utils import utcnow
+
+
+def make_event(description: str = "description", id: str = "123", **kwargs) -> GoogleEvent:
+    start = datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc)
+    return GoogleEvent(
+        id=id, status=EventStatus.confirmed, summary="summary", description=description,
+        start=GoogleDatetime(dateTime=start), end=GoogleDatetime(dateTime=start + datetime.timedelta(hours=1)),
+        created=start, updated=start + datetime.timedelta(hours=2), htmlLink="https://calendar.google.com/event",
+        attendees=[
+            GoogleEventAttendee(email="accepted@test.com", responseStatus=GoogleEventResponseStatus.accepted),
+            GoogleEventAttendee(email="declined@test.com", responseStatus=GoogleEventResponseStatus.declined),
+        ],
+        **kwargs
+    )
+
+
+class TestWireFormat:
+    @staticmethod
+    def test_updated_event_round_trip():
+        event = make_event(recurrence=["RRULE:FREQ=WEEKLY"])
+        sqs_event = prepare_event_to_push(event, 5, False)
+        body = encode_sqs_event(sqs_event)
+
+        content = json.loads(body)
+        assert content["v"] == 2
+        assert "htmlLink" not in content["d"]["event"]
+        assert "originalStartTime" not in content["d"]["event"]
+        assert content["d"]["event"]["attendees"] == [{"email": "declined@test.com", "responseStatus": "declined"}]
+        assert len(body) < len(SQSEvent(kind=sqs_event.kind, data=sqs_event.get_update_event().dict()).json())
+
+        decoded = decode_sqs_event(body)
+        assert decoded.kind == QueueEvent.UPDATED_EVENT
+        assert decoded.first_received == sqs_event.first_received
+        e = decoded.get_update_event()
+        assert e.rule_id == 5
+        assert not e.delete
+        assert e.event.id == event.id
+        assert e.event.status == EventStatus.confirmed
+        assert e.event.start == event.start
+        assert e.event.updated == event.updated
+        assert e.event.summary == event.summary
+        assert e.event.description == event.description
+        assert e.event.recurrence == event.recurrence
+        assert e.event.get_declined_emails() == ["declined@test.com"]
+
+    @staticmethod
+    def test_compressed():
+        event = make_event(description="a long description " * 500)
+        sqs_event = prepare_event_to_push(event, 5, True)
+        with patch("calensync.sqs.SQS_COMPRESSION_THRESHOLD", 1024):
+            body = encode_sqs_event(sqs_event)
+        assert "z" in json.loads(body)
+        assert len(body) < 1024
+
+        e = decode_sqs_event(body).get_update_event()
+        assert e.delete
+        assert e.event.description == event.description
+
+        with patch("calensync.sqs.SQS_COMPRESSION_THRESHOLD", 0):
+            assert "z" not in json.loads(encode_sqs_event(sqs_event))
+
+    @staticmethod
+    def test_from_update_event():
+        update_event = UpdateGoogleEvent(event=make_event(), rule_id=1, delete=False)
+        sqs_event = SQSEvent.from_update_event(update_event)
+        assert sqs_event.kind == QueueEvent.UPDATED_EVENT
+        assert sqs_event.data == update_event.dict()
+        assert sqs_event.get_update_event() is update_event
+
+        sqs_event = SQSEvent.from_update_event(update_event, data={"rule_id": 1})
+        assert sqs_event.data == {"rule_id": 1}
+        assert sqs_event.get_update_event() is update_event
+
+    @staticmethod
+    def test_legacy_messages():
+        event = make_event()
+        data = prepare_event_to_push(event, 1, False).get_update_event().dict()
+        body = SQSEvent(kind=QueueEvent.UPDATED_EVENT, data=data, first_received=utcnow()).json()
+        assert decode_sqs_event(body).get_update_event().event.htmlLink == event.htmlLink
+
+        body = SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=3).dict()).json()
+        decoded = decode_sqs_event(body)
+        assert decoded.kind == QueueEvent.POST_SYNC_RULE
+        assert decoded.data == {"sync_rule_id": 3}
+
+
+class TestProducer:
+    @staticmethod
+    def test_pack_batches():
+        assert pack_batches([]) == []
+        contents = [str(i) for i in range(25)]
+        assert [len(b) for b in pack_batches(contents)] == [10, 10, 5]
+        assert sum(pack_batches(contents), []) == contents
+
+        contents = ["a" * 40, "b" * 40, "c" * 30, "d" * 90, "e"]
+        assert pack_batches(contents, max_bytes=100) == [["a" * 40, "b" * 40], ["c" * 30], ["d" * 90, "e"]]
+        # too large messages are sent on their own
+        assert pack_batches(["a", "b" * 200, "c"], max_bytes=100) == [["a"], ["b" * 200], ["c"]]
+
+    @staticmethod
+    def test_failed_entries_retried():
+        client = MagicMock()
+        client.send_message_batch.side_effect = [
+            {"Failed": [{"Id": "0", "SenderFault": False}, {"Id": "1", "SenderFault": True, "Code": "Invalid"}]},
+            {"Failed": [{"Id": "0", "SenderFault": False}]},
+            {"Successful": [{"Id": "0"}]},
+        ]
+        with patch("calensync.sqs.get_sqs_client", return_value=client), patch("calensync.sqs.time.sleep") as sleep:
+            not_sent = send_batched_events(None, ["a", "b", "c"], queue_url="queue", delay=0)
+
+        assert not_sent == ["b"]
+        assert sleep.call_count == 2
+        calls = client.send_message_batch.call_args_list
+        assert [len(c.kwargs["Entries"]) for c in calls] == [3, 1, 1]
+        assert calls[2].kwargs["Entries"] == [{"Id": "0", "MessageBody": "a", "DelaySeconds": 0}]
+
+    @staticmethod
+    def test_give_up():
+        client = MagicMock()
+        client.send_message_batch.return_value = {"Failed": [{"Id": "1", "SenderFault": False}]}
+        with patch("calensync.sqs.get_sqs_client", return_value=client), patch("calensync.sqs.time.sleep"):
+            assert send_batched_events(None, ["a", "b"], queue_url="queue", delay=0) == ["b"]
+        assert client.send_message_batch.call_count == 4
+
+    @staticmethod
+    def test_send_messages_raises_when_not_sent(monkeypatch):
+        monkeypatch.setenv("SQS_QUEUE_URL", "queue")
+        client = MagicMock()
+        client.send_message_batch.return_value = {"Failed": [{"Id": "1", "SenderFault": True, "Code": "Invalid"}]}
+        with patch("calensync.sqs.get_sqs_client", return_value=client):
+            with pytest.raises(SQSSendException) as e:
+                send_messages(None, ["a", "b", "c"], workers=1, delay=0)
+        assert e.value.not_sent == ["b"]
+
+    @staticmethod
+    def test_push_concurrently(db, boto_session, queue_url):
+        events = [prepare_event_to_push(make_event(id=str(i)), 1, False) for i in range(35)]
+        push_update_event_to_queue(events, boto_session, db)
+
+        assert get_sqs_client(boto_session) is get_sqs_client(boto_session)
+        sqs = boto_session.client("sqs")
+        ids = set()
+        for _ in range(10):
+            response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+            for message in response.get("Messages", []):
+                ids.add(decode_sqs_event(message["Body"]).get_update_event().event.id)
+        assert ids == {str(i) for i in range(35)}
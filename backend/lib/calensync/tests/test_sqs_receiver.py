@@ -0,0 +1,213 @@
+import json
+from unittest.mock import patch
+
+import threading
+
+import boto3
+
+from calensync.awslambda.sqs_receiver import handle_sqs_records, backoff_delay, MAX_BACKOFF_DELAY, get_ordering_keys, \
+    get_executor, thread_boto_session
+from calensync.database.model import SyncRule
+from calensync.dataclass import SQSEvent, QueueEvent, PostSyncRuleEvent, GoogleEvent, EventStatus, UpdateGoogleEvent, \
+    GoogleWebhookEvent
+from calensync.libcalendar import PushToQueueException
+from calensync.tests.fixtures import *
+from calensync.utils import BackoffException, is_non_blocking_backoff, utcnow
+
+
+def receive_records(boto_session, queue_url, n):
+    """ Receives the messages of the queue in the format of the lambda SQS event records """
+    response = boto_session.client("sqs").receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=n, AttributeNames=["All"], WaitTimeSeconds=0, VisibilityTimeout=0
+    )
+    return [
+        {"messageId": m["MessageId"], "receiptHandle": m["ReceiptHandle"], "body": m["Body"],
+         "attributes": m["Attributes"]}
+        for m in response.get("Messages", [])
+    ]
+
+
+class TestHandleSqsRecords:
+    @staticmethod
+    def test_backoff_reschedules_without_sleeping(db, boto_session, queue_url):
+        sqs = boto_session.client("sqs")
+        for i in range(2):
+            body = SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=i).dict()).json()
+            sqs.send_message(QueueUrl=queue_url, MessageBody=body)
+        records = receive_records(boto_session, queue_url, 2)
+        assert len(records) == 2
+
+        handled = []
+
+        def _handle(sqs_event, *args):
+            assert is_non_blocking_backoff()
+            handled.append(sqs_event.data["sync_rule_id"])
+            if sqs_event.data["sync_rule_id"] == 0:
+                raise BackoffException(10)
+
+        with (
+            patch("calensync.awslambda.sqs_receiver.handle_sqs_event") as handle_sqs_event,
+            patch("time.sleep") as sleep,
+            patch("calensync.awslambda.sqs_receiver.backoff_delay", return_value=123),
+        ):
+            handle_sqs_event.side_effect = _handle
+            response = handle_sqs_records(records, db, boto_session)
+
+        assert sorted(handled) == [0, 1]
+        assert sleep.call_count == 0
+        failed_id = next(r["messageId"] for r in records if json.loads(r["body"])["data"]["sync_rule_id"] == 0)
+        assert response == {"batchItemFailures": [{"itemIdentifier": failed_id}]}
+        assert not is_non_blocking_backoff()
+
+        # the rescheduled message is hidden, the other one wasn't deleted as there's no lambda runtime
+        visible = receive_records(boto_session, queue_url, 2)
+        assert [r["messageId"] for r in visible] == [r["messageId"] for r in records if r["messageId"] != failed_id]
+
+    @staticmethod
+    def test_superseded_updates_acknowledged(db, boto_session, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        now = utcnow()
+        records = []
+        for i, (event_id, updated) in enumerate([("1", now), ("1", now + datetime.timedelta(seconds=1)), ("2", now)]):
+            event = GoogleEvent(id=event_id, status=EventStatus.confirmed, updated=updated)
+            body = SQSEvent(kind=QueueEvent.UPDATED_EVENT,
+                            data=UpdateGoogleEvent(event=event, rule_id=rule.id, delete=False).dict()).json()
+            records.append({"messageId": str(i), "receiptHandle": str(i), "body": body, "attributes": {}})
+        records.append({"messageId": "invalid", "receiptHandle": "invalid", "body": "{}", "attributes": {}})
+
+        with patch("calensync.gwrapper.GoogleCalendarWrapper.push_event_to_rule") as push_event_to_rule:
+            response = handle_sqs_records(records, db, boto_session)
+
+        handled = [c.args[0] for c in push_event_to_rule.call_args_list]
+        assert [(e.id, e.updated) for e in handled] == [("1", now + datetime.timedelta(seconds=1)), ("2", now)]
+        assert response == {"batchItemFailures": [{"itemIdentifier": "invalid"}]}
+
+
+
+def make_update_record(message_id: str, event_id: str, rule_id: int):
+    event = GoogleEvent(id=event_id, status=EventStatus.confirmed, updated=utcnow())
+    body = SQSEvent(kind=QueueEvent.UPDATED_EVENT,
+                    data=UpdateGoogleEvent(event=event, rule_id=rule_id, delete=False).dict()).json()
+    return {"messageId": message_id, "receiptHandle": message_id, "body": body, "attributes": {}}
+
+
+class TestConcurrentRecords:
+    @staticmethod
+    def test_ordering_keys(db, calendar1_1, calendar1_2, calendar1_2_2):
+        rule1 = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        rule2 = SyncRule(source=calendar1_2_2, destination=calendar1_2, private=True).save_new()
+        rule3 = SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+        webhook = GoogleWebhookEvent(channel_id="channel", token="token", state="exists", resource_id=None)
+        sqs_events = {
+            "1": SQSEvent(kind=QueueEvent.UPDATED_EVENT, data=UpdateGoogleEvent(
+                event=GoogleEvent(id="1", status=EventStatus.confirmed), rule_id=rule1.id, delete=False).dict()),
+            "2": SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=rule2.id).dict()),
+            "3": SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=rule3.id).dict()),
+            "4": SQSEvent(kind=QueueEvent.GOOGLE_WEBHOOK, data=webhook.dict()),
+            "5": SQSEvent(kind=QueueEvent.POST_SYNC_RULE, data=PostSyncRuleEvent(sync_rule_id=-1).dict()),
+        }
+        keys = get_ordering_keys(sqs_events)
+        assert keys["1"] == keys["2"] == ("destination", calendar1_2.id)
+        assert keys["3"] == ("destination", calendar1_2_2.id)
+        assert keys["4"] == ("channel", "channel")
+        assert keys["5"] == ("rule", -1)
+
+    @staticmethod
+    def test_same_destination_serialized(db, boto_session, calendar1_1, calendar1_2, calendar1_2_2):
+        rule1 = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        rule2 = SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+        records = [make_update_record("1", "a", rule1.id), make_update_record("2", "b", rule2.id),
+                   make_update_record("3", "c", rule1.id)]
+
+        first_started = threading.Event()
+        handled = []
+
+        def _push(event, *args, **kwargs):
+            event_id = event.id
+            if event_id == "a":
+                first_started.set()
+            elif event_id == "b":
+                # only possible if the records of the other destination are processed concurrently
+                assert first_started.wait(5)
+            elif event_id == "c":
+                raise Exception("error")
+            handled.append((event_id, threading.get_ident()))
+
+        with patch("calensync.gwrapper.GoogleCalendarWrapper.push_event_to_rule") as push_event_to_rule:
+            push_event_to_rule.side_effect = _push
+            response = handle_sqs_records(records, db, boto_session, workers=4)
+
+        assert push_event_to_rule.call_count == 3
+        assert sorted(e for e, _ in handled) == ["a", "b"]
+        assert response == {"batchItemFailures": [{"itemIdentifier": "3"}]}
+
+    @staticmethod
+    def test_threads_reused_across_invocations(db, boto_session, calendar1_1, calendar1_2):
+        rule = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        threads = []
+
+        def _push(*args, **kwargs):
+            threads.append(threading.current_thread())
+
+        with patch("calensync.gwrapper.GoogleCalendarWrapper.push_event_to_rule") as push_event_to_rule:
+            push_event_to_rule.side_effect = _push
+            for i in range(2):
+                response = handle_sqs_records([make_update_record(str(i), str(i), rule.id)], db, boto_session,
+                                              workers=2)
+                assert response == {"batchItemFailures": []}
+
+        assert get_executor(2) is get_executor(2)
+        # the idle worker of the first invocation processes the record of the second one
+        assert len(threads) == 2 and threads[0] is threads[1]
+        assert threads[0] is not threading.current_thread()
+
+
+class TestThreadBotoSession:
+    @staticmethod
+    def test_same_credentials():
+        session = boto3.Session(aws_access_key_id="key", aws_secret_access_key="secret", region_name="eu-north-1")
+        thread_session = thread_boto_session(session)
+        assert thread_session is not session
+        assert thread_session.region_name == "eu-north-1"
+        assert thread_session.get_credentials().get_frozen_credentials().access_key == "key"
+
+    @staticmethod
+    def test_without_credentials():
+        session = boto3.Session(region_name="eu-north-1")
+        with patch.object(session, "get_credentials", return_value=None):
+            thread_session = thread_boto_session(session)
+        assert thread_session.region_name == "eu-north-1"
+
+
+class TestUpdatedEventRecords:
+    @staticmethod
+    def test_grouped_by_rule(db, boto_session, calendar1_1, calendar1_2, calendar1_2_2):
+        rule1 = SyncRule(source=calendar1_1, destination=calendar1_2, private=True).save_new()
+        rule2 = SyncRule(source=calendar1_1, destination=calendar1_2_2, private=True).save_new()
+        records = [make_update_record(str(i), str(i), rule1.id) for i in range(3)]
+        records.append(make_update_record("3", "3", rule2.id))
+
+        with (
+            patch("calensync.gwrapper.GoogleCalendarWrapper.push_event_to_rule") as push_event_to_rule,
+            patch("calensync.api.service.build_rule_copy_index") as build_rule_copy_index,
+        ):
+            push_event_to_rule.side_effect = [None, PushToQueueException(None), None, None]
+            response = handle_sqs_records(records, db, boto_session)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+        # only the rule with enough events is indexed
+        assert build_rule_copy_index.call_count == 1
+        calls = push_event_to_rule.call_args_list
+        assert [c.args[1].id for c in calls] == [rule1.id] * 3 + [rule2.id]
+        assert len({id(c.kwargs["destination_wrapper"]) for c in calls[:3]}) == 1
+        assert calls[3].kwargs["destination_wrapper"].calendar_db.id == calendar1_2_2.id
+        assert {id(c.kwargs["copy_index"]) for c in calls[:3]} == {id(build_rule_copy_index.return_value)}
+        assert calls[3].kwargs["copy_index"] is None
+
+
+class TestBackoffDelay:
+    @staticmethod
+    def test_grows_with_receive_count():
+        assert 10 <= backoff_delay(10, 1) <= 20
+        assert 40 <= backoff_delay(10, 3) <= 50
+        assert backoff_delay(10, 30) == MAX_BACKOFF_DELAY
@@ -1,12 +1,15 @@
+import asyncio
 import json
+import threading
 from unittest.mock import MagicMock, patch
 
 import googleapiclient.errors
 import pytest
 
 from calensync.database.model import User, EmailDB
-from calensync.tests.fixtures import db
-from calensync.utils import prefetch_get_or_none, google_error_handling_with_backoff, BackoffException
+from calensync.tests.fixtures import db, make_http_error
+from calensync.utils import prefetch_get_or_none, google_error_handling_with_backoff, BackoffException, \
+    google_batch_with_backoff, run_async, gather_with_concurrency, run_in_thread, non_blocking_backoff
 
 
 class TestPrefetchOrNone:
@@ -114,3 +117,173 @@ class TestGoogleExceptionWithBackoff:
                 google_error_handling_with_backoff(_inner)
 
         assert i[0] == 1
+
+
+class TestNonBlockingBackoff:
+    @staticmethod
+    def test_raises_instead_of_sleeping():
+        def _inner():
+            raise make_http_error(429, "rateLimitExceeded")
+
+        with patch("calensync.utils.sleep") as sleep:
+            with non_blocking_backoff():
+                with pytest.raises(BackoffException) as e:
+                    google_error_handling_with_backoff(_inner)
+            assert sleep.call_count == 0
+        assert e.value.delay in (1, 2)
+        assert isinstance(e.value.__cause__, googleapiclient.errors.HttpError)
+
+    @staticmethod
+    def test_batch_raises_instead_of_sleeping():
+        responses = {"r0": lambda request_id: make_http_error(429, "rateLimitExceeded")}
+        service, executed = make_batch_service(responses)
+
+        with patch("calensync.utils.sleep") as sleep:
+            with non_blocking_backoff():
+                with pytest.raises(BackoffException):
+                    google_batch_with_backoff(service, {"0": "r0"})
+            assert sleep.call_count == 0
+        assert len(executed) == 1
+
+
+class FakeBatch:
+    """ Mimics googleapiclient BatchHttpRequest, responses are given by request -> response/exception """
+
+    def __init__(self, callback, responses, executed, batch_errors):
+        self.callback = callback
+        self.responses = responses
+        self.executed = executed
+        self.batch_errors = batch_errors
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.executed.append([request_id for request_id, _ in self.requests])
+        # error of the batch request itself, None when it succeeds
+        if self.batch_errors and (error := self.batch_errors.pop(0)) is not None:
+            raise error
+        for request_id, request in self.requests:
+            response = self.responses[request](request_id)
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
+
+
+def make_batch_service(responses, batch_errors=None):
+    service = MagicMock()
+    executed = []
+    batch_errors = list(batch_errors or [])
+    service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, responses, executed,
+                                                                            batch_errors)
+    return service, executed
+
+
+class TestGoogleBatchWithBackoff:
+    @staticmethod
+    def test_splits_in_batches_of_50():
+        responses = {f"r{i}": (lambda request_id: {"id": request_id}) for i in range(120)}
+        service, executed = make_batch_service(responses)
+
+        results = google_batch_with_backoff(service, {str(i): f"r{i}" for i in range(120)})
+        assert [len(batch) for batch in executed] == [50, 50, 20]
+        assert results == {str(i): {"id": str(i)} for i in range(120)}
+
+    @staticmethod
+    def test_retries_only_rate_limited_items():
+        calls = {"r0": 0}
+
+        def _rate_limited_once(request_id):
+            calls["r0"] += 1
+            if calls["r0"] == 1:
+                return make_http_error(403, "rateLimitExceeded")
+            return {"id": request_id}
+
+        responses = {"r0": _rate_limited_once, "r1": lambda request_id: {"id": request_id}}
+        service, executed = make_batch_service(responses)
+
+        with patch("calensync.utils.sleep") as sleep:
+            results = google_batch_with_backoff(service, {"0": "r0", "1": "r1"})
+            assert sleep.call_count == 1
+
+        assert executed == [["0", "1"], ["0"]]
+        assert results == {"0": {"id": "0"}, "1": {"id": "1"}}
+
+    @staticmethod
+    def test_rate_limited_batch_retried():
+        responses = {f"r{i}": (lambda request_id: {"id": request_id}) for i in range(60)}
+        service, executed = make_batch_service(responses, [None, make_http_error(429, "rateLimitExceeded")])
+
+        with patch("calensync.utils.sleep") as sleep:
+            results = google_batch_with_backoff(service, {str(i): f"r{i}" for i in range(60)})
+            assert sleep.call_count == 1
+
+        # only the rejected batch is sent again
+        assert [len(batch) for batch in executed] == [50, 10, 10]
+        assert executed[2] == [str(i) for i in range(50, 60)]
+        assert results == {str(i): {"id": str(i)} for i in range(60)}
+
+    @staticmethod
+    def test_batch_error_raised():
+        responses = {"r0": lambda request_id: {"id": request_id}}
+        service, executed = make_batch_service(responses, [make_http_error(500, "backendError")])
+
+        with pytest.raises(googleapiclient.errors.HttpError):
+            google_batch_with_backoff(service, {"0": "r0"})
+        assert len(executed) == 1
+
+    @staticmethod
+    def test_backoff_exception_when_always_rate_limited():
+        responses = {"r0": lambda request_id: make_http_error(429, "rateLimitExceeded")}
+        service, executed = make_batch_service(responses)
+
+        with pytest.raises(BackoffException):
+            with patch("calensync.utils.sleep"):
+                google_batch_with_backoff(service, {"0": "r0"})
+        assert len(executed) == 4
+
+    @staticmethod
+    def test_other_errors_are_returned():
+        error = make_http_error(400, "badRequest")
+        responses = {"r0": lambda request_id: error, "r1": lambda request_id: {"id": request_id}}
+        service, executed = make_batch_service(responses)
+
+        results = google_batch_with_backoff(service, {"0": "r0", "1": "r1"})
+        assert len(executed) == 1
+        assert results["0"] is error
+        assert results["1"] == {"id": "1"}
+
+
+class TestConcurrencyHelpers:
+    @staticmethod
+    def test_gather_with_concurrency_limit():
+        running = [0, 0]
+
+        async def task(i):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        results = run_async(gather_with_concurrency((task(i) for i in range(10)), limit=2))
+        assert running[1] == 2
+        assert results[:3] == [0, 1, 2]
+        assert isinstance(results[3], ValueError)
+
+    @staticmethod
+    def test_run_in_thread_closes_connection(db):
+        def query():
+            User().save_new()
+            return threading.get_ident(), db.is_closed()
+
+        with patch.object(db, "close", wraps=db.close) as close:
+            thread_id, closed = run_async(run_in_thread(db, query))
+            assert close.call_count == 1
+        assert thread_id != threading.get_ident()
+        assert closed is False
+        assert User.select().count() == 1
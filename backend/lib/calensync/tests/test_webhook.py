@@ -0,0 +1,142 @@
+import json
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from calensync.dataclass import GoogleWebhookEvent
+from calensync.tests.fixtures import *
+from calensync.webhook import InMemoryChannelStore, WebhookDebouncer, ChannelTokenCache, forward_webhook
+
+
+@pytest.fixture
+def sqs_client(boto_session, queue_url):
+    client = boto_session.client("sqs")
+    with patch("calensync.webhook.get_sqs_client", return_value=client):
+        yield client
+
+
+class TestInMemoryChannelStore:
+    @staticmethod
+    def test_duplicates_and_stale_dropped():
+        store = InMemoryChannelStore()
+        assert store.record("channel", 2, now=0, window=0)
+        assert not store.record("channel", 2, now=1, window=0)
+        assert not store.record("channel", 1, now=2, window=0)
+        assert store.record("channel", 3, now=3, window=0)
+        assert store.record("other", 1, now=3, window=0)
+
+    @staticmethod
+    def test_window():
+        store = InMemoryChannelStore()
+        assert store.record("channel", 1, now=0, window=10)
+        assert not store.record("channel", 2, now=5, window=10)
+        # the dropped notification was still recorded
+        assert not store.record("channel", 2, now=11, window=10)
+        assert store.record("channel", 3, now=11, window=10)
+
+    @staticmethod
+    def test_bounded():
+        store = InMemoryChannelStore(max_size=2)
+        for channel in ["1", "2", "3"]:
+            assert store.record(channel, 5, now=0, window=0)
+        # the oldest channel was forgotten
+        assert store.record("1", 5, now=0, window=0)
+        assert not store.record("3", 5, now=0, window=0)
+
+
+class TestWebhookDebouncer:
+    @staticmethod
+    def test_burst_coalesced():
+        debouncer = WebhookDebouncer(window=10)
+        with patch("calensync.webhook.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            assert debouncer.should_forward("channel", "exists", "5")
+            monotonic.return_value = 2
+            assert not debouncer.should_forward("channel", "exists", "6")
+            assert debouncer.should_forward("channel", "exists", "7", debounce=False)
+            monotonic.return_value = 20
+            assert not debouncer.should_forward("channel", "exists", "6")
+            assert debouncer.should_forward("channel", "exists", "8")
+
+    @staticmethod
+    def test_sync_resets_channel():
+        debouncer = WebhookDebouncer(window=10)
+        with patch("calensync.webhook.time.monotonic", return_value=0):
+            assert debouncer.should_forward("channel", "exists", "100")
+            # the watch was renewed with the same channel id
+            assert debouncer.should_forward("channel", "sync", "1")
+            assert not debouncer.should_forward("channel", "exists", "2")
+            assert debouncer.should_forward("channel", "exists", "3", debounce=False)
+
+    @staticmethod
+    def test_invalid_message_number():
+        debouncer = WebhookDebouncer(window=0)
+        assert debouncer.should_forward("channel", "exists", "abc")
+        assert debouncer.should_forward("channel", "exists", None)
+
+
+class TestChannelTokenCache:
+    @staticmethod
+    def test_reload():
+        tokens = {"channel1": "token1"}
+        loads = []
+
+        def load():
+            loads.append(1)
+            return dict(tokens)
+
+        cache = ChannelTokenCache(load, ttl=100, reload_interval=10)
+        with patch("calensync.webhook.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            assert cache.is_valid("channel1", "token1")
+            assert not cache.is_valid("channel1", "token2")
+            assert len(loads) == 1
+
+            # unknown channels reload the tokens at most once per reload interval
+            tokens["channel2"] = "token2"
+            assert not cache.is_valid("channel2", "token2")
+            assert len(loads) == 1
+            monotonic.return_value = 11
+            assert cache.is_valid("channel2", "token2")
+            assert len(loads) == 2
+
+            # known channels only after the ttl
+            tokens["channel1"] = "token3"
+            assert not cache.is_valid("channel1", "token3")
+            monotonic.return_value = 200
+            assert cache.is_valid("channel1", "token3")
+            assert len(loads) == 3
+
+
+class TestForwardWebhook:
+    @staticmethod
+    def test_forwarded(sqs_client, queue_url):
+        webhook_event = GoogleWebhookEvent(channel_id="channel1", token="token1", state="exists", resource_id="1")
+        token_cache = ChannelTokenCache(lambda: {"channel1": "token1"})
+        debouncer = WebhookDebouncer(window=0)
+
+        assert forward_webhook(webhook_event, debouncer, "1", token_cache)
+        assert not forward_webhook(webhook_event, debouncer, "1", token_cache)
+        invalid = webhook_event.copy(update={"token": "token2"})
+        assert not forward_webhook(invalid, debouncer, "2", token_cache)
+
+        messages = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+        assert len(messages) == 1
+        body = json.loads(messages[0]["Body"])
+        assert body["data"]["channel_id"] == "channel1"
+
+    @staticmethod
+    def test_retried_after_failed_send(queue_url):
+        webhook_event = GoogleWebhookEvent(channel_id="channel1", token="token1", state="exists", resource_id="1")
+        debouncer = WebhookDebouncer(window=10)
+        client = MagicMock()
+        client.send_message.side_effect = [Exception("unavailable"), {}]
+
+        with patch("calensync.webhook.get_sqs_client", return_value=client):
+            with pytest.raises(Exception):
+                forward_webhook(webhook_event, debouncer, "5")
+
+            # google's retry has the same message number, and is within the debounce window
+            assert forward_webhook(webhook_event, debouncer, "5")
+            assert not forward_webhook(webhook_event, debouncer, "5")
+        assert client.send_message.call_count == 2
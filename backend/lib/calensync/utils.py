@@ -1,11 +1,17 @@
 from __future__ import annotations
 
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
 import json
+import math
 import os
 import random
 from time import sleep
 import pathlib
+from typing import Dict, Any, Iterable, Awaitable, List
 
 import boto3
 import googleapiclient.errors
@@ -105,38 +111,78 @@ class BackoffException(Exception):
         super().__init__()
 
 
+_non_blocking_backoff = contextvars.ContextVar("non_blocking_backoff", default=False)
+
+
+@contextlib.contextmanager
+def non_blocking_backoff():
+    """
+    Within this context, rate limited Google calls raise a BackoffException right away with the delay
+    they would have slept, instead of sleeping. The caller is then in charge of scheduling the retry
+    """
+    token = _non_blocking_backoff.set(True)
+    try:
+        yield
+    finally:
+        _non_blocking_backoff.reset(token)
+
+
+def is_non_blocking_backoff() -> bool:
+    return _non_blocking_backoff.get()
+
+
+def get_google_error_reason(e: googleapiclient.errors.HttpError) -> str:
+    # the reason is always set to something, but can be a text (why the fuck google?) or an enum like text
+    # normally there's always a json representation
+    reason = e.reason
+    if e.resp.get('content-type', '').startswith('application/json'):
+        errors = json.loads(e.content).get('error', {}).get('errors', {})
+        if errors:
+            reason = errors[0].get('reason')
+        else:
+            logger.error(f"Couldn't parse error: {e.content}")
+    return reason
+
+
+def is_writer_access_error(e: googleapiclient.errors.HttpError) -> bool:
+    return e.status_code == 403 and e.reason == "You need to have writer access to this calendar."
+
+
+def is_rate_limit_error(e: googleapiclient.errors.HttpError, reason: str = None) -> bool:
+    if reason is None:
+        reason = get_google_error_reason(e)
+    return (
+            e.status_code == 429
+            or (e.status_code == 403 and reason in ["userRateLimitExceeded", 'Rate Limit Exceeded',
+                                                    "rateLimitExceeded", "quotaExceeded",
+                                                    'Calendar usage limits exceeded.'])
+    )
+
+
+def pause_calendar_without_writer_access(e: googleapiclient.errors.HttpError, calendar_db=None):
+    if calendar_db:
+        calendar_db.paused = utcnow()
+        calendar_db.paused_reason = e.reason
+        calendar_db.save()
+    logger.info(f"Did not insert event - You need to have writer access to this calendar on "
+                f"calendar {calendar_db.id if calendar_db else None}")
+
+
 def google_error_handling_with_backoff(function, calendar_db=None):
     for i in range(4):
         try:
             return function()
         except googleapiclient.errors.HttpError as e:
-            # the reason is always set to something, but can be a text (why the fuck google?) or an enum like text
-            # normally there's always a json representation
-            reason = e.reason
-            if e.resp.get('content-type', '').startswith('application/json'):
-                errors = json.loads(e.content).get('error', {}).get('errors', {})
-                if errors:
-                    reason = errors[0].get('reason')
-                else:
-                    logger.error(f"Couldn't parse error: {e.content}")
-
-            if e.status_code == 403:
-                if e.reason == "You need to have writer access to this calendar.":
-                    if calendar_db:
-                        calendar_db.paused = utcnow()
-                        calendar_db.paused_reason = e.reason
-                        calendar_db.save()
-                    logger.info(f"Did not insert event - You need to have writer access to this calendar on "
-                                f"calendar {calendar_db.id}")
-                    return False
-
-            if (
-                    e.status_code == 429
-                    or (e.status_code == 403 and reason in ["userRateLimitExceeded", 'Rate Limit Exceeded',
-                                                            "rateLimitExceeded", "quotaExceeded",
-                                                            'Calendar usage limits exceeded.'])
-            ):
+            reason = get_google_error_reason(e)
+
+            if is_writer_access_error(e):
+                pause_calendar_without_writer_access(e, calendar_db)
+                return False
+
+            if is_rate_limit_error(e, reason):
                 sleep_delay = 2 ** i + random.random()
+                if is_non_blocking_backoff():
+                    raise BackoffException(math.ceil(sleep_delay)) from e
                 logger.info(f"Sleeping for {sleep_delay} seconds")
                 sleep(sleep_delay)
             else:
@@ -146,8 +192,130 @@ def google_error_handling_with_backoff(function, calendar_db=None):
     raise BackoffException(60)
 
 
+GOOGLE_BATCH_SIZE = 50
+
+
+def google_batch_with_backoff(service, requests: Dict[str, Any], calendar_db=None) -> Dict[str, Any]:
+    """
+    Executes the given requests (request id -> googleapiclient HttpRequest) through the Google batch endpoint,
+    packing up to GOOGLE_BATCH_SIZE requests per HTTP call. Every sub-response goes through the same logic
+    as google_error_handling_with_backoff: rate limited requests are retried with exponential backoff,
+    missing writer access pauses the calendar.
+
+    Returns a dictionary request id -> response. The value is False if the calendar was paused, and the
+    HttpError if the request failed for any other reason. A rate limited batch is retried like its requests,
+    any other error of the batch itself is raised. Raises BackoffException if some requests are
+    still rate limited after the last retry.
+    """
+    results = {}
+    pending = dict(requests)
+    for i in range(4):
+        rate_limited = {}
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif not isinstance(exception, googleapiclient.errors.HttpError):
+                results[request_id] = exception
+            elif is_writer_access_error(exception):
+                pause_calendar_without_writer_access(exception, calendar_db)
+                results[request_id] = False
+            elif is_rate_limit_error(exception):
+                rate_limited[request_id] = pending[request_id]
+            else:
+                results[request_id] = exception
+
+        items = list(pending.items())
+        for chunk_start in range(0, len(items), GOOGLE_BATCH_SIZE):
+            chunk = items[chunk_start:chunk_start + GOOGLE_BATCH_SIZE]
+            # each request of a batch counts against the quota, see calensync.ratelimit
+            rate_limiter = getattr(chunk[0][1], "rate_limiter", None)
+            if rate_limiter is not None:
+                rate_limiter.acquire(len(chunk))
+
+            n_rate_limited = len(rate_limited)
+            batch = service.new_batch_http_request(callback=_callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            try:
+                batch.execute()
+            except googleapiclient.errors.HttpError as e:
+                # the whole batch was rejected, its requests without response are retried with the others
+                if not is_rate_limit_error(e):
+                    raise e
+                for request_id, request in chunk:
+                    if request_id not in results:
+                        rate_limited[request_id] = request
+
+            if rate_limiter is not None:
+                if len(rate_limited) > n_rate_limited:
+                    rate_limiter.on_rate_limited()
+                else:
+                    rate_limiter.on_success(len(chunk))
+
+        if not rate_limited:
+            return results
+
+        pending = rate_limited
+        sleep_delay = 2 ** i + random.random()
+        if is_non_blocking_backoff():
+            raise BackoffException(math.ceil(sleep_delay))
+        logger.info(f"{len(pending)} batched requests rate limited, sleeping for {sleep_delay} seconds")
+        sleep(sleep_delay)
+
+    raise BackoffException(60)
+
+
 def replace_timezone(dt: datetime.datetime):
     return dt.replace(tzinfo=datetime.timezone.utc)
 
 
+def replace_timezone_if_naive(dt: datetime.datetime):
+    if dt.tzinfo is None:
+        return replace_timezone(dt)
+    return dt
+
+
 INVALID_GRANT_ERROR = 'invalid_grant'
+
+
+GOOGLE_MAX_CONCURRENCY = int(os.environ.get("GOOGLE_MAX_CONCURRENCY", 16))
+
+
+def run_async(coroutine, max_workers: int = None):
+    """
+    Runs the coroutine until completion from synchronous code. The blocking calls it sends to threads
+    (asyncio.to_thread, run_in_thread) are executed by a pool of max_workers threads
+    """
+    async def main():
+        workers = max_workers or GOOGLE_MAX_CONCURRENCY
+        asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(workers))
+        return await coroutine
+
+    return asyncio.run(main())
+
+
+async def gather_with_concurrency(coroutines: Iterable[Awaitable], limit: int = None) -> List[Any]:
+    """ Like asyncio.gather with return_exceptions=True, but with at most `limit` coroutines running at once """
+    semaphore = asyncio.Semaphore(limit or GOOGLE_MAX_CONCURRENCY)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(bounded(c) for c in coroutines), return_exceptions=True)
+
+
+async def run_in_thread(db: peewee.Database, function, *args, **kwargs):
+    """
+    Runs a blocking function in the executor. peewee connections are per thread, so the connection
+    the function may have opened is closed afterwards instead of being left open in the worker thread
+    """
+    def inner():
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if db is not None and not db.is_closed():
+                db.close()
+
+    return await asyncio.to_thread(inner)
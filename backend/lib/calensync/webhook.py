@@ -0,0 +1,180 @@
+import collections
+import dataclasses
+import os
+import threading
+import time
+from typing import Optional, Callable, Dict
+
+from calensync.database.model import Calendar
+from calensync.database.utils import DatabaseSession
+from calensync.dataclass import GoogleWebhookEvent, SQSEvent, QueueEvent
+from calensync.log import get_logger
+from calensync.sqs import get_sqs_client
+from calensync.utils import get_env
+
+logger = get_logger(__file__)
+
+# the notifications of a channel are forwarded with this delay, and the ones received meanwhile are dropped:
+# the forwarded notification is processed after all of them, so its listing already contains their changes
+WEBHOOK_DEBOUNCE_SECONDS = int(os.environ.get("WEBHOOK_DEBOUNCE_SECONDS", 10))
+WEBHOOK_STORE_SIZE = 10000
+WEBHOOK_TOKEN_CACHE_TTL = 15 * 60
+WEBHOOK_TOKEN_RELOAD_INTERVAL = 60
+
+
+@dataclasses.dataclass
+class ChannelState:
+    message_number: Optional[int]
+    forwarded_at: float
+
+
+class InMemoryChannelStore:
+    """
+    State of the channels, i.e. the last notification received and when one was last forwarded.
+    Stand-in for a store shared by all the instances of the API (e.g. a table with conditional writes),
+    it only knows about the notifications received by this process
+    """
+
+    def __init__(self, max_size: int = WEBHOOK_STORE_SIZE):
+        self.max_size = max_size
+        self._states: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, channel_id: str, message_number: Optional[int], now: float, window: float,
+               reset: bool = False) -> bool:
+        """
+        Records the notification, and returns whether it must be forwarded. It's not if it's a duplicate or
+        older than a notification already received, or if a notification was forwarded less than `window`
+        seconds ago. `reset` forgets the previous notifications of the channel
+        """
+        with self._lock:
+            state: Optional[ChannelState] = None if reset else self._states.get(channel_id)
+            if state is None:
+                self._states[channel_id] = ChannelState(message_number, now)
+                self._states.move_to_end(channel_id)
+                while len(self._states) > self.max_size:
+                    self._states.popitem(last=False)
+                return True
+
+            self._states.move_to_end(channel_id)
+            if message_number is not None and state.message_number is not None:
+                if message_number <= state.message_number:
+                    return False
+                state.message_number = message_number
+
+            if now - state.forwarded_at < window:
+                return False
+            state.forwarded_at = now
+            return True
+
+    def cancel(self, channel_id: str, message_number: Optional[int]):
+        """
+        Forgets a notification recorded as forwarded which couldn't be, so that its retry isn't dropped. The
+        notifications received meanwhile may be forwarded again, which is harmless
+        """
+        with self._lock:
+            state: Optional[ChannelState] = self._states.get(channel_id)
+            if state is None:
+                return
+            if message_number is not None:
+                state.message_number = message_number - 1
+            state.forwarded_at = float("-inf")
+
+
+class WebhookDebouncer:
+    """
+    Coalesces the bursts of notifications Google sends for a channel. The forwarded notifications must be
+    delayed by `window` seconds (see WEBHOOK_DEBOUNCE_SECONDS), otherwise the dropped ones could be missed
+    """
+
+    def __init__(self, window: float = WEBHOOK_DEBOUNCE_SECONDS, store: InMemoryChannelStore = None):
+        self.window = window
+        self.store = store if store is not None else InMemoryChannelStore()
+
+    def should_forward(self, channel_id: str, state: str, message_number: Optional[str],
+                       debounce: bool = True) -> bool:
+        """
+        Returns whether the notification must be forwarded. Without `debounce`, i.e. when the notification is
+        processed right away, only the duplicate and stale notifications are dropped
+        """
+        number = self._parse_message_number(channel_id, message_number)
+        # a channel id is used again when a watch is renewed, and the numbering starts again with
+        # the sync notification of the new channel
+        forward = self.store.record(channel_id, number, time.monotonic(), self.window if debounce else 0,
+                                     reset=state == "sync")
+        if not forward:
+            logger.info(f"Dropping notification {message_number} of channel {channel_id}")
+        return forward
+
+    def cancel(self, channel_id: str, message_number: Optional[str]):
+        """ The notification couldn't be forwarded, see InMemoryChannelStore.cancel """
+        self.store.cancel(channel_id, self._parse_message_number(channel_id, message_number))
+
+    @staticmethod
+    def _parse_message_number(channel_id: str, message_number: Optional[str]) -> Optional[int]:
+        try:
+            return int(message_number) if message_number is not None else None
+        except ValueError:
+            logger.warning(f"Can't parse message number {message_number} of channel {channel_id}")
+            return None
+
+
+def load_channel_tokens() -> Dict[str, str]:
+    with DatabaseSession(get_env()):
+        query = Calendar.select(Calendar.channel_id, Calendar.token).where(Calendar.expiration.is_null(False))
+        return {str(channel_id): str(token) for channel_id, token in query.tuples()}
+
+
+class ChannelTokenCache:
+    """
+    Tokens of the watched channels, loaded all at once and kept in memory, so that the notifications are
+    validated without a database query each. An unknown channel reloads the tokens, at most once per
+    reload_interval: new watches are known quickly, and junk notifications can't hammer the database
+    """
+
+    def __init__(self, load: Callable[[], Dict[str, str]] = load_channel_tokens, ttl: float = WEBHOOK_TOKEN_CACHE_TTL,
+                 reload_interval: float = WEBHOOK_TOKEN_RELOAD_INTERVAL):
+        self.load = load
+        self.ttl = ttl
+        self.reload_interval = reload_interval
+        self._tokens: Optional[Dict[str, str]] = None
+        self._loaded_at = 0.
+        self._lock = threading.Lock()
+
+    def is_valid(self, channel_id: str, token: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if (
+                    self._tokens is None
+                    or now - self._loaded_at > self.ttl
+                    or (channel_id not in self._tokens and now - self._loaded_at > self.reload_interval)
+            ):
+                self._tokens = self.load()
+                self._loaded_at = now
+            return self._tokens.get(channel_id) == token
+
+
+def forward_webhook(webhook_event: GoogleWebhookEvent, debouncer: WebhookDebouncer, message_number: Optional[str],
+                    token_cache: ChannelTokenCache = None) -> bool:
+    """
+    Sends the notification to the queue without touching the database, unless the token cache must be
+    (re)loaded. Returns whether the notification was forwarded
+    """
+    if token_cache is not None and not token_cache.is_valid(webhook_event.channel_id, webhook_event.token):
+        logger.warning(f"Invalid token for channel {webhook_event.channel_id}, ignoring notification")
+        return False
+
+    if not debouncer.should_forward(webhook_event.channel_id, webhook_event.state, message_number):
+        return False
+
+    sqs_event = SQSEvent(kind=QueueEvent.GOOGLE_WEBHOOK, data=webhook_event.dict())
+    try:
+        # the delay lets the next notifications of the burst be dropped, see WebhookDebouncer
+        get_sqs_client().send_message(
+            QueueUrl=os.environ["SQS_QUEUE_URL"], MessageBody=sqs_event.json(), DelaySeconds=int(debouncer.window)
+        )
+    except Exception as e:
+        # google retries the notification with the same message number
+        debouncer.cancel(webhook_event.channel_id, message_number)
+        raise e
+    return True
@@ -0,0 +1,35 @@
+"""
+Compares the cost of building a Google Calendar service with googleapiclient.discovery.build
+and with the cached discovery document of calensync.google_service.
+
+    python scripts/benchmark_service_build.py
+"""
+import timeit
+
+import httplib2
+from googleapiclient.discovery import build
+
+from calensync.google_service import build_calendar_service, get_discovery_document
+
+N = 50
+
+
+def build_with_discovery():
+    service = build('calendar', 'v3', http=httplib2.Http())
+    service.events()
+
+
+def build_with_cached_document():
+    service = build_calendar_service(http=httplib2.Http())
+    service.events()
+
+
+if __name__ == "__main__":
+    # the first call loads the cached document, it's excluded from the measure like the
+    # first discovery parsing of a warm lambda would be
+    get_discovery_document('calendar', 'v3')
+
+    for name, function in [("discovery.build", build_with_discovery),
+                           ("cached document", build_with_cached_document)]:
+        total = timeit.timeit(function, number=N)
+        print(f"{name:>16}: {1000 * total / N:.2f} ms per service")
@@ -4,7 +4,8 @@ from copy import copy
 import boto3
 from playhouse.migrate import migrate, PostgresqlMigrator
 
-from calensync.database.model import Calendar, OAuthState, User, Event, SyncRule, EmailDB, CalendarAccount
+from calensync.database.model import Calendar, OAuthState, User, Event, SyncRule, EmailDB, CalendarAccount, \
+    DailySyncRun
 from calensync.database.utils import DatabaseSession
 from calensync.log import get_logger
 from calensync.secure import encrypt_credentials
@@ -21,29 +22,37 @@ if __name__ == "__main__":
         # pass
         migrator = PostgresqlMigrator(db)
         with db.atomic():
-            field = copy(CalendarAccount.encrypted_credentials)
-            field.null = True
-            migrate(
-                migrator.add_column(
-                    CalendarAccount._meta.name,
-                    CalendarAccount.encrypted_credentials.column.name,
-                    field
-                )
-            )
-            for account in CalendarAccount.select():
-                account: CalendarAccount
-                logger.info(f"Updating account {account.id}")
-                credentials = account.credentials
-                encrypted = encrypt_credentials(credentials, boto_session)
-                account.encrypted_credentials = encrypted
-                account.save()
-
-            migrate(
-                migrator.add_not_null(
-                    CalendarAccount._meta.name,
-                    CalendarAccount.encrypted_credentials.column.name
-                )
-            )
+            DailySyncRun.create_table()
+            # migrate(
+            #     migrator.add_column(
+            #         Calendar._meta.name,
+            #         Calendar.sync_token.column.name,
+            #         Calendar.sync_token
+            #     )
+            # )
+            # field = copy(CalendarAccount.encrypted_credentials)
+            # field.null = True
+            # migrate(
+            #     migrator.add_column(
+            #         CalendarAccount._meta.name,
+            #         CalendarAccount.encrypted_credentials.column.name,
+            #         field
+            #     )
+            # )
+            # for account in CalendarAccount.select():
+            #     account: CalendarAccount
+            #     logger.info(f"Updating account {account.id}")
+            #     credentials = account.credentials
+            #     encrypted = encrypt_credentials(credentials, boto_session)
+            #     account.encrypted_credentials = encrypted
+            #     account.save()
+            #
+            # migrate(
+            #     migrator.add_not_null(
+            #         CalendarAccount._meta.name,
+            #         CalendarAccount.encrypted_credentials.column.name
+            #     )
+            # )
             # Event.drop_table()
             # SyncRule.create_table()
             # EmailDB.create_table()